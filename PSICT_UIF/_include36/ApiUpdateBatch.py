@@ -0,0 +1,107 @@
+## PSICT-UIF Labber API update batching
+##  Collects value updates destined for the Labber MeasurementObject into a
+##  single ordered batch, which is then flushed through a pluggable backend.
+
+import logging
+
+import PSICT_UIF._include36._LogLevels as LogLevels
+
+class ApiUpdateBatch:
+    '''
+    Ordered batch of pending Labber API value updates.
+
+    Each update is identified by its full channel name (target string) and item type (eg 'SINGLE', 'START', 'STOP', 'N_PTS'). Only the last value added for each (channel, item type) pair is kept, and it is placed at the position of that last write. The batch is applied by flushing it through a backend object, which must implement an update_value(target_string, value, item_type) method.
+    '''
+
+    def __init__(self, *, parent_logger_name = None):
+        ## Logging
+        if parent_logger_name is not None:
+            logger_name = '.'.join([parent_logger_name, 'ApiUpdateBatch'])
+        else:
+            logger_name = 'ApiUpdateBatch'
+        self.logger = logging.getLogger(logger_name)
+        ## Pending updates, keyed by (target_string, item_type)
+        self._updates = {}
+        ## Status message
+        self.logger.log(LogLevels.TRACE, 'Instance initialized.')
+
+    def __len__(self):
+        return len(self._updates)
+
+    def __iter__(self):
+        for (target_string, item_type), value in self._updates.items():
+            yield target_string, value, item_type
+
+    def add(self, target_string, value, item_type = 'SINGLE'):
+        '''
+        Add an update to the batch, replacing any earlier update to the same channel and item type.
+        '''
+        key = (target_string, item_type)
+        ## Remove earlier write so that the update takes the position of the latest write
+        if key in self._updates:
+            self.logger.log(LogLevels.TRACE, 'Replacing pending update for %s (%s)', target_string, item_type)
+            del self._updates[key]
+        self._updates[key] = value
+
+    def clear(self):
+        '''
+        Discard all pending updates.
+        '''
+        self._updates = {}
+
+    def flush(self, backend):
+        '''
+        Apply all pending updates in order through the given backend, and clear the batch.
+
+        Returns the number of updates applied.
+        '''
+        n_updates = len(self._updates)
+        self.logger.debug('Flushing {} API value updates...'.format(n_updates))
+        for target_string, value, item_type in self:
+            backend.update_value(target_string, value, item_type)
+        self.clear()
+        self.logger.debug('API value updates flushed.')
+        return n_updates
+
+###############################################################################
+## Backends
+
+class MeasurementObjectBackend:
+    '''
+    Backend which applies updates through a Labber ScriptTools MeasurementObject.
+    '''
+    requires_MeasurementObject = True
+
+    def __init__(self, MeasurementObject):
+        self.MeasurementObject = MeasurementObject
+
+    def update_value(self, target_string, value, item_type):
+        self.MeasurementObject.updateValue(target_string, value, item_type)
+
+
+class RecordingBackend:
+    '''
+    Backend which records updates in memory instead of applying them.
+
+    This does not require Labber, and so can be used to run and inspect the pre-processing pipeline on machines without a Labber installation.
+    '''
+    requires_MeasurementObject = False
+
+    def __init__(self):
+        self.updates = []   # list of (target_string, value, item_type) in order of application
+
+    def update_value(self, target_string, value, item_type):
+        self.updates.append((target_string, value, item_type))
+
+    def get_values(self):
+        '''
+        Get the recorded values as a dict of {(target_string, item_type): value}.
+        '''
+        return {(target_string, item_type): value \
+                        for target_string, value, item_type in self.updates}
+
+    def clear(self):
+        '''
+        Discard all recorded updates.
+        '''
+        self.updates = []
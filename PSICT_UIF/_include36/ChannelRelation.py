@@ -0,0 +1,144 @@
+## PSICT-UIF channel relation compiler
+##  Parses channel relation equation strings (as used for Labber channel
+##  relations) once, and provides their free variables, validation against
+##  the defined channel keys, and evaluation over NumPy arrays.
+
+import ast
+import functools
+
+import numpy as np
+
+## Modules available in relation strings, eg "np.sin(x)"
+RELATION_MODULES = {"np": np, "numpy": np}
+
+def _maximum(*values):
+    ## As the Python builtin: the largest element of a single argument, otherwise the element-wise maximum
+    if len(values) == 1:
+        return np.max(values[0])
+    return functools.reduce(np.maximum, values)
+
+def _minimum(*values):
+    if len(values) == 1:
+        return np.min(values[0])
+    return functools.reduce(np.minimum, values)
+
+def _to_int(value):
+    ## Truncates towards zero, as the Python builtin
+    return np.trunc(value).astype(np.int64)
+
+def _to_float(value):
+    return np.asarray(value, dtype = np.float64)
+
+## Functions available in relation strings without a module prefix, eg "sin(x)"; Python builtins are mapped to element-wise NumPy equivalents so that they can be evaluated over arrays
+RELATION_FUNCTIONS = {
+    "abs": np.abs, "round": np.round, "int": _to_int, "float": _to_float,
+    "max": _maximum, "min": _minimum,
+    "sqrt": np.sqrt, "exp": np.exp, "log": np.log, "log10": np.log10, "log2": np.log2,
+    "sin": np.sin, "cos": np.cos, "tan": np.tan, "arcsin": np.arcsin, "arccos": np.arccos, "arctan": np.arctan,
+    "arctan2": np.arctan2, "sinh": np.sinh, "cosh": np.cosh, "tanh": np.tanh, "hypot": np.hypot,
+    "floor": np.floor, "ceil": np.ceil, "trunc": np.trunc, "sign": np.sign, "mod": np.mod, "power": np.power,
+    "deg2rad": np.deg2rad, "rad2deg": np.rad2deg, "real": np.real, "imag": np.imag, "angle": np.angle,
+    "clip": np.clip, "where": np.where,
+}
+
+## Compiled relations, memoized by relation string
+_compiled_relations = {}
+
+def compile_relation(relation_string):
+    '''
+    Get the CompiledRelation for the given relation string.
+
+    Relations are only parsed once; subsequent calls with the same string return the same (cached) object.
+    '''
+    try:
+        return _compiled_relations[relation_string]
+    except KeyError:
+        compiled_relation = CompiledRelation(relation_string)
+        _compiled_relations[relation_string] = compiled_relation
+        return compiled_relation
+
+
+class CompiledRelation:
+    '''
+    A channel relation equation string, parsed as a Python expression.
+
+    The variables attribute lists the free variables (channel keys) of the relation in order of first appearance. Names used as functions (eg "sin(x)", "max(x, y)") are taken from RELATION_FUNCTIONS, and attributes of the numpy module (eg "np.pi") are also available; they are not variables. A ValueError is raised if the relation is not a valid expression, uses a function which is not in RELATION_FUNCTIONS, or refers to private (double-underscore) names.
+    '''
+    def __init__(self, relation_string):
+        self.relation_string = relation_string
+        try:
+            tree = ast.parse(relation_string.strip(), mode = "eval")
+        except SyntaxError as error:
+            raise ValueError("Invalid channel relation '{}': {}".format(relation_string, error.msg))
+        ## Extract variables and functions
+        visitor = _RelationVisitor(relation_string)
+        visitor.visit(tree)
+        self.variables = visitor.variables
+        self.functions = visitor.functions
+        ## Namespace for evaluation
+        self._namespace = dict(RELATION_MODULES, __builtins__ = {})
+        for function_name in self.functions:
+            try:
+                self._namespace[function_name] = RELATION_FUNCTIONS[function_name]
+            except KeyError:
+                raise ValueError("Unknown function '{}' in channel relation '{}'".format(function_name, relation_string))
+        self._code = compile(tree, "<channel relation>", "eval")
+
+    def __repr__(self):
+        return "<CompiledRelation '{}'>".format(self.relation_string)
+
+    def get_undefined_variables(self, defined_variables):
+        '''
+        Get the variables of the relation which are not in defined_variables (eg the defined channel keys).
+        '''
+        return [variable for variable in self.variables if variable not in defined_variables]
+
+    def evaluate(self, variable_values):
+        '''
+        Evaluate the relation for the given variable values (a dict of variable name: value).
+
+        Values can be scalars or NumPy arrays (which are broadcast against each other as usual), so that eg the values of a relation over a full sweep can be calculated at once. A KeyError is raised if any variables are missing.
+        '''
+        missing_variables = self.get_undefined_variables(variable_values)
+        if missing_variables:
+            raise KeyError("Missing values for variables {} in channel relation '{}'".format(missing_variables, self.relation_string))
+        local_values = {variable: np.asarray(variable_values[variable]) for variable in self.variables}
+        return np.asarray(eval(self._code, self._namespace, local_values))
+
+
+class _RelationVisitor(ast.NodeVisitor):
+    '''
+    Collects the variable and function names of a relation expression, in order of first appearance.
+    '''
+    def __init__(self, relation_string):
+        self.relation_string = relation_string
+        self.variables = []
+        self.functions = []
+
+    def check_name(self, name):
+        if name.startswith("__"):
+            raise ValueError("Invalid name '{}' in channel relation '{}'".format(name, self.relation_string))
+
+    def visit_Name(self, node):
+        self.check_name(node.id)
+        if node.id not in self.variables:
+            self.variables.append(node.id)
+
+    def visit_Attribute(self, node):
+        self.check_name(node.attr)
+        ## Attributes of modules are not variables; attributes of anything else (eg "x.real") are
+        if isinstance(node.value, ast.Name) and node.value.id in RELATION_MODULES:
+            return
+        self.visit(node.value)
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Name):
+            self.check_name(node.func.id)
+            if node.func.id not in self.functions:
+                self.functions.append(node.func.id)
+        else:
+            self.visit(node.func)
+        for arg in node.args:
+            self.visit(arg)
+        for keyword in node.keywords:
+            self.visit(keyword.value)
@@ -11,9 +11,11 @@ import inspect
 import pathlib
 import logging
 
-from Labber import ScriptTools
+## Labber (ScriptTools) and h5py are imported where they are first used
 
 import PSICT_UIF._include36._FileManager_rc as _rc
+from PSICT_UIF._include36.ReferenceCache import ReferenceCache
+from PSICT_UIF._include36.StageProfiler import StageProfiler
 import PSICT_UIF._include36._LogLevels as LogLevels
 
 class FileManager:
@@ -32,12 +34,19 @@ class FileManager:
         self.logger = logging.getLogger(logger_name)
         ## Set values of attributes constant across multiple methods
         self._REF_COPY_POSTFIX = _rc.REF_COPY_POSTFIX
+        self._ref_copy_strategies = list(_rc.REF_COPY_STRATEGIES)
+        self.reference_copy_strategy = None # strategy used to create the current reference file
+        self.referenceCache = None # ReferenceCache of prepared reference files; reference file copy is deferred if set
+        self._reserved_output_path = None # placeholder file reserving the output file name
+        self.profiler = StageProfiler(parent_logger_name = logger_name) # stage timings and counters; replaced by the interface's profiler
         ## Set Labber exe path to system default - can be overwritten by user in external script later
         self.setdef_labber_exe_path()
         ## Status message
         self.logger.log(LogLevels.TRACE, 'Instance initialized.')
 
     def __del__(self):
+        ## Release output file name reservation (if the measurement was not run)
+        self.release_output_file()
         ## Delete reference file (temporary copy of template file)
         self.clean_reference_file()
         ## Status message
@@ -118,6 +127,7 @@ class FileManager:
         NB: This method should not be used explicitly in the external script; it will be called as part of measurement pre-processing anyway.
         '''
         self.logger.debug("Setting Labber executable path through ScriptTools...")
+        from Labber import ScriptTools
         ## Set ScriptTools path
         ScriptTools.setExePath(self.labber_exe_path)
         ## Status message
@@ -149,29 +159,116 @@ class FileManager:
         self.template_path = self.generate_full_path(self.template_dir, self.template_file)
         ## Status message
         self.logger.info("Template file set as: {}".format(self.template_path))
-        ## Copy template file to create reference file
-        self.copy_reference_file()
-        self.logger.debug('Template file copied to temporary reference file.')
+        ## Copy template file to create reference file (deferred until the measurement when using the reference cache)
+        if self.referenceCache is None:
+            self.copy_reference_file()
+            self.logger.debug('Template file copied to temporary reference file.')
+        else:
+            self.set_reference_file()
+            self.logger.debug('Reference file copy deferred to measurement.')
 
-    def copy_reference_file(self):
+    def set_reference_file(self):
         '''
-        Copies the template file into a temporary reference file.
-
-        The temporary reference file will have all direct hdf5 edits applied to it, and the measurement will be run from it as well.
+        Set the temporary reference file names based on the template file.
         '''
-        self.logger.log(LogLevels.VERBOSE, "Copying reference file...")
-        ## Set reference file target names
         try:
             self.reference_dir = self.template_dir
             self.reference_file = "".join([self.template_file, self._REF_COPY_POSTFIX])
         except AttributeError:
             raise RuntimeError("The template directory and/or filename have not been specified.")
         self.reference_path = self.generate_full_path(self.reference_dir, self.reference_file)
-        ## Copy file
-        shutil.copy(self.template_path, self.reference_path)
+
+    def copy_reference_file(self, source_path = None):
+        '''
+        Copies the template file into a temporary reference file.
+
+        The temporary reference file will have all direct hdf5 edits applied to it, and the measurement will be run from it as well. If source_path is given (eg a cached prepared reference file), it is copied instead of the template file.
+        '''
+        self.logger.log(LogLevels.VERBOSE, "Copying reference file...")
+        ## Set reference file target names
+        self.set_reference_file()
+        if source_path is None:
+            source_path = self.template_path
+        ## Copy file, trying each strategy in turn
+        copy_functions = {
+                "reflink": copy_reflink,
+                "config_only": copy_config_only,
+                "copy": shutil.copy,
+            }
+        for strategy in self._ref_copy_strategies:
+            ## Rebuilding the hdf5 file only pays off for templates with a large amount of stored data
+            if strategy == "config_only" and os.path.getsize(source_path) < _rc.REF_CONFIG_ONLY_MIN_SIZE:
+                self.logger.log(LogLevels.TRACE, "Template file is small; skipping reference file copy strategy: {}".format(strategy))
+                continue
+            self.logger.log(LogLevels.TRACE, "Attempting reference file copy strategy: {}".format(strategy))
+            try:
+                copy_functions[strategy](source_path, self.reference_path)
+            except Exception as copy_error:
+                self.logger.debug("Reference file copy strategy {} failed: {}".format(strategy, repr(copy_error)))
+                ## Clean up partial output before the next attempt
+                if os.path.isfile(self.reference_path):
+                    os.remove(self.reference_path)
+            else:
+                self.reference_copy_strategy = strategy
+                ## A reflink clone shares the data blocks of the source file
+                if strategy == "config_only":
+                    self.profiler.count("hdf5_opens", 2)
+                if strategy != "reflink":
+                    self.profiler.count("bytes_copied", os.path.getsize(self.reference_path))
+                break
+        else:
+            raise RuntimeError("Could not copy template file {} using any of the strategies: {}".format(\
+                                            source_path, self._ref_copy_strategies))
         ## Status message
-        self.logger.debug("Reference file copied successfully: {}".format(self.reference_path))
+        self.logger.debug("Reference file copied successfully ({}): {}".format(self.reference_copy_strategy, self.reference_path))
+
+    def set_reference_copy_strategies(self, strategies):
+        '''
+        Set the strategies used to create the reference file from the template file, in the order in which they are tried.
+
+        Valid strategies are "reflink" (copy-on-write clone), "config_only" (hdf5 copy excluding stored data), and "copy" (full copy); the default order is set by REF_COPY_STRATEGIES in the _FileManager_rc file. Note that this must be set before the template file is set to take effect.
+        '''
+        strategies = list(strategies)
+        for strategy in strategies:
+            if strategy not in ["reflink", "config_only", "copy"]:
+                raise ValueError("Invalid reference file copy strategy: {}".format(strategy))
+        self._ref_copy_strategies = strategies
+        self.logger.log(LogLevels.VERBOSE, "Reference file copy strategies set to: {}".format(self._ref_copy_strategies))
+
+
+    ## Reference cache methods
+
+    def set_reference_cache(self, cache_dir, *, max_size = None):
+        '''
+        Use a cache of prepared reference files in cache_dir, with a maximum total size of max_size bytes (ReferenceCache default if None).
+
+        When the cache is used, the reference file is only created at the start of the measurement (by prepare_reference_file), so this must be set before the template file is set.
+        '''
+        cache_kwargs = {} if max_size is None else {"max_size": max_size}
+        self.referenceCache = ReferenceCache(cache_dir, parent_logger_name = self.logger.name, **cache_kwargs)
+        self.logger.log(LogLevels.VERBOSE, "Reference cache set to: {}".format(self.referenceCache.cache_dir))
+
+    def prepare_reference_file(self, state_hash):
+        '''
+        Create the reference file for the measurement, from the reference cache if possible.
+
+        state_hash describes all settings which affect the direct edits to the reference file. Returns True if a cached reference file (with all edits already applied) was used, and False if the template file was copied (in which case the edits must be applied, and the result published with publish_reference_file).
+        '''
+        self._reference_cache_key = self.referenceCache.get_key(self.template_path, state_hash)
+        cached_path = self.referenceCache.lookup(self._reference_cache_key)
+        if cached_path is not None:
+            self.copy_reference_file(source_path = cached_path)
+            self.logger.log(LogLevels.VERBOSE, "Reference file created from cache.")
+            return True
+        self.copy_reference_file()
+        return False
 
+    def publish_reference_file(self):
+        '''
+        Add the prepared reference file to the reference cache, under the key from the last prepare_reference_file call.
+        '''
+        self.referenceCache.publish(self._reference_cache_key, self.reference_path)
+        self.profiler.count("bytes_copied", os.path.getsize(self.reference_path))
 
     def clean_reference_file(self):
         '''
@@ -183,7 +280,7 @@ class FileManager:
             os.remove(self.reference_path)
         except (AttributeError, FileNotFoundError):
             ## Log but do nothing
-            self.logger.warning('Reference file {} not found!'.format(self.reference_path))
+            self.logger.warning('Reference file {} not found!'.format(getattr(self, 'reference_path', None)))
             pass
         else:
             self.logger.log(LogLevels.DEBUG, "Deleted reference file {}".format(self.reference_path))
@@ -199,8 +296,12 @@ class FileManager:
          - If allowed, this will attempt to increment the last valid integer string appearing in the file name, eg "myfile_034" -> "myfile_035".
          - If disallowed, or if allowed and unable to parse a sequential integer from the file name, a RuntimeError will be raised.
         Basically, the PSICT-UIF will never overwrite an existing output file.
+
+        The output file name is reserved with a placeholder file until the measurement has been carried out, so that concurrent scripts writing to the same directory will not be assigned the same output file.
         '''
         self.logger.debug("Setting output file...")
+        ## Release any previous reservation
+        self.release_output_file()
         ## Set output dir (will not change)
         self.output_dir = os.path.abspath(os.path.normpath(output_dir))
         ## Create output dir if it does not exist
@@ -221,6 +322,8 @@ class FileManager:
         Return the name of a valid output file.
 
         If the specified file does not already exist, it will be returned as-is. If the file already exists, incrementation of the file name (see the FileManager.increment_filename method) will be attempted. If this cannot be done, a RuntimeError will be raised.
+
+        The existing files are found from a single listing of the directory, and the incremented file name takes the sequential id following the highest one in use (see the FileManager.get_next_free_filename method), rather than checking each incremented file name in turn. The returned file name is reserved (see the FileManager.reserve_output_file method).
         '''
         ## preparation
         flag_increment = False   # set if incrementation attempt is to be attempted
@@ -228,9 +331,11 @@ class FileManager:
         file_new = file_in
         ## Status message
         self.logger.debug("Verifying output file: {}".format(path_in))
+        ## Get names of existing (or reserved) output files
+        existing_files = self.get_existing_output_files(dir_in)
 
         ## Check if file already exists
-        if not os.path.isfile(path_in):
+        if file_in not in existing_files and self.reserve_output_file(dir_in, file_in):
             ## File does not exist; set new file name as-is
             self.logger.debug("The file {} does not already exist.".format(path_in))
             ## Keep going past incrementation, return as-is
@@ -256,14 +361,14 @@ class FileManager:
         ## Attempt to increment filename if required
         if flag_increment:
             self.logger.debug("Attempting to increment file name...")
-            n_incr_attempts = 0   # log number of attempts to prevent loop with no exit condition
-            path_new = self.generate_full_path(dir_in, file_new)
-            while os.path.isfile(path_new):
-                self.logger.debug("File {} exists; incrementing...".format(path_new))
+            ## Jump straight past the highest sequential id in use
+            file_new = self.get_next_free_filename(file_new, existing_files)
+            n_incr_attempts = 1   # log number of attempts to prevent loop with no exit condition
+            ## Reserve file name; this only fails if another script has taken it since the directory was listed
+            while not self.reserve_output_file(dir_in, file_new):
+                self.logger.debug("File {} was taken concurrently; incrementing...".format(file_new))
                 ## increment filename
                 file_new = self.increment_filename(file_new)
-                ## update other values
-                path_new = self.generate_full_path(dir_in, file_new)
                 n_incr_attempts = n_incr_attempts + 1
                 ## check if max number of attempts exceeded
                 if n_incr_attempts > _rc.INCREMENT_MAX_ATTEMPTS:
@@ -277,6 +382,55 @@ class FileManager:
         self.logger.debug("The file {} is a valid output file.".format(path_new))
         return file_new
 
+    def get_existing_output_files(self, dir_in):
+        '''
+        Get the set of names (without extension) of the existing and reserved database files in dir_in, from a single directory listing.
+        '''
+        database_ext = "".join([".", _rc.FILE_DATABASE_EXT])
+        reserved_ext = "".join([database_ext, _rc.OUTFILE_RESERVED_POSTFIX])
+        existing_files = set()
+        for file_name in os.listdir(dir_in):
+            if file_name.endswith(database_ext):
+                existing_files.add(file_name[:-len(database_ext)])
+            elif file_name.endswith(reserved_ext):
+                existing_files.add(file_name[:-len(reserved_ext)])
+        self.logger.log(LogLevels.TRACE, "Found {} existing output files in {}".format(len(existing_files), dir_in))
+        return existing_files
+
+    def reserve_output_file(self, dir_in, file_in):
+        '''
+        Atomically reserve an output file name by creating a placeholder file next to it.
+
+        Returns False if the name is already reserved, or the output file itself already exists. Only one output file name is reserved at a time; the reservation is released by the release_output_file method.
+        '''
+        output_path = self.generate_full_path(dir_in, file_in)
+        reserved_path = "".join([output_path, _rc.OUTFILE_RESERVED_POSTFIX])
+        try:
+            os.close(os.open(reserved_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        ## The output file may have been written since the directory was listed
+        if os.path.isfile(output_path):
+            os.remove(reserved_path)
+            return False
+        self.release_output_file()
+        self._reserved_output_path = reserved_path
+        self.logger.log(LogLevels.TRACE, "Reserved output file: {}".format(output_path))
+        return True
+
+    def release_output_file(self):
+        '''
+        Release the current output file name reservation (ie delete the placeholder file), if any.
+        '''
+        if self._reserved_output_path is None:
+            return
+        try:
+            os.remove(self._reserved_output_path)
+        except FileNotFoundError:
+            pass
+        self.logger.log(LogLevels.TRACE, "Released output file reservation: {}".format(self._reserved_output_path))
+        self._reserved_output_path = None
+
     def increment_filename(self, fname_in):
         '''
         Attempt to increment a filename by increasing a sequential id integer at the end of the filename string by 1, and returning the new filename.
@@ -293,6 +447,27 @@ class FileManager:
         new_fname = "".join([fname_head, new_id])
         return new_fname
 
+    def get_next_free_filename(self, fname_in, existing_files):
+        '''
+        Get the filename following the highest sequential id in use among existing_files for the same filename head, in a single pass over the names.
+
+        The sequential id of the new filename is one more than the larger of the id of fname_in and the highest existing id (with the leading zeros of fname_in preserved), so names below the highest existing id are not re-used even if they are free.
+        '''
+        ## Split the file name into a head and sequential id
+        fname_split = re.split(r'(\d+$)', fname_in)    # split by int searching from back
+        if len(fname_split) < 2:                         # could not split properly
+            raise RuntimeError("Could not identify sequential ID in filename:", fname_in)
+        fname_head = fname_split[0]
+        fname_id = fname_split[1]
+        ## Find the highest id in use for the same head
+        id_pattern = re.compile("".join([re.escape(fname_head), r'(\d+)$']))
+        max_id = int(fname_id)
+        for existing_file in existing_files:
+            id_match = id_pattern.match(existing_file)
+            if id_match is not None:
+                max_id = max(max_id, int(id_match.group(1)))
+        return "".join([fname_head, str(max_id + 1).zfill(len(fname_id))])
+
     def increment_string(self, str_in):
         '''
         Increment a string, preserving leading zeros.
@@ -346,6 +521,7 @@ class FileManager:
                 script_path_original = os.path.join(self._original_wd, self._script_inv)
                 self.logger.log(LogLevels.VERBOSE, "Original script is: {}".format(script_path_original))
                 script_path_new = shutil.copy(script_path_original, script_target_path)
+                self.profiler.count("bytes_copied", os.path.getsize(script_path_new))
                 self.logger.log(LogLevels.INFO, "Script file copied to: {}".format(script_path_new))
         else:
             ## Copying script not enabled
@@ -353,3 +529,37 @@ class FileManager:
         ##
 
     # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+###############################################################################
+## Reference file copy strategies
+
+FICLONE = 0x40049409 # Linux ioctl request code for a copy-on-write clone of a whole file
+
+def copy_reflink(src_path, dst_path):
+    '''
+    Create dst_path as a copy-on-write clone of src_path.
+
+    This is only supported on Linux, on filesystems which support reflinks (eg btrfs, xfs); an OSError is raised otherwise.
+    '''
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("Reflink copies are not supported on this platform.")
+    with open(src_path, "rb") as src_file, open(dst_path, "wb") as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    shutil.copymode(src_path, dst_path)
+
+def copy_config_only(src_path, dst_path, excluded_groups = _rc.REF_COPY_EXCLUDED_GROUPS):
+    '''
+    Create dst_path as a new hdf5 file containing the contents of src_path, except the top-level groups matching excluded_groups (the stored data).
+
+    All file attributes and all other top-level groups and datasets (eg 'Step list', 'Step config', 'Instrument config', 'Channels') are copied as-is.
+    '''
+    import h5py
+    with h5py.File(src_path, "r") as src_file, h5py.File(dst_path, "w") as dst_file:
+        for attr_name, attr_value in src_file.attrs.items():
+            dst_file.attrs[attr_name] = attr_value
+        for key in src_file:
+            if re.match(excluded_groups, key):
+                continue
+            src_file.copy(key, dst_file)
@@ -0,0 +1,321 @@
+## PSICT-UIF InstrumentServer connection pool
+##  Keeps connections to the Labber InstrumentServer and to individual
+##  InstrumentClients open across measurements in the same process.
+
+import time
+import threading
+import atexit
+import hashlib
+import logging
+
+import numpy as np
+
+import PSICT_UIF._include36._LogLevels as LogLevels
+
+## Pool defaults
+DEFAULT_IDLE_TIMEOUT = 600.0         # connections unused for longer than this (in s) are closed and re-opened
+DEFAULT_HEALTH_CHECK_INTERVAL = 10.0 # connections unused for longer than this (in s) are health-checked before re-use
+
+class _PoolEntry:
+    '''
+    A pooled connection, with the time at which it was last used.
+
+    For instrument connections, applied_values holds the fingerprints of the last values pushed to the instrument through this connection.
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+        self.last_used = time.monotonic()
+        self.applied_values = {}
+
+    @property
+    def idle_time(self):
+        return time.monotonic() - self.last_used
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+
+class InstrumentServerPool:
+    '''
+    Process-wide pool of connections to Labber InstrumentServers and InstrumentClients.
+
+    Server connections are keyed by server name, and instrument connections by (server name, hardware name, instrument name). Different instruments can be acquired concurrently from separate threads; each server or instrument connection is only opened or checked by one thread at a time, without holding up connections to the others. Connections which have been idle for longer than the idle timeout are closed and re-opened on their next use; connections which have been idle for longer than the health check interval are checked (through a cheap query) before being handed out again, and re-opened if the check fails.
+
+    The connect_function (Labber.connectToServer by default) is called with the server name to open a new server connection; a FakeInstrumentServer can be used in its place to use the pool without Labber.
+    '''
+
+    def __init__(self, *, connect_function = None, idle_timeout = DEFAULT_IDLE_TIMEOUT, \
+                          health_check_interval = DEFAULT_HEALTH_CHECK_INTERVAL, parent_logger_name = None):
+        ## Logging
+        if parent_logger_name is not None:
+            logger_name = '.'.join([parent_logger_name, 'InstrumentServerPool'])
+        else:
+            logger_name = 'InstrumentServerPool'
+        self.logger = logging.getLogger(logger_name)
+        ## Settings
+        self._connect_function = connect_function
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        ## Pooled connections
+        self._servers = {}      # server_name: _PoolEntry
+        self._instruments = {}  # (server_name, hardware_name, instrument_name): _PoolEntry
+        self._lock = threading.RLock()
+        self._server_locks = {}     # server_name: threading.Lock
+        self._instrument_locks = {} # (server_name, hardware_name, instrument_name): threading.Lock
+        ## Status message
+        self.logger.log(LogLevels.TRACE, 'Instance initialized.')
+
+    # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+    ## Acquiring connections
+
+    def get_server(self, server_name):
+        '''
+        Get a (pooled) connection to the InstrumentServer with the given name.
+        '''
+        ## Only hold the pool-wide lock for bookkeeping, so that the health check round trip does not block other connections
+        with self._lock:
+            server_lock = self._server_locks.setdefault(server_name, threading.Lock())
+        with server_lock:
+            with self._lock:
+                entry = self._servers.get(server_name)
+            if entry is not None and not self._is_usable(entry, _check_server):
+                self.logger.debug('Re-opening connection to InstrumentServer: {}'.format(server_name))
+                self.close_server(server_name)
+                entry = None
+            if entry is None:
+                self.logger.debug('Opening connection to InstrumentServer: {}'.format(server_name))
+                entry = _PoolEntry(self._connect(server_name))
+                with self._lock:
+                    self._servers[server_name] = entry
+            entry.touch()
+            return entry.connection
+
+    def get_instrument(self, server_name, hardware_name, instrument_name):
+        '''
+        Get a (pooled) InstrumentClient for the given instrument on the given server.
+        '''
+        key = (server_name, hardware_name, instrument_name)
+        ## Only hold the pool-wide lock for bookkeeping, so that other instruments can be connected concurrently
+        with self._lock:
+            instrument_lock = self._instrument_locks.setdefault(key, threading.Lock())
+        with instrument_lock:
+            with self._lock:
+                entry = self._instruments.get(key)
+            if entry is not None and not self._is_usable(entry, _check_instrument):
+                self.logger.debug('Re-opening connection to instrument: {} ({})'.format(instrument_name, hardware_name))
+                self.discard_instrument(server_name, hardware_name, instrument_name)
+                entry = None
+            if entry is None:
+                self.logger.debug('Connecting to instrument: {} ({})'.format(instrument_name, hardware_name))
+                server_client = self.get_server(server_name)
+                entry = _PoolEntry(server_client.connectToInstrument(hardware_name, {'name': instrument_name}))
+                with self._lock:
+                    self._instruments[key] = entry
+            entry.touch()
+            return entry.connection
+
+    def get_applied_values(self, server_name, hardware_name, instrument_name):
+        '''
+        Get the dict of value fingerprints last applied to the given instrument through its pooled connection.
+
+        The dict is reset whenever the connection is (re-)opened, as the instrument state can no longer be assumed to be known.
+        '''
+        with self._lock:
+            entry = self._instruments.get((server_name, hardware_name, instrument_name))
+            if entry is None:
+                return {}
+            return entry.applied_values
+
+    def _connect(self, server_name):
+        if self._connect_function is None:
+            import Labber
+            return Labber.connectToServer(server_name)
+        return self._connect_function(server_name)
+
+    def _is_usable(self, entry, check_function):
+        '''
+        Check if a pooled connection can be handed out again.
+        '''
+        idle_time = entry.idle_time
+        if idle_time > self.idle_timeout:
+            return False
+        if idle_time > self.health_check_interval:
+            return check_function(entry.connection)
+        return True
+
+    # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+    ## Closing connections
+
+    def discard_instrument(self, server_name, hardware_name, instrument_name):
+        '''
+        Close and remove the pooled connection to the given instrument (eg after an error).
+        '''
+        with self._lock:
+            entry = self._instruments.pop((server_name, hardware_name, instrument_name), None)
+            if entry is not None:
+                _close_quietly(entry.connection.disconnectFromInstr)
+                self.logger.debug('Disconnected from instrument: {}'.format(instrument_name))
+
+    def close_server(self, server_name):
+        '''
+        Close the connection to the given server, along with all of its instrument connections.
+        '''
+        with self._lock:
+            for key in [key for key in self._instruments if key[0] == server_name]:
+                self.discard_instrument(*key)
+            entry = self._servers.pop(server_name, None)
+            if entry is not None:
+                _close_quietly(entry.connection.close)
+                self.logger.debug('Labber InstrumentServer connection closed: {}'.format(server_name))
+
+    def close_idle(self):
+        '''
+        Close all connections which have been idle for longer than the idle timeout.
+        '''
+        with self._lock:
+            for key, entry in list(self._instruments.items()):
+                if entry.idle_time > self.idle_timeout:
+                    self.discard_instrument(*key)
+            for server_name, entry in list(self._servers.items()):
+                if entry.idle_time > self.idle_timeout:
+                    self.close_server(server_name)
+
+    def close_all(self):
+        '''
+        Close all pooled connections.
+        '''
+        with self._lock:
+            for server_name in list(self._servers):
+                self.close_server(server_name)
+            for key in list(self._instruments):
+                self.discard_instrument(*key)
+
+
+def _check_server(server_client):
+    try:
+        server_client.getListOfInstruments()
+    except Exception:
+        return False
+    return True
+
+def _check_instrument(instrument_client):
+    try:
+        return bool(instrument_client.isRunning())
+    except Exception:
+        return False
+
+def _close_quietly(close_function):
+    try:
+        close_function()
+    except Exception:
+        pass
+
+def value_fingerprint(value):
+    '''
+    Get a fingerprint of a value to be set through the InstrumentClient, for comparing against previously applied values.
+
+    Lists and arrays are compared by a hash of their contents (along with their dtype and shape); all other values are compared directly.
+    '''
+    if isinstance(value, (list, np.ndarray)):
+        array = np.ascontiguousarray(value)
+        return ('array', array.dtype.str, array.shape, hashlib.sha1(array.tobytes()).hexdigest())
+    return ('value', value)
+
+def value_nbytes(value):
+    '''
+    Get the (approximate) number of bytes sent when setting a value through the InstrumentClient.
+    '''
+    if isinstance(value, (list, np.ndarray)):
+        return np.asarray(value).nbytes
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    return 8
+
+###############################################################################
+## Process-wide pool
+
+_server_pool = None
+
+def get_server_pool():
+    '''
+    Get the process-wide InstrumentServerPool, creating it if necessary.
+    '''
+    global _server_pool
+    if _server_pool is None:
+        _server_pool = InstrumentServerPool()
+        atexit.register(_server_pool.close_all)
+    return _server_pool
+
+###############################################################################
+## Offline stand-ins for the Labber server and instrument clients
+
+class FakeInstrumentServer:
+    '''
+    Offline stand-in for a Labber InstrumentServer connection (LabberClient).
+
+    Use as the connect_function of an InstrumentServerPool, eg InstrumentServerPool(connect_function = FakeInstrumentServer), to apply InstrumentClient values without Labber. The instruments (FakeInstrumentClient objects) are kept in the instruments attribute, keyed by (hardware_name, instrument_name), so that the values set can be inspected.
+
+    Each round trip to the server or to an instrument sleeps for latency seconds, to emulate the time taken by a real connection.
+    '''
+    def __init__(self, server_name = 'localhost', *, latency = 0.0):
+        self.server_name = server_name
+        self.latency = latency
+        self.instruments = {}
+        self.is_closed = False
+        self.n_round_trips = 0
+        self._lock = threading.Lock()
+
+    def connectToInstrument(self, hardware_name, com_cfg):
+        _round_trip(self)
+        key = (hardware_name, com_cfg['name'])
+        with self._lock:
+            if key not in self.instruments:
+                self.instruments[key] = FakeInstrumentClient(hardware_name, com_cfg['name'], \
+                                                             latency = self.latency)
+            self.instruments[key].is_connected = True
+            return self.instruments[key]
+
+    def getListOfInstruments(self):
+        _round_trip(self)
+        return list(self.instruments.keys())
+
+    def close(self):
+        self.is_closed = True
+
+
+class FakeInstrumentClient:
+    '''
+    Offline stand-in for a Labber InstrumentClient, which stores all set values in its values attribute.
+    '''
+    def __init__(self, hardware_name, instrument_name, *, latency = 0.0):
+        self.hardware_name = hardware_name
+        self.instrument_name = instrument_name
+        self.latency = latency
+        self.values = {}
+        self.is_connected = True
+        self.n_round_trips = 0
+
+    def setValue(self, param_name, param_value):
+        _round_trip(self)
+        self.values[param_name] = param_value
+        return param_value
+
+    def setInstrConfig(self, config_dict):
+        _round_trip(self)
+        self.values.update(config_dict)
+
+    def getValue(self, param_name):
+        _round_trip(self)
+        return self.values[param_name]
+
+    def isRunning(self):
+        _round_trip(self)
+        return self.is_connected
+
+    def disconnectFromInstr(self):
+        self.is_connected = False
+
+def _round_trip(fake_connection):
+    fake_connection.n_round_trips += 1
+    if fake_connection.latency > 0:
+        time.sleep(fake_connection.latency)
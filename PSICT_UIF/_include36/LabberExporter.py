@@ -2,17 +2,45 @@
 ##  Stores and prepares all parameter settings before sending them to the
 ##  Labber measurement program.
 
-import h5py
 import numpy as np
 import logging
+import json
+import hashlib
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
 
-from Labber import ScriptTools
-import Labber
+## Labber (ScriptTools) is imported when the MeasurementObject is initialised
 
 import PSICT_UIF._include36._Pulse_rc as _Pulse_rc
-from PSICT_UIF._include36.ParameterSpec import IterationSpec
+import PSICT_UIF._include36._LabberExporter_rc as _rc
+from PSICT_UIF._include36.ParameterSpec import IterationSpec, make_iteration_spec
 import PSICT_UIF._include36._LogLevels as LogLevels
 from PSICT_UIF._include36._Common import extract_relation_variables
+from PSICT_UIF._include36.ChannelRelation import compile_relation
+from PSICT_UIF._include36.SweepGrid import SweepGrid, DEFAULT_CHUNK_SIZE
+from PSICT_UIF._include36.ReferenceFileSession import ReferenceFileSession
+from PSICT_UIF._include36.ApiUpdateBatch import ApiUpdateBatch, MeasurementObjectBackend
+from PSICT_UIF._include36.InstrumentServerPool import get_server_pool, value_fingerprint, value_nbytes
+from PSICT_UIF._include36.StageProfiler import StageProfiler
+
+def get_state_json_value(value):
+    '''
+    Get a JSON-serialisable representation of a value which is not otherwise serialisable, for hashing the reference state.
+
+    Arrays are represented by a hash of their contents along with their dtype and shape (their repr is truncated by NumPy, so that different large arrays could otherwise give the same hash), and IterationSpec objects by their spec key (with explicit values as an array). All other values are represented by their repr.
+    '''
+    if isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            return ['ndarray', value.shape, value.tolist()]
+        array = np.ascontiguousarray(value)
+        return ['ndarray', array.dtype.str, array.shape, hashlib.sha1(array.tobytes()).hexdigest()]
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, IterationSpec):
+        if value.values is not None:
+            return ['IterationSpec', 'values', value.values]
+        return ['IterationSpec', value.get_spec_key()]
+    return repr(value)
 
 class LabberExporter:
     '''
@@ -32,8 +60,18 @@ class LabberExporter:
         self.logger = logging.getLogger(logger_name)
         ## Labber MeasurementObject - will be set later
         self.MeasurementObject = None
+        self._reference_path = None # path to reference file; set with MeasurementObject
+        ## Labber API updates are batched, and flushed through the API backend
+        self._api_batch = ApiUpdateBatch(parent_logger_name = logger_name)
+        self._api_backend = None    # defaults to the MeasurementObject if not set
         ## Set server name to 'localhost' as default
         self.set_server_name('localhost')
+        ## InstrumentClient connections - the process-wide pool is used unless set otherwise
+        self._server_pool = None
+        self._client_readback = False # read back string values after setting them (for logging only)
+        self._client_force_refresh = False # send all client values, even if unchanged since they were last applied
+        self.client_write_stats = {} # InstrumentClient write counters for the last apply_all
+        self._client_max_workers = 1  # number of instruments to which client values are applied concurrently
         ## Parameter containers
         self._api_values = {}     # parameter values which will be set through the Labber API
         self._client_values = {}  # parameter values which will be set through the InstrumentClient interface
@@ -46,6 +84,8 @@ class LabberExporter:
         self._channel_relations = {} # Actual channel relations
         ## Other attributes
         self._hdf5_sl_entry_dtype = None # Stores the dtype of the hdf5 step list entries (this can't be auto-generated for some reason...)
+        self._reference_session = None   # ReferenceFileSession, if one is currently open
+        self.profiler = StageProfiler(parent_logger_name = logger_name) # stage timings and counters; replaced by the interface's profiler
         ## Status message
         self.logger.log(LogLevels.TRACE, "Instance initialized.")
 
@@ -93,6 +133,52 @@ class LabberExporter:
         self._InstrumentServer = server_name
         self.logger.log(LogLevels.VERBOSE, 'InstrumentServer set to: {}'.format(server_name))
 
+    def set_server_pool(self, server_pool):
+        '''
+        Set the InstrumentServerPool used for InstrumentClient connections.
+
+        By default (or if set to None), the process-wide pool is used, so that connections persist across measurements.
+        '''
+        self._server_pool = server_pool
+
+    def get_server_pool(self):
+        '''
+        Get the InstrumentServerPool used for InstrumentClient connections.
+        '''
+        if self._server_pool is None:
+            return get_server_pool()
+        return self._server_pool
+
+    def set_client_readback(self, readback):
+        '''
+        Set whether string values set through the InstrumentClient interface are read back from the instrument for logging.
+
+        This costs one additional round trip per string value, and is disabled by default.
+        '''
+        self._client_readback = bool(readback)
+        self.logger.log(LogLevels.VERBOSE, 'InstrumentClient read-back set to: {}'.format(self._client_readback))
+
+    def set_client_force_refresh(self, force_refresh):
+        '''
+        Set whether all InstrumentClient values are sent, even if they are unchanged since they were last applied.
+
+        By default, only values which differ from those last applied through the (pooled) instrument connection are sent.
+        '''
+        self._client_force_refresh = bool(force_refresh)
+        self.logger.log(LogLevels.VERBOSE, 'InstrumentClient force refresh set to: {}'.format(self._client_force_refresh))
+
+    def set_client_max_workers(self, max_workers):
+        '''
+        Set the maximum number of instruments to which InstrumentClient values are applied concurrently.
+
+        The default of 1 applies the values to each instrument in turn; larger values apply them from a pool of worker threads, one instrument per thread.
+        '''
+        max_workers = int(max_workers)
+        if max_workers < 1:
+            raise ValueError('The maximum number of client workers must be at least 1 (got {})'.format(max_workers))
+        self._client_max_workers = max_workers
+        self.logger.log(LogLevels.VERBOSE, 'InstrumentClient max workers set to: {}'.format(self._client_max_workers))
+
     def add_client_value_spec(self, instrument_name, instrument_params, hardware_name):
         '''
         Add specifications that are to be set via the Labber InstrumentClient API.
@@ -126,10 +212,7 @@ class LabberExporter:
             self._api_values[instrument_name] = {}
         ## Import parameters
         for param_name, iter_list in instrument_params.items():
-            iter_obj = IterationSpec({"start_value": iter_list[0],
-                                      "stop_value": iter_list[1],
-                                      "n_pts": iter_list[2],
-                                    })
+            iter_obj = make_iteration_spec(iter_list)
             self._api_values[instrument_name][param_name] = iter_obj
             self.logger.debug("Set {} - {} to {}".format(instrument_name, \
                                                     param_name, iter_obj))
@@ -150,15 +233,20 @@ class LabberExporter:
         '''
         Carry out any processing operations required on the iteration order specification.
 
-        Most importantly, converts the iteration order specifications into full channel names.
+        Most importantly, converts the iteration order specifications into full channel names. Items which are already full channel names are kept as they are, so that the processing can be repeated.
         '''
         ## status message
         self.logger.debug("Processing iteration order specification...")
+        ## Map pulse names to numbers once for the whole iteration order
+        pulse_numbers = {pulse.name: pulse["pulse_number"] for pulse in self._pulse_sequence}
         ## Build full-channel names iteration order spec
         new_iteration_order = []
         for iter_item in self._iteration_order:
+            if isinstance(iter_item, str):
+                new_iteration_order.append(iter_item)
+                continue
             instrument_name = iter_item[0]
-            if instrument_name == "SQPG" and iter_item[0] == "main":
+            if instrument_name == "SQPG" and iter_item[1][0] == "main":
                 param_name = iter_item[1][1]
                 ## Construct channel name
                 channel_name = " - ".join([instrument_name, param_name])
@@ -166,7 +254,10 @@ class LabberExporter:
                 pulse_name = iter_item[1][0]
                 param_name = iter_item[1][1]
                 ## Get pulse number corresponding to given name
-                pulse_number = [pulse["pulse_number"] for pulse in self._pulse_sequence if pulse.name == pulse_name][0]
+                try:
+                    pulse_number = pulse_numbers[pulse_name]
+                except KeyError:
+                    raise KeyError("No pulse with name {} exists in the pulse sequence.".format(pulse_name))
                 ## Construct channel name
                 channel_name = "".join([instrument_name, " - ", param_name, " #", str(pulse_number)])
             else:
@@ -266,6 +357,36 @@ class LabberExporter:
         self.logger.debug("Pulse definitions and relations received.")
 
 
+    # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+    ## Offline sweep estimation
+
+    def get_channel_values(self):
+        '''
+        Get the values of all channels set through the Labber API (including the SQPG pulse parameters), keyed by full channel name.
+
+        Values are either point values or IterationSpec objects.
+        '''
+        channel_values = {}
+        for instrument_name, instrument_params in self._api_values.items():
+            for param_name, param_value in instrument_params.items():
+                channel_values[self.get_full_label(instrument_name, param_name)] = param_value
+        for pulse in self._pulse_sequence:
+            pulse_number = pulse["pulse_number"]
+            for param_name in _Pulse_rc.FULL_NAMES_PULSES:
+                if param_name in pulse.attributes:
+                    channel_values[self.get_full_label("SQPG", param_name, pulse_number)] = pulse[param_name]
+        return channel_values
+
+    def get_sweep_grid(self, *, chunk_size = DEFAULT_CHUNK_SIZE):
+        '''
+        Get a SweepGrid of the stored iteration specifications and channel relations, for estimating the measurement size and derived channel values without Labber.
+
+        The iteration order should already have been processed (see process_iteration_order).
+        '''
+        return SweepGrid(self.get_channel_values(), iteration_order = self._iteration_order, \
+                         channel_defs = self._raw_channel_defs, channel_relations = self._channel_relations, \
+                         chunk_size = chunk_size, parent_logger_name = self.logger.name)
+
     # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
     ## Labber MeasurementObject methods
 
@@ -286,30 +407,129 @@ class LabberExporter:
             return
         else:
             ## Initialise MeasurementObject
+            from Labber import ScriptTools
             self.MeasurementObject = ScriptTools.MeasurementObject(\
                                         reference_path,
                                         output_path)
+            self.set_reference_path(reference_path)
             ## debug message
             self.logger.debug("MeasurementObject initialised.")
 
+    def set_reference_path(self, reference_path):
+        '''
+        Set the path of the reference hdf5 file to which direct edits are applied.
+
+        This is set automatically when the MeasurementObject is initialised, and only needs to be set explicitly when running without one (eg with a RecordingBackend).
+        '''
+        self._reference_path = reference_path
+        self.logger.debug("Reference path set to: {}".format(reference_path))
+
+    def set_api_backend(self, backend):
+        '''
+        Set the backend through which batched Labber API value updates are applied.
+
+        The backend must implement an update_value(target_string, value, item_type) method. If no backend is set (or it is set to None), updates are applied through the MeasurementObject.
+        '''
+        self._api_backend = backend
+        self.logger.log(LogLevels.VERBOSE, "API backend set to: {}".format(type(backend).__name__))
+
+    def get_api_backend(self):
+        '''
+        Get the backend through which batched Labber API value updates are applied.
+        '''
+        if self._api_backend is None:
+            return MeasurementObjectBackend(self.MeasurementObject)
+        return self._api_backend
+
+    def requires_MeasurementObject(self):
+        '''
+        Check if the current API backend requires a Labber MeasurementObject.
+        '''
+        if self._api_backend is None:
+            return True
+        return getattr(self._api_backend, 'requires_MeasurementObject', True)
+
 
     # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
     ## Application of instrument parameter specifications
 
-    def apply_all(self):
+    def apply_all(self, *, single_session = True, reference_edits = True):
         '''
         Apply all stored parameters to the reference file, either through the Labber API or direct editing.
+
+        If single_session is set, the reference file is opened once and all direct edits are written back in a single flush at the end; otherwise, the file is opened and closed for each individual edit. The session is only opened after the Labber API and InstrumentClient values have been applied, as the Labber API backend (the MeasurementObject) itself writes to the reference file, and these writes would otherwise be overwritten when the session is committed.
+
+        If reference_edits is not set, the direct edits to the reference file (iteration order, Instrument Config values, and channel relations) are skipped, eg because the reference file has been taken from the reference cache with the edits already applied. Values set through the Labber API and the InstrumentClient interface are always applied.
+
+        The channel relations are checked (see check_relations) before any parameters are applied.
         '''
         ## Status message
         self.logger.log(LogLevels.VERBOSE, "Applying all instrument parameters from LabberExporter...")
-        ## Apply different parameter sets
-        self.apply_api_values()
-        self.apply_client_values()
-        self.apply_instr_config_values()
-        self.apply_relations()
+        ## Fail before the reference file is edited if any relations are invalid
+        if reference_edits:
+            self.check_relations()
+        ## Apply values which are not set by direct editing
+        with self.profiler.stage("api_values"):
+            self.apply_api_values(sort_iteration = False)
+        with self.profiler.stage("client_values"):
+            self.apply_client_values()
+        ## Apply direct edits to the reference file
+        if reference_edits:
+            with ExitStack() as stack:
+                ## Hold the reference file open for all direct edits
+                if single_session:
+                    stack.enter_context(self.reference_session())
+                with self.profiler.stage("iteration_order"):
+                    self.sort_iteration_order()
+                with self.profiler.stage("instr_config_values"):
+                    self.apply_instr_config_values()
+                with self.profiler.stage("step_items"):
+                    self.apply_step_items()
+                with self.profiler.stage("relations"):
+                    self.apply_relations()
+        else:
+            self.logger.debug("Skipping direct edits to the reference file.")
         ## debug message
         self.logger.log(LogLevels.VERBOSE, "Instrument parameters applied.")
 
+    def get_reference_state_hash(self):
+        '''
+        Get a hash of all stored settings which affect the direct edits to the reference file.
+
+        Together with the template file contents, this determines the prepared reference file, and so is used as part of the reference cache key. Note that the iteration order must already have been processed.
+        '''
+        reference_state = {
+                'iteration_order': self._iteration_order,
+                'instr_config_values': self._instr_config_values,
+                'instr_config_hardware_names': {instrument_name: self._hardware_names[instrument_name] \
+                                                    for instrument_name in self._instr_config_values},
+                'server_name': self._InstrumentServer,
+                'channel_defs': self._raw_channel_defs,
+                'channel_relations': self._channel_relations,
+                'step_items': self.get_step_items(),
+            }
+        state_string = json.dumps(reference_state, sort_keys = True, default = get_state_json_value)
+        return hashlib.sha1(state_string.encode('utf-8')).hexdigest()
+
+    @contextmanager
+    def reference_session(self):
+        '''
+        Get a ReferenceFileSession on the reference hdf5 file for the duration of the context.
+
+        If a session is already open (eg during apply_all), that session is used, and its edits will be written when it is closed. Otherwise, a new session is opened and committed at the end of the context.
+        '''
+        if self._reference_session is not None:
+            yield self._reference_session
+            return
+        self.profiler.count("hdf5_opens")
+        with ReferenceFileSession(self._reference_path, \
+                                  parent_logger_name = self.logger.name) as session:
+            self._reference_session = session
+            try:
+                yield session
+            finally:
+                self._reference_session = None
+
     def swap_items_by_index(self, container, index_1, index_2):
         '''
         Swap two items (specified by index) in the given container.
@@ -321,24 +541,22 @@ class LabberExporter:
     def sort_iteration_order(self):
         '''
         Re-order the iteration items list in the reference hdf5 file, based on the specified iteration order.
+
+        The specified channels are moved to the front of the 'Step list' in the given order; all other channels keep their relative order.
         '''
         ## Status message
         self.logger.debug("Sorting iteration order...")
-        ## Open reference config file and re-order iteration list
-        with h5py.File(self.MeasurementObject.sCfgFileIn, 'r+') as config_file:
-            for index_counter, channel_name in enumerate(self._iteration_order):
-                ## Generate list of channels in the order they currently appear
-                current_iter_order = [step_item[0] for step_item in config_file['Step list'][()]]
-                ## Get index of desired channel name in current order
-                channel_index = current_iter_order.index(channel_name)
-                ## Swap desired channel with that at index_counter
-                self.swap_items_by_index(config_file['Step list'], index_counter, channel_index)
+        ## Re-order iteration list in reference file as a single permutation
+        with self.reference_session() as session:
+            session.reorder_step_list(self._iteration_order)
         ## status message
         self.logger.debug("Iteration order sorted.")
 
-    def apply_api_values(self):
+    def apply_api_values(self, *, sort_iteration = True):
         '''
         Apply all stored point values (including for SQPG) through the Labber API.
+
+        The iteration order is then applied to the reference file, unless sort_iteration is not set.
         '''
         ## Status message
         self.logger.log(LogLevels.VERBOSE, "Applying parameter point values...")
@@ -349,18 +567,19 @@ class LabberExporter:
                 self.update_api_value(target_string, param_value)
         ## Apply pulse parameters for SQPG
         for pulse in self._pulse_sequence:
-            pulse_number = pulse.attributes["pulse_number"]
+            ## Read all set parameters of the pulse at once
+            pulse_attributes = dict(pulse.attributes.items())
+            pulse_number = pulse_attributes["pulse_number"]
             for param_name in _Pulse_rc.FULL_NAMES_PULSES:
-                try:
-                    param_value = pulse.attributes[param_name]
-                except KeyError:
-                    continue
-                else:
+                if param_name in pulse_attributes:
                     target_string = "".join([
                                             "SQPG - ", param_name, " #", str(pulse_number)])
-                    self.update_api_value(target_string, param_value)
+                    self.update_api_value(target_string, pulse_attributes[param_name])
+        ## Apply all queued updates in a single batch
+        self._api_batch.flush(self.get_api_backend())
         ## Sort iteration parameters
-        self.sort_iteration_order()
+        if sort_iteration:
+            self.sort_iteration_order()
         ## Status message
         self.logger.debug('Parameter point values applied.')
 
@@ -369,78 +588,163 @@ class LabberExporter:
         Update the value of an instrument parameter through the Labber API
 
         The specific parameter should be specified in full by the target_string. The type of the param_value will determine what is set: single -> single, IterationSpec -> iteration.
+
+        Only linear-range iterations can be set through the Labber API; all other iterations (log-spaced, explicit values, or segments) are skipped here and are instead written directly to the step items in the reference file (see apply_step_items).
+
+        The update is queued in the API update batch, and is only applied when the batch is flushed (at the end of apply_api_values).
         '''
         ## Check type of param value
-        if isinstance(param_value, IterationSpec):
+        ## (status messages are formatted lazily, as this is called for every parameter)
+        if isinstance(param_value, IterationSpec) and not param_value.is_linear:
+            self.logger.log(LogLevels.VERBOSE, \
+                    "Iteration for \'%s\' will be set as reference file step items: %s", target_string, param_value)
+        elif isinstance(param_value, IterationSpec):
             ## param_value is an IterationSpec object
-            self.MeasurementObject.updateValue(target_string, param_value.start_value, 'START')
-            self.MeasurementObject.updateValue(target_string, param_value.stop_value, 'STOP')
-            self.MeasurementObject.updateValue(target_string, param_value.n_pts, 'N_PTS')
+            self._api_batch.add(target_string, param_value.start_value, 'START')
+            self._api_batch.add(target_string, param_value.stop_value, 'STOP')
+            self._api_batch.add(target_string, param_value.n_pts, 'N_PTS')
             ## Status message
-            self.logger.log(LogLevels.SPECIAL, \
-                    "Instrument value updated: \'{}\' to {}".format(target_string, param_value))
+            self.logger.log(LogLevels.SPECIAL, "Instrument value queued: \'%s\' to %s", target_string, param_value)
         else: # the parameter is a single value, either string or numeric
-            self.MeasurementObject.updateValue(target_string, param_value, 'SINGLE')
+            self._api_batch.add(target_string, param_value, 'SINGLE')
             ## Status message
-            self.logger.log(LogLevels.VERBOSE, \
-                    "Instrument value updated: \'{}\' to {}".format(target_string, param_value))
-        ## Status message
-        self.logger.debug('Labber API values applied.')
+            self.logger.log(LogLevels.VERBOSE, "Instrument value queued: \'%s\' to %s", target_string, param_value)
 
     def apply_client_values(self):
         '''
         Apply all stored values that are marked for application through the InstrumentClient interface
+
+        Connections to the InstrumentServer and the instruments are taken from the InstrumentServerPool, and are kept open after the values have been applied. If more than one client worker is set (see set_client_max_workers), the instruments are handled concurrently; errors are then collected for all instruments and logged in instrument order, before the first one is re-raised.
         '''
         ## Status message
         self.logger.log(LogLevels.VERBOSE, 'Applying InstrumentClient values...')
-        ## Open server connection
-        self.logger.debug('Opening connection to Labber InstrumentServer...')
+        ## Reset write counters
+        self.client_write_stats = {'writes': 0, 'writes_skipped': 0, 'bytes_sent': 0, 'bytes_skipped': 0, 'round_trips': 0}
+        ## Nothing to do if no client values are specified
+        if not self._client_values:
+            self.logger.debug('No InstrumentClient values specified.')
+            return
+        ## Get server connection
+        server_pool = self.get_server_pool()
+        self.logger.debug('Getting connection to Labber InstrumentServer...')
         try:
-            ServerClient = Labber.connectToServer(self._InstrumentServer)
+            server_pool.get_server(self._InstrumentServer)
         except:
             self.logger.error('Could not connect to server; skipping...')
             ## Could not connect to server; do not attempt further client value application
             return
         else:
             pass
-        ## Iterate through instruments, opening InstrumentClient instance
-        for instrument_name, hardware_name in self._hardware_names.items():
-            ## Connect to instrument
-            self.logger.debug('Connecting to instrument {} ({})'.format(instrument_name, hardware_name))
-            ## Treat strings and lists/arrays differently (weird Labber quirk)
-            array_params = {}
-            string_params = {}
-            for param_name, param_value in self._client_values[instrument_name].items():
-                if isinstance(param_value, str):
-                    self.logger.log(LogLevels.TRACE, '{} is a string: {}'.format(param_name, param_value))
-                    string_params[param_name] = param_value
-                elif isinstance(param_value, list) or isinstance(param_value, np.ndarray):
-                    self.logger.log(LogLevels.TRACE, '{} is a list/array: {}'.format(param_name, param_value))
-                    array_params[param_name] = param_value
-            ## Open InstrumentClient
-            instClient = ServerClient.connectToInstrument(hardware_name, {'name': instrument_name})
+        ## Apply values for each instrument, either in turn or concurrently
+        if self._client_max_workers == 1 or len(self._client_values) == 1:
+            for instrument_name in self._client_values:
+                instrument_stats = self.apply_instrument_client_values(server_pool, instrument_name)
+                self.add_client_write_stats(instrument_stats)
+        else:
+            self.logger.debug('Applying InstrumentClient values with {} workers...'.format(self._client_max_workers))
+            with ThreadPoolExecutor(max_workers = self._client_max_workers) as executor:
+                futures = [(instrument_name, executor.submit(self.apply_instrument_client_values, \
+                                                            server_pool, instrument_name)) \
+                                    for instrument_name in self._client_values]
+            ## Collect results and errors in instrument order
+            errors = []
+            for instrument_name, future in futures:
+                error = future.exception()
+                if error is None:
+                    self.add_client_write_stats(future.result())
+                else:
+                    self.logger.error('Applying InstrumentClient values failed for instrument {}: {}'.format(instrument_name, repr(error)))
+                    errors.append(error)
+            if errors:
+                raise errors[0]
+        self.profiler.count("client_round_trips", self.client_write_stats['round_trips'])
+        ## Status message
+        self.logger.log(LogLevels.VERBOSE, 'InstrumentClient writes: {writes} sent ({bytes_sent} bytes, {round_trips} round trips), {writes_skipped} skipped ({bytes_skipped} bytes)'.format(**self.client_write_stats))
+        self.logger.debug('InstrumentClient values applied.')
+
+    def apply_instrument_client_values(self, server_pool, instrument_name):
+        '''
+        Apply the stored InstrumentClient values for a single instrument, using a connection from server_pool.
+
+        Returns the write counters for the instrument.
+        '''
+        instrument_params = self._client_values[instrument_name]
+        hardware_name = self._hardware_names[instrument_name]
+        instrument_stats = {'writes': 0, 'writes_skipped': 0, 'bytes_sent': 0, 'bytes_skipped': 0, 'round_trips': 0}
+        ## Connect to instrument
+        self.logger.debug('Connecting to instrument {} ({})'.format(instrument_name, hardware_name))
+        ## Treat strings and lists/arrays differently (weird Labber quirk)
+        array_params = {}
+        string_params = {}
+        for param_name, param_value in instrument_params.items():
+            if isinstance(param_value, str):
+                self.logger.log(LogLevels.TRACE, '{} is a string: {}'.format(param_name, param_value))
+                string_params[param_name] = param_value
+            elif isinstance(param_value, list) or isinstance(param_value, np.ndarray):
+                self.logger.log(LogLevels.TRACE, '{} is a list/array: {}'.format(param_name, param_value))
+                array_params[param_name] = param_value
+        ## Get InstrumentClient from pool
+        instClient = server_pool.get_instrument(self._InstrumentServer, hardware_name, instrument_name)
+        ## Skip values which are unchanged since they were last applied
+        applied_values = server_pool.get_applied_values(self._InstrumentServer, hardware_name, instrument_name)
+        array_params = self.filter_unchanged_client_values(array_params, applied_values, instrument_stats)
+        string_params = self.filter_unchanged_client_values(string_params, applied_values, instrument_stats)
+        try:
             ## Iterate over arrays/lists
             for param_name, param_value in array_params.items():
                 ## Set parameter value
                 instClient.setValue(param_name, param_value)
+                instrument_stats['round_trips'] += 1
+                applied_values[param_name] = value_fingerprint(param_value)
                 ## Status message
                 self.logger.debug('Set value: {} to {} ({})'.format(param_name, \
                                                     param_value, type(param_value)))
             ## Apply string values
-            instClient.setInstrConfig(string_params)
-            ## Print status messages
-            for param_name in string_params.keys():
-                self.logger.debug('Set value: {} to {}'.format(param_name, \
-                                            instClient.getValue(param_name)))
-            ## Close connection to instrument
-            instClient.disconnectFromInstr()
-            ##
-            self.logger.debug('Disconnected from instrument: {}'.format(instrument_name))
-        ## Close server connection
-        ServerClient.close()
-        self.logger.debug('Labber InstrumentServer connection closed.')
-        ## Status message
-        self.logger.debug('InstrumentClient values applied.')
+            if string_params:
+                instClient.setInstrConfig(string_params)
+                instrument_stats['round_trips'] += 1
+                for param_name, param_value in string_params.items():
+                    applied_values[param_name] = value_fingerprint(param_value)
+        except:
+            ## Do not re-use a connection which may be broken
+            server_pool.discard_instrument(self._InstrumentServer, hardware_name, instrument_name)
+            raise
+        ## Print status messages
+        for param_name, param_value in string_params.items():
+            if self._client_readback:
+                param_value = instClient.getValue(param_name)
+                instrument_stats['round_trips'] += 1
+            self.logger.debug('Set value: {} to {}'.format(param_name, param_value))
+        ##
+        self.logger.debug('InstrumentClient values applied for instrument: {}'.format(instrument_name))
+        return instrument_stats
+
+    def filter_unchanged_client_values(self, client_params, applied_values, write_stats):
+        '''
+        Get the subset of client_params which differ from the applied_values fingerprints, updating the write_stats counters.
+
+        If force refresh is enabled, all values are returned.
+        '''
+        changed_params = {}
+        for param_name, param_value in client_params.items():
+            n_bytes = value_nbytes(param_value)
+            if not self._client_force_refresh and \
+                    applied_values.get(param_name) == value_fingerprint(param_value):
+                self.logger.log(LogLevels.TRACE, 'Value for {} is unchanged; skipping...'.format(param_name))
+                write_stats['writes_skipped'] += 1
+                write_stats['bytes_skipped'] += n_bytes
+            else:
+                changed_params[param_name] = param_value
+                write_stats['writes'] += 1
+                write_stats['bytes_sent'] += n_bytes
+        return changed_params
+
+    def add_client_write_stats(self, write_stats):
+        '''
+        Add the write counters for a single instrument to the totals for the current application.
+        '''
+        for stat_name, stat_value in write_stats.items():
+            self.client_write_stats[stat_name] += stat_value
 
     def apply_instr_config_values(self):
         '''
@@ -454,15 +758,46 @@ class LabberExporter:
             instrument_params = self._instr_config_values[instrument_name]
             hardware_name = self._hardware_names[instrument_name]
             full_instrument_string = hardware_name+' - , '+instrument_name+' at '+self._InstrumentServer
-            ## Open file and set values
-            with h5py.File(self.MeasurementObject.sCfgFileIn, 'r+') as config_file:
+            ## Set values in reference file
+            with self.reference_session() as session:
                 ## Iterate over each instrument parameter
                 for param_name, param_value in instrument_params.items():
                     self.logger.debug('Setting value: {} to {}'.format(param_name, param_value))
-                    config_file['Instrument config'][full_instrument_string].attrs[param_name] = param_value
+                    session.set_instr_config_attr(full_instrument_string, param_name, param_value)
         ## Status message
         self.logger.debug('Instrument Config values applied.')
 
+    def get_step_items(self):
+        '''
+        Get the step items of all iterations which cannot be set through the Labber API, as a dict of full channel name: list of step item dicts (see IterationSpec.get_step_items).
+        '''
+        return {channel_name: channel_value.get_step_items() for channel_name, channel_value in self.get_channel_values().items() \
+                if isinstance(channel_value, IterationSpec) and not channel_value.is_linear}
+
+    def apply_step_items(self):
+        '''
+        Apply the step items of all non-linear iterations by directly editing the reference hdf5 file.
+        '''
+        ## Status message
+        self.logger.debug('Applying step items...')
+        all_step_items = self.get_step_items()
+        if not all_step_items:
+            return
+        with self.reference_session() as session:
+            for channel_name, step_items in all_step_items.items():
+                self.logger.log(LogLevels.VERBOSE, "Setting {} step items for {}".format(len(step_items), channel_name))
+                session.set_step_items(channel_name, [{
+                        "range_type": _rc.STEP_ITEM_RANGE_TYPES[step_item["range_type"]],
+                        "step_type": _rc.STEP_ITEM_STEP_TYPES["n_pts"],
+                        "single": step_item["single"],
+                        "start": step_item["start"],
+                        "stop": step_item["stop"],
+                        "n_pts": step_item["n_pts"],
+                        "interp": _rc.STEP_ITEM_INTERP_TYPES[step_item["interp"]],
+                    } for step_item in step_items])
+        ## Status message
+        self.logger.debug('Step items applied.')
+
     def process_channel_defs(self):
         '''
         Convert the stored channel definitions to the format required for application to the hdf5 file.
@@ -475,10 +810,8 @@ class LabberExporter:
         if self._hdf5_sl_entry_dtype is None:
             ## status message
             self.logger.debug("Fetching step list entry dtype...")
-            with h5py.File(self.MeasurementObject.sCfgFileIn, 'r') as config_file:
-                for instrument_key in config_file['Step config']:
-                    self._hdf5_sl_entry_dtype = np.dtype(config_file['Step config'][instrument_key]['Relation parameters'].dtype)
-                    break # only need to fetch once
+            with self.reference_session() as session:
+                self._hdf5_sl_entry_dtype = session.get_relation_params_dtype()
         ## Convert each of the stored definitions in self._raw_channel_defs to the appropriate format, and store in self._channel_defs
         for channel_key, channel_name in self._raw_channel_defs.items():
             self._channel_defs[channel_key] = np.array([(channel_key, channel_name, False)], dtype = self._hdf5_sl_entry_dtype)
@@ -492,13 +825,9 @@ class LabberExporter:
         '''
         ## status message
         self.logger.debug("Fetching step list index for {}...".format(label_string))
-        ## Open file and extract existing step list
-        with h5py.File(self.MeasurementObject.sCfgFileIn, 'r') as config_file:
-            step_list = config_file['Step list'][()]
-        self.logger.debug("Step list extracted.")
-        ## Get index of element with matching label string
-        step_list_labels = [labels['channel_name'] for labels in step_list]
-        index = step_list_labels.index(label_string)
+        ## Look up index of element with matching label string
+        with self.reference_session() as session:
+            index = session.get_step_list_index(label_string)
         self.logger.debug("Step list index extracted.")
         return index
 
@@ -513,12 +842,12 @@ class LabberExporter:
         ## Get step list index of label string
         step_list_index =self.get_sl_index(label_string)
         ## Modify step list entry
-        with h5py.File(self.MeasurementObject.sCfgFileIn, 'r+') as config_file:
-            new_entry = config_file['Step list'][step_list_index]
+        with self.reference_session() as session:
+            new_entry = session.get_step_list_entry(step_list_index)
             new_entry['equation'] = equation_string
             new_entry['use_relations'] = True
             new_entry['show_advanced'] = True
-            config_file['Step list'][step_list_index] = new_entry
+            session.set_step_list_entry(step_list_index, new_entry)
         ## status message
         self.logger.debug("Equation string set for {}".format(label_string))
 
@@ -532,13 +861,9 @@ class LabberExporter:
         self.logger.debug("Applying step config for {}".format(label_string))
         ## Build up new step config entry from channel keys
         new_sc_entries = np.concatenate([self._channel_defs[channel_key] for channel_key in required_channel_keys])
-        ## Delete old step config entry and replace with new one
-        with h5py.File(self.MeasurementObject.sCfgFileIn, 'r+') as config_file:
-            try:
-                del config_file['Step config'][label_string]['Relation parameters']
-            except KeyError:
-                pass
-            config_file['Step config'][label_string].create_dataset('Relation parameters', data = new_sc_entries)
+        ## Replace old step config entry with new one
+        with self.reference_session() as session:
+            session.set_relation_params(label_string, new_sc_entries)
         ## status message
         self.logger.debug("Step config entries applied for {}".format(label_string))
 
@@ -570,6 +895,33 @@ class LabberExporter:
         for channel_name, channel_relation in self._channel_relations.items():
             self.apply_relation(channel_name, channel_relation)
 
+    def check_relations(self):
+        '''
+        Check that all stored channel relations are valid expressions which only refer to defined channel keys.
+
+        A ValueError is raised otherwise, listing the undefined keys for each relation.
+        '''
+        ## status message
+        self.logger.debug("Checking channel relations...")
+        undefined_keys = []
+        for channel_name, channel_relation in self._channel_relations.items():
+            compiled_relation = compile_relation(channel_relation[0])
+            required_keys = list(channel_relation[1]) + compiled_relation.get_undefined_variables(channel_relation[1])
+            missing_keys = [channel_key for channel_key in required_keys if channel_key not in self._raw_channel_defs]
+            if missing_keys:
+                undefined_keys.append("{} ({})".format(channel_name, ", ".join(missing_keys)))
+        if undefined_keys:
+            raise ValueError("Channel relations refer to undefined channel keys: {}".format("; ".join(undefined_keys)))
+        self.logger.debug("Channel relations checked.")
+
+    def evaluate_relation(self, channel_name, channel_values):
+        '''
+        Evaluate the stored relation for the given full channel name, for the given values of the channel keys (a dict of channel key: value).
+
+        Values can be scalars or NumPy arrays, so that eg the values of a related channel over a full sweep can be calculated and range-checked at once, without Labber.
+        '''
+        return compile_relation(self._channel_relations[channel_name][0]).evaluate(channel_values)
+
 
 
     # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -2,14 +2,49 @@
 
 from numbers import Number
 
+import numpy as np
+
+## Point spacings for iteration ranges
+ITERATION_SPACINGS = ["linear", "log"]
+
+def make_iteration_spec(iter_spec):
+    '''
+    Create an IterationSpec from a user iteration specification.
+
+    The specification can be a [start, stop, n_pts] list (optionally with the spacing, "linear" or "log", as a fourth element), a NumPy array of explicit values, a list of range lists (segments swept one after the other), or a dict of IterationSpec keys (see IterationSpec.set_iteration_spec).
+    '''
+    if isinstance(iter_spec, IterationSpec):
+        return iter_spec
+    if isinstance(iter_spec, dict):
+        return IterationSpec(iter_spec)
+    if isinstance(iter_spec, np.ndarray):
+        return IterationSpec({"values": iter_spec})
+    if len(iter_spec) > 0 and all(isinstance(segment, (list, tuple, dict)) for segment in iter_spec):
+        return IterationSpec({"segments": iter_spec})
+    spec_dict = {"start_value": iter_spec[0],
+                 "stop_value": iter_spec[1],
+                 "n_pts": iter_spec[2],
+                }
+    if len(iter_spec) > 3:
+        spec_dict["spacing"] = iter_spec[3]
+    return IterationSpec(spec_dict)
+
 class IterationSpec:
     '''
     Specify a parameter as an iteration.
+
+    The iteration can be a range of points (linearly or logarithmically spaced), an explicit list of values, or a list of range segments swept one after the other. In all cases, start_value, stop_value and n_pts hold the first and last values and the total number of points.
     '''
     def __init__(self, spec_dict):
         self.set_iteration_spec(spec_dict)
 
     def __repr__(self):
+        if self.values is not None:
+            return "".join(["<Iteration: ", str(self.n_pts), " values [", str(self.start_value), " --> ", str(self.stop_value), "]>"])
+        if self.segments is not None:
+            return "".join(["<Iteration: ", str(len(self.segments)), " segments ", str(self.segments), ">"])
+        if self.spacing != "linear":
+            return "".join(["<Iteration: [", str(self.start_value), " --> ", str(self.stop_value), ", ", str(self.n_pts), ", ", self.spacing, "]>"])
         return "".join(["<Iteration: [", str(self.start_value), " --> ", str(self.stop_value), ", ", str(self.n_pts), "]>"])
 
     def __add__(self, other):
@@ -21,6 +56,9 @@ class IterationSpec:
     def __radd__(self, other):
         return self.__add__(other)
 
+    def __float__(self):
+        return float(self.max_value)
+
     def __sub__(self, other):
         if isinstance(other, Number):
             return self.max_value - number
@@ -44,13 +82,82 @@ class IterationSpec:
 
     @property
     def max_value(self):
+        if self.values is not None or self.segments is not None:
+            return np.max(self.get_values()).item()
         return max(self.start_value, self.stop_value)
 
+    @property
+    def is_linear(self):
+        return self.values is None and self.segments is None and self.spacing == "linear"
+
 
     def set_iteration_spec(self, spec_dict):
         '''
         The keys used for the specifications are "parameter_name", "start_value", "stop_value", "n_pts", and an optional "pulse_number".
+
+        The optional "spacing" key sets the spacing of the points ("linear" by default, or "log"). Alternatively, the iteration can be specified through the "values" key (an array of explicit values), or the "segments" key (a list of range specifications, either as dicts or [start, stop, n_pts(, spacing)] lists).
+        '''
+        self.spacing = spec_dict.get("spacing", "linear")
+        self.values = None
+        self.segments = None
+        if "values" in spec_dict:
+            self.values = np.asarray(spec_dict["values"]).ravel()
+            if len(self.values) == 0:
+                raise ValueError("An iteration must have at least one value.")
+            self.start_value = self.values[0].item()
+            self.stop_value = self.values[-1].item()
+            self.n_pts = len(self.values)
+        elif "segments" in spec_dict:
+            self.segments = [make_iteration_spec(segment) for segment in spec_dict["segments"]]
+            if len(self.segments) == 0:
+                raise ValueError("An iteration must have at least one segment.")
+            if not all(segment.values is None and segment.segments is None for segment in self.segments):
+                raise ValueError("Iteration segments must be ranges.")
+            self.start_value = self.segments[0].start_value
+            self.stop_value = self.segments[-1].stop_value
+            self.n_pts = sum(segment.n_pts for segment in self.segments)
+        else:
+            self.start_value = spec_dict["start_value"]
+            self.stop_value = spec_dict["stop_value"]
+            self.n_pts = spec_dict["n_pts"]
+        ## Check spacing
+        if self.spacing not in ITERATION_SPACINGS:
+            raise ValueError("Invalid iteration spacing: {} (must be one of {})".format(self.spacing, ITERATION_SPACINGS))
+        if self.spacing == "log" and not self.start_value*self.stop_value > 0:
+            raise ValueError("Log-spaced iterations must have non-zero start and stop values of the same sign.")
+
+    def get_values(self):
+        '''
+        Get the values of the iteration (as set in Labber) as an array.
+        '''
+        if self.values is not None:
+            return np.array(self.values)
+        if self.segments is not None:
+            return np.concatenate([segment.get_values() for segment in self.segments])
+        if self.spacing == "log":
+            return np.geomspace(self.start_value, self.stop_value, self.n_pts)
+        return np.linspace(self.start_value, self.stop_value, self.n_pts)
+
+    def get_step_items(self):
+        '''
+        Get the Labber step items (range items of the step channel) which make up the iteration.
+
+        Each step item is a dict with the keys "range_type" ("single" or "start_stop"), "single", "start", "stop", "n_pts", and "interp" (the spacing).
+        '''
+        if self.values is not None:
+            return [{"range_type": "single", "single": value, "start": value, "stop": value, "n_pts": 1, "interp": "linear"} \
+                    for value in self.values.tolist()]
+        if self.segments is not None:
+            return [step_item for segment in self.segments for step_item in segment.get_step_items()]
+        return [{"range_type": "start_stop", "single": self.start_value, "start": self.start_value, "stop": self.stop_value, \
+                 "n_pts": self.n_pts, "interp": self.spacing}]
+
+    def get_spec_key(self):
+        '''
+        Get a hashable representation of the iteration, which is equal for equal iterations.
         '''
-        self.start_value = spec_dict["start_value"]
-        self.stop_value = spec_dict["stop_value"]
-        self.n_pts = spec_dict["n_pts"]
+        if self.values is not None:
+            return ("values", tuple(self.values.tolist()))
+        if self.segments is not None:
+            return ("segments", tuple(segment.get_spec_key() for segment in self.segments))
+        return ("range", self.start_value, self.stop_value, self.n_pts, self.spacing)
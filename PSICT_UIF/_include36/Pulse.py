@@ -3,27 +3,391 @@
 ##  the intention is for these to be handled differently by the input-output
 ##  pulse conversion algorithm
 
+from collections.abc import MutableMapping
+import numpy as np
+
 import PSICT_UIF._include36._Pulse_rc as _rc
 
+_PARAM_COLUMNS = _rc.PULSE_PARAM_COLUMNS  # parameter name (short or full) to pulse table column
+
+## Kinds of pulse table column
+OBJECT_COLUMN = 0  # arbitrary objects, with None for unset entries
+FLOAT_COLUMN = 1   # float64, with NaN for entries without a float value
+INT_COLUMN = 2     # int64, with the minimum int64 value for entries without an int value
+FLAG_COLUMN = 3    # int8 holding 0 (False) or 1 (True), with -1 for entries without a bool value
+_INT_NO_VALUE = np.iinfo(np.int64).min
+_INT_MAX = np.iinfo(np.int64).max
+_COLUMN_KINDS = {column: FLOAT_COLUMN if column in _rc.PULSE_TABLE_FLOAT_COLUMNS \
+                    else INT_COLUMN if column in _rc.PULSE_TABLE_INT_COLUMNS \
+                    else FLAG_COLUMN if column in _rc.PULSE_TABLE_BOOL_COLUMNS \
+                    else OBJECT_COLUMN \
+                 for column in _rc.PULSE_TABLE_COLUMNS}
+_KIND_DTYPES = {OBJECT_COLUMN: object, FLOAT_COLUMN: np.float64, INT_COLUMN: np.int64, FLAG_COLUMN: np.int8}
+_KIND_NO_VALUES = {OBJECT_COLUMN: None, FLOAT_COLUMN: np.nan, INT_COLUMN: _INT_NO_VALUE, FLAG_COLUMN: -1}
+_TYPED_COLUMNS = [column for column in _rc.PULSE_TABLE_COLUMNS if _COLUMN_KINDS[column] != OBJECT_COLUMN]
+## Value types which are stored directly in each kind of typed column (bool is deliberately not an int type here)
+_INT_TYPES = frozenset({int} | {np.dtype(code).type for code in np.typecodes["AllInteger"]})
+_FLOAT_TYPES = frozenset({float} | {np.dtype(code).type for code in np.typecodes["Float"]}) | _INT_TYPES
+_BOOL_TYPES = frozenset({bool, np.bool_})
+_KIND_TYPES = {FLOAT_COLUMN: _FLOAT_TYPES, INT_COLUMN: _INT_TYPES, FLAG_COLUMN: _BOOL_TYPES}
+## Column kinds in table column order, and the contents of an empty row
+_ROW_KINDS = tuple(_COLUMN_KINDS[column] for column in _rc.PULSE_TABLE_COLUMNS)
+_EMPTY_ROW = tuple(_KIND_NO_VALUES[kind] for kind in _ROW_KINDS)
+_ROW_FULL_NAMES = tuple(_rc.SHORT_NAMES_PULSES.get(column, column) for column in _rc.PULSE_TABLE_COLUMNS)
+## (column index, column kind) for each parameter name (short or full)
+_PARAM_INDICES = {param_name: (_rc.PULSE_TABLE_COLUMNS.index(column), _COLUMN_KINDS[column]) \
+                  for param_name, column in _PARAM_COLUMNS.items()}
+
+def _encode_value(kind, value):
+    '''
+    Get the entry of a column of the given kind which holds value, or None if the value must be held as an object instead.
+    '''
+    value_type = type(value)
+    if kind == FLOAT_COLUMN:
+        if value_type in _FLOAT_TYPES and value == value:
+            return float(value)
+    elif kind == INT_COLUMN:
+        if value_type in _INT_TYPES and _INT_NO_VALUE < value <= _INT_MAX:
+            return int(value)
+    elif value_type in _BOOL_TYPES:
+        return int(value)
+    return None
+
+class PulseTable:
+    '''
+    Compact storage for the parameters of many pulses.
+
+    The parameters are held in a NumPy structured array with one row per pulse and one column per parameter (see PULSE_TABLE_COLUMNS in the _Pulse_rc file). The numeric parameters have typed columns: float64 for the physical parameters and times, int64 for the pulse number, and int8 (0 or 1) for the bool flags. Entries of typed columns which do not hold a value of the column type are marked by NaN, the minimum int64 value, and -1 respectively; the parameter is then either unset, or its value is held as an object alongside the table (eg IterationSpec objects, or a NaN float). Only the non-numeric parameters (eg name, time_reference) have object columns, in which unset entries hold None.
+
+    Note that integer values of float parameters are stored (and read back) as floats, and bool flags are read back as Python bools.
+
+    Full parameter names (eg "Amplitude") share the column of the corresponding shortcode (eg "a"). Pulse objects act as views onto the rows of the table.
+    '''
+    def __init__(self, capacity = 16):
+        self.dtype = np.dtype([(column, _KIND_DTYPES[_COLUMN_KINDS[column]]) for column in _rc.PULSE_TABLE_COLUMNS])
+        self.n_rows = 0
+        self.objects = {column: {} for column in _TYPED_COLUMNS}  # row: value, for values held as objects
+        self._objects_by_index = [self.objects.get(column) for column in _rc.PULSE_TABLE_COLUMNS]
+        self.data = np.empty(0, dtype = self.dtype)
+        self._allocate(max(capacity, 1))
+
+    def __len__(self):
+        return self.n_rows
+
+    def _allocate(self, capacity):
+        ## np.zeros is much faster than np.empty for dtypes with object fields (which would otherwise be initialised one by one)
+        new_data = np.zeros(capacity, dtype = self.dtype)
+        new_data[:self.n_rows] = self.data[:self.n_rows]
+        new_data[self.n_rows:] = _EMPTY_ROW
+        self.data = new_data
+        ## Cache column views for fast single-element access
+        self.columns = {column: self.data[column] for column in self.dtype.names}
+        ## (column view, column kind, objects) for each parameter name (short or full)
+        self.params = {param_name: (self.columns[column], _COLUMN_KINDS[column], self.objects.get(column)) \
+                       for param_name, column in _PARAM_COLUMNS.items()}
+
+    def reserve(self, n_rows):
+        '''
+        Make room for at least n_rows more rows, so that the table does not have to grow while they are added.
+        '''
+        if self.n_rows + n_rows > len(self.data):
+            self._allocate(self.n_rows + n_rows)
+
+    def add_row(self, param_values = None):
+        '''
+        Add a row to the table (growing it if necessary), and return its index.
+
+        The row is empty, or holds the values given as a dict of {parameter name: value}.
+        '''
+        if self.n_rows == len(self.data):
+            self._allocate(2*len(self.data))
+        row = self.n_rows
+        if param_values:
+            self.data[row] = self._make_row(row, _EMPTY_ROW, param_values)
+        self.n_rows += 1
+        return row
+
+    # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+    ## Single entries and rows
+
+    def get_value(self, param_name, row):
+        '''
+        Get the value of the given parameter (by column, shortcode or full name) in the given row, or None if it is not set.
+
+        A KeyError is raised if param_name is not a valid pulse parameter.
+        '''
+        values, kind, objects = self.params[param_name]
+        ## item() returns a Python scalar, and is much faster than indexing for single elements
+        value = values.item(row)
+        if kind == FLOAT_COLUMN:
+            if value == value:
+                return value
+        elif kind == OBJECT_COLUMN:
+            return value
+        elif kind == INT_COLUMN:
+            if value != _INT_NO_VALUE:
+                return value
+        elif value >= 0:
+            return value == 1
+        return objects.get(row) if objects else None
+
+    def set_value(self, param_name, row, value):
+        '''
+        Set the value of the given parameter (by column, shortcode or full name) in the given row; setting None unsets it.
+
+        A KeyError is raised if param_name is not a valid pulse parameter.
+        '''
+        values, kind, objects = self.params[param_name]
+        if kind == OBJECT_COLUMN:
+            values[row] = value
+            return
+        if objects:
+            objects.pop(row, None)
+        entry = _encode_value(kind, value)
+        if entry is None:
+            values[row] = _KIND_NO_VALUES[kind]
+            if value is not None:
+                objects[row] = value
+        else:
+            values[row] = entry
+
+    def get_row(self, row, full_names = False):
+        '''
+        Get all set values in the given row, as a dict of {column: value} in table column order.
+
+        If full_names is set, the physical parameters are keyed by their full names rather than their shortcodes.
+        '''
+        row_values = {}
+        param_names = _ROW_FULL_NAMES if full_names else _rc.PULSE_TABLE_COLUMNS
+        for param_name, kind, objects, value in zip(param_names, _ROW_KINDS, self._objects_by_index, self.data.item(row)):
+            if kind == FLOAT_COLUMN:
+                if value == value:
+                    row_values[param_name] = value
+                    continue
+            elif kind == OBJECT_COLUMN:
+                if value is not None:
+                    row_values[param_name] = value
+                continue
+            elif kind == INT_COLUMN:
+                if value != _INT_NO_VALUE:
+                    row_values[param_name] = value
+                    continue
+            elif value >= 0:
+                row_values[param_name] = value == 1
+                continue
+            if objects and row in objects:
+                row_values[param_name] = objects[row]
+        return row_values
+
+    def update_row(self, row, param_values):
+        '''
+        Set the values in the given row from a dict of {parameter name: value}, writing the whole row at once; None values unset their parameters.
+
+        A KeyError is raised (and the row is left unchanged) if any of the parameter names is invalid.
+        '''
+        self.data[row] = self._make_row(row, self.data.item(row), param_values)
+
+    def _make_row(self, row, row_entries, param_values):
+        ## Get the entries of the row with param_values set; values held as objects are only stored once all names have been checked
+        row_entries = list(row_entries)
+        objects_by_index = self._objects_by_index
+        object_values = {}  # column index: value held as object (or None to remove it), for typed columns
+        for param_name, value in param_values.items():
+            try:
+                index, kind = _PARAM_INDICES[param_name]
+            except KeyError:
+                raise KeyError(" ".join(["Key", str(param_name), "is not defined as a valid pulse parameter."]))
+            if kind == OBJECT_COLUMN:
+                row_entries[index] = value
+                continue
+            if kind == FLOAT_COLUMN and type(value) is float and value == value:
+                row_entries[index] = value
+            else:
+                entry = _encode_value(kind, value)
+                if entry is None:
+                    row_entries[index] = _EMPTY_ROW[index]
+                    object_values[index] = value
+                    continue
+                row_entries[index] = entry
+            ## Drop any value previously held as object
+            if row in objects_by_index[index]:
+                object_values[index] = None
+        for index, value in object_values.items():
+            if value is None:
+                objects_by_index[index].pop(row, None)
+            else:
+                objects_by_index[index][row] = value
+        return tuple(row_entries)
+
+    # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+    ## Whole columns
+
+    def _get_object_rows(self, column, rows):
+        ## Indices into rows of the entries held as objects
+        objects = self.objects[column]
+        if not objects:
+            return np.empty(0, dtype = np.intp)
+        return np.flatnonzero(np.isin(rows, np.fromiter(objects, dtype = np.intp, count = len(objects))))
+
+    def _get_value_mask(self, column, rows):
+        ## Whether each entry holds a value of the column type
+        kind = _COLUMN_KINDS[column]
+        entries = self.columns[column][rows]
+        if kind == FLOAT_COLUMN:
+            return entries == entries
+        if kind == INT_COLUMN:
+            return entries != _INT_NO_VALUE
+        return entries >= 0
+
+    def get_set_mask(self, column, rows):
+        '''
+        Get a bool array of whether the given column is set in each of the given rows.
+        '''
+        if _COLUMN_KINDS[column] == OBJECT_COLUMN:
+            return np.not_equal(self.columns[column][rows], None)
+        set_mask = self._get_value_mask(column, rows)
+        set_mask[self._get_object_rows(column, rows)] = True
+        return set_mask
+
+    def get_values(self, column, rows):
+        '''
+        Get the values in the given column for the given rows, as an object array with None for unset entries.
+        '''
+        kind = _COLUMN_KINDS[column]
+        if kind == OBJECT_COLUMN:
+            return self.columns[column][rows]
+        entries = self.columns[column][rows]
+        values = np.empty(len(rows), dtype = object)
+        values[:] = (entries == 1).tolist() if kind == FLAG_COLUMN else entries.tolist()
+        values[~self._get_value_mask(column, rows)] = None
+        objects = self.objects[column]
+        for index in self._get_object_rows(column, rows):
+            values[index] = objects[rows[index]]
+        return values
+
+    def get_array(self, column, rows):
+        '''
+        Get the values in the given column for the given rows, as a float array.
+
+        Values held as objects (eg IterationSpec objects) are converted with float(). A KeyError is raised if any of the entries is unset.
+        '''
+        kind = _COLUMN_KINDS[column]
+        if kind == OBJECT_COLUMN:
+            values = self.columns[column][rows]
+            if any(value is None for value in values):
+                raise KeyError(column)
+            return values.astype(float)
+        array = self.columns[column][rows].astype(float)
+        value_mask = self._get_value_mask(column, rows)
+        object_rows = self._get_object_rows(column, rows)
+        if np.count_nonzero(value_mask) + len(object_rows) < len(rows):
+            raise KeyError(column)
+        objects = self.objects[column]
+        for index in object_rows:
+            array[index] = float(objects[rows[index]])
+        return array
+
+    def set_values(self, column, rows, values):
+        '''
+        Set the values in the given column for the given rows (values should be a list of the same length).
+        '''
+        kind = _COLUMN_KINDS[column]
+        if kind == OBJECT_COLUMN:
+            self.columns[column][rows] = values
+            return
+        objects = self.objects[column]
+        column_types = _KIND_TYPES[kind]
+        if kind != FLOAT_COLUMN and all(type(value) in column_types for value in values):
+            self.columns[column][rows] = values
+            if objects:
+                for row in rows.tolist():
+                    objects.pop(row, None)
+        elif kind == FLOAT_COLUMN and all(type(value) in column_types and value == value for value in values):
+            self.columns[column][rows] = values
+            if objects:
+                for row in rows.tolist():
+                    objects.pop(row, None)
+        else:
+            for row, value in zip(rows.tolist(), values):
+                self.set_value(column, row, value)
+
+
+class PulseAttributes(MutableMapping):
+    '''
+    Dict-like view of the parameters of a single pulse, including only the parameters which have been set.
+
+    Physical parameters appear under their shortcodes, or under their full names once the pulse has been set to use full names (see Pulse.set_full_names).
+    '''
+    __slots__ = ['_pulse']
+
+    def __init__(self, pulse):
+        self._pulse = pulse
+
+    def __getitem__(self, key):
+        return self._pulse[key]
+
+    def __setitem__(self, key, value):
+        self._pulse[key] = value
+
+    def __delitem__(self, key):
+        del self._pulse[key]
+
+    def __contains__(self, key):
+        pulse = self._pulse
+        try:
+            return pulse._table.get_value(key, pulse._row) is not None
+        except KeyError:
+            return False
+
+    def _get_dict(self):
+        ## All set parameters, read from the table row at once
+        return self._pulse.get_attributes_dict()
+
+    def __iter__(self):
+        return iter(self._get_dict())
+
+    def __len__(self):
+        return len(self._get_dict())
+
+    def keys(self):
+        return self._get_dict().keys()
+
+    def items(self):
+        return self._get_dict().items()
+
+    def values(self):
+        return self._get_dict().values()
+
+    def __repr__(self):
+        return repr(self._get_dict())
+
+
 class Pulse:
     '''
     Abstract representation of an individual pulse in the pulse sequence.
 
+    The pulse parameters are stored in a row of a PulseTable; if no table is given, the pulse gets a table of its own.
+
     This class should not in general be used directly, but instead managed through PulseSeq objects (which act as containers for the pulse sequence as a whole)
     '''
-    def __init__(self, spec, *, parent_logger_name = None):
-        self.attributes = {}
-        self.valid_abs_time = False
+    __slots__ = ['_table', '_row', '_full_names', '__valid_abs_time']
+
+    def __init__(self, spec, *, table = None, parent_logger_name = None):
+        if table is None:
+            table = PulseTable(capacity = 1)
         if isinstance(spec, dict):  # create from dict of parameters
             # if verbose >= 4:
             #     print("Creating Pulse object from parameter dict...")
-            self.set_attributes(spec)
+            self._row = table.add_row(spec)
         elif isinstance(spec, str): # create from string as name
             # if verbose >= 4:
             #     print("Creating pulse object by name:", spec)
-            self.name = spec
+            self._row = table.add_row({"name": spec})
         else:
             raise TypeError("Invalid specification for Pulse creation:", spec)
+        self._table = table
+        self._full_names = False
+        self.valid_abs_time = False
 
     def __repr__(self):
         return "".join(["<Pulse \"", self.name, "\">"])
@@ -32,13 +396,21 @@ class Pulse:
     ###########################################################################
     ## Properties and attributes
 
+    ## Dict-like view of all set parameters
+    @property
+    def attributes(self):
+        return PulseAttributes(self)
+
     ## Pulse name
     @property
     def name(self):
-        return self.attributes["name"]
+        name = self._table.columns["name"][self._row]
+        if name is None:
+            raise KeyError("name")
+        return name
     @name.setter
     def name(self, name):
-        self.attributes["name"] = name
+        self["name"] = name
 
     ## Valid absolute_time spec flag
     @property
@@ -48,38 +420,49 @@ class Pulse:
     def valid_abs_time(self, new_value):
         self.__valid_abs_time = bool(new_value)
 
+    def set_full_names(self, full_names = True):
+        '''
+        Set whether the physical parameters are listed under their full names (rather than their shortcodes) in the attributes view.
+
+        Both names can always be used to access the parameters.
+        '''
+        self._full_names = bool(full_names)
+
     ## Get start and end times as attributes (will only work if appropriate params are set already)
     @property
     def start_time(self):
         assert self.valid_abs_time
-        return self.attributes["absolute_time"]
+        return self["absolute_time"]
     @property
     def end_time(self):
-        try:
-            assert "Width" in self.attributes
-            assert "Plateau" in self.attributes
-        except AssertionError:
-            try:
-                assert "w" in self.attributes
-                assert "v" in self.attributes
-            except AsserionError as AssE:
-                raise AssE
-            else:
-                return self.start_time + self['w'] + self['v']
-        else:
-            return self.start_time + self["Width"] + self["Plateau"]
+        return self.start_time + self["w"] + self["v"]
+
+    def _get_column_value(self, column):
+        return self._table.get_value(column, self._row)
+
+    def get_attributes_dict(self):
+        '''
+        Get all set parameters as a (new) dict, under their shortcodes or full names as in the attributes view.
+        '''
+        return self._table.get_row(self._row, full_names = self._full_names)
 
     def __getitem__(self, key):
-        return self.attributes[key]
+        ## Raises KeyError for invalid parameter names
+        value = self._table.get_value(key, self._row)
+        if value is None:
+            raise KeyError(key)
+        return value
 
     def __setitem__(self, key, value):
-        if key in _rc.PULSE_PARAMS:
-            self.attributes[key] = value
-        else:
+        try:
+            self._table.set_value(key, self._row, value)
+        except KeyError:
             raise KeyError(" ".join(["Key", key, "is not defined as a valid pulse parameter."]))
 
     def __delitem__(self, key):
-        del self.attributes[key]
+        ## Raises KeyError if not set
+        self[key]
+        self._table.set_value(key, self._row, None)
 
     def print_info(self):
         '''
@@ -95,10 +478,76 @@ class Pulse:
         '''
         Set attributes from an input dictionary input_attributes.
         '''
-        for key, value in input_attributes.items():
-            self[key] = value
+        ## Write all values to the table row at once (raises KeyError for invalid parameter names)
+        self._table.update_row(self._row, input_attributes)
             # if verbose >= 3:
             #     try:
             #         print("Pulse ", self.name, ": attribute ", key, " set to value ", value, sep = "")
             #     except KeyError:
             #         print("<unnamed pulse>: attribute", key, "set to value", value)
+
+
+###############################################################################
+## Vectorized parameter access
+
+def _get_shared_rows(pulses):
+    '''
+    Get the table and row indices of the pulses if they are all stored in the same PulseTable, or (None, None) otherwise.
+    '''
+    if len(pulses) == 0:
+        return None, None
+    table = pulses[0]._table
+    if not all(pulse._table is table for pulse in pulses):
+        return None, None
+    return table, np.fromiter((pulse._row for pulse in pulses), dtype = np.intp, count = len(pulses))
+
+def get_param_values(pulses, param_name):
+    '''
+    Get the values of the given parameter for a list of pulses as an object array, with None for pulses which do not have the parameter set.
+    '''
+    column = _PARAM_COLUMNS[param_name]
+    table, rows = _get_shared_rows(pulses)
+    if table is not None:
+        return table.get_values(column, rows)
+    values = np.empty(len(pulses), dtype = object)
+    values[:] = [pulse._get_column_value(column) for pulse in pulses]
+    return values
+
+def get_param_set_mask(pulses, param_name):
+    '''
+    Get a bool array of whether the given parameter is set for each of a list of pulses.
+    '''
+    column = _PARAM_COLUMNS[param_name]
+    table, rows = _get_shared_rows(pulses)
+    if table is not None:
+        return table.get_set_mask(column, rows)
+    return np.array([pulse._get_column_value(column) is not None for pulse in pulses], dtype = bool)
+
+def get_param_array(pulses, param_name):
+    '''
+    Get the values of the given parameter for a list of pulses as a float array.
+
+    Iteration parameters (IterationSpec objects) are converted to their max_value, as in arithmetic on individual values. A KeyError is raised if any of the pulses does not have the parameter set.
+    '''
+    column = _PARAM_COLUMNS[param_name]
+    table, rows = _get_shared_rows(pulses)
+    if table is not None:
+        try:
+            return table.get_array(column, rows)
+        except KeyError:
+            raise KeyError(param_name)
+    values = get_param_values(pulses, param_name)
+    if any(value is None for value in values):
+        raise KeyError(param_name)
+    return values.astype(float)
+
+def set_param_values(pulses, param_name, values):
+    '''
+    Set the values of the given parameter for a list of pulses (values should be a list of the same length).
+    '''
+    table, rows = _get_shared_rows(pulses)
+    if table is not None:
+        table.set_values(_PARAM_COLUMNS[param_name], rows, values)
+    else:
+        for pulse, value in zip(pulses, values):
+            pulse[param_name] = value
@@ -5,7 +5,8 @@
 import logging
 
 from PSICT_UIF._include36.PulseSequence import InputPulseSeq, OutputPulseSeq
-from PSICT_UIF._include36.ParameterSpec import IterationSpec
+from PSICT_UIF._include36.ParameterSpec import IterationSpec, make_iteration_spec
+import PSICT_UIF._include36._Pulse_rc as _Pulse_rc
 import PSICT_UIF._include36._LogLevels as LogLevels
 
 class PulseSeqManager:
@@ -24,9 +25,18 @@ class PulseSeqManager:
         ## init input and output pulse sequence containers
         self.inputPulseSeq = InputPulseSeq(parent_logger_name = logger_name)
         self.outputPulseSeq = OutputPulseSeq(parent_logger_name = logger_name)
+        ## script rcmodule (passed on to rebuilt pulse sequences)
+        self._script_rc = None
+        self._script_rcpath = None
+        ## raw input specifications, as set by the user and at the last conversion
+        self._input_specs = {}
+        self._converted_specs = None
         ## flags
         self.is_input_seq_populated = False
         self.is_output_seq_populated = False
+        self._is_input_seq_stale = False # inputPulseSeq does not match the input specifications, or has been used in a conversion
+        ## settings
+        self.vectorized_conversion = False # convert_seq uses the vectorized (array-based) conversion if set
         ## debug message
         self.logger.log(LogLevels.TRACE, 'Instance initialized.')
 
@@ -58,27 +68,53 @@ class PulseSeqManager:
         '''
         Set the input pulse sequence from a dict of user specifications.
 
-        This is passed directly to the InputPulseSeq.
+        A copy of the specifications is stored, and the InputPulseSeq is (re-)built from it at the next full conversion. The input sequence can be set again after a conversion; if only parameters which do not affect the pulse timing have changed, the next conversion is carried out incrementally (see convert_seq).
+
+        The parameter names of all pulses (and of the global inverted-pulse parameters) are checked here, as an incremental conversion does not rebuild the pulses; a KeyError is raised for any invalid name, and the stored specifications are left unchanged.
         '''
         self.logger.debug("Adding parameter specifications for SQPG...")
-        self.inputPulseSeq.set_pulse_seq(pulse_seq_dict)
-        ## set flag
+        for spec_name, spec_params in pulse_seq_dict.items():
+            if spec_name != "main":
+                _check_spec_params(spec_name, spec_params)
+        self._input_specs = _copy_specs(pulse_seq_dict)
+        ## set flags
+        self._is_input_seq_stale = True
         self.is_input_seq_populated = True
 
     def set_iteration_spec(self, iteration_spec_dict):
         '''
         Set iteration specifications, potentially overriding point values.
+
+        A KeyError is raised if any of the pulses does not exist, or any of the parameter names is invalid; in this case, none of the iteration specifications are set.
         '''
         self.logger.debug("Setting iteration specifications for SQPG...")
+        for pulse_name, iter_params in iteration_spec_dict.items():
+            if pulse_name not in self._input_specs or pulse_name in ["main", "inverted"]:
+                raise KeyError("No pulse with name {} exists.".format(pulse_name))
+            _check_spec_params(pulse_name, iter_params)
         for pulse_name, iter_params in iteration_spec_dict.items():
             for param_name, param_spec in iter_params.items():
                 ## Convert to IterationSpec object
-                iter_obj = IterationSpec({"start_value": param_spec[0],
-                                          "stop_value": param_spec[1],
-                                          "n_pts": param_spec[2],
-                                        })
+                iter_obj = make_iteration_spec(param_spec)
                 ## Set parameter using IterationSpec object
-                self.inputPulseSeq.set_pulse_parameter(pulse_name, param_name, iter_obj)
+                self._input_specs[pulse_name][param_name] = iter_obj
+                self.logger.debug("Set pulse {} parameter {} to {}".format(pulse_name, param_name, iter_obj))
+        self._is_input_seq_stale = True
+
+    def build_input_pulse_seq(self):
+        '''
+        (Re-)build the InputPulseSeq from the stored input specifications, keeping any channel definitions and relations already set.
+        '''
+        self.logger.log(LogLevels.TRACE, "Building input pulse sequence...")
+        channel_defs = self.inputPulseSeq.get_channel_defs()
+        channel_relations = self.inputPulseSeq.get_channel_relations()
+        self.inputPulseSeq = InputPulseSeq(parent_logger_name = self.logger.name)
+        self.inputPulseSeq.assign_script_rcmodule(self._script_rc, self._script_rcpath)
+        self.inputPulseSeq.add_channel_defs(channel_defs)
+        self.inputPulseSeq.add_channel_relations(channel_relations)
+        ## The InputPulseSeq takes ownership of (and modifies) the dicts passed to it
+        self.inputPulseSeq.set_pulse_seq(_copy_specs(self._input_specs))
+        self._is_input_seq_stale = False
 
 
     # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -113,17 +149,43 @@ class PulseSeqManager:
     # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
     ## Conversion methods
 
-    def convert_seq(self):
+    def convert_seq(self, *, vectorized = None, incremental = True):
         '''
         Convert the input sequence (specified by the user) into an output sequence (suitable for input into Labber).
 
         Note that the input sequence must have already been imported using the set_input_pulse_seq method.
+
+        If the sequence has been converted before and incremental is set, the input specifications are compared against those at the last conversion. If only parameters which do not affect the timing or ordering of the pulses have changed (ie not those in TIMING_PARAMS in the _Pulse_rc file), and the main and inverted-pulse parameters are unchanged, the changes are patched directly into the existing output sequence; if nothing has changed (eg when the sequence was already converted for get_sweep_grid), the existing output sequence is reused as it is. Otherwise, the full conversion is carried out.
+
+        If vectorized is set, the sort and the timing calculations of the conversion are carried out on arrays of the pulse parameters; the results are the same as for the pulse-by-pulse conversion. If vectorized is None, the vectorized_conversion attribute is used.
         '''
+        if vectorized is None:
+            vectorized = self.vectorized_conversion
         ## debug message
         self.logger.debug("Converting input sequence to output sequence...")
         ## Assert input sequence is populated
         if not self.is_input_seq_populated:
             raise RuntimeError("Input sequence is not populated!")
+        ## Patch existing output sequence if possible
+        if incremental and self.is_output_seq_populated:
+            param_changes = self.get_param_changes()
+            if param_changes == []:
+                self.logger.debug("Input sequence unchanged since the last conversion; reusing output sequence.")
+            elif param_changes is not None:
+                self.logger.debug("Patching {} parameter change(s) into output sequence...".format(len(param_changes)))
+                self.patch_output_seq(param_changes)
+            if param_changes is not None:
+                self._converted_specs = _copy_specs(self._input_specs)
+                self.transfer_channel_relations()
+                self.logger.debug("Incremental conversion to output sequence completed.")
+                return
+        ## Start from a fresh input sequence if it has changed or has already been converted, and a fresh output sequence
+        if self._is_input_seq_stale:
+            self.build_input_pulse_seq()
+        if self.is_output_seq_populated:
+            self.outputPulseSeq = OutputPulseSeq(parent_logger_name = self.logger.name)
+            self.outputPulseSeq.assign_script_rcmodule(self._script_rc, self._script_rcpath)
+            self.is_output_seq_populated = False
         #### Pulse sequence conversion
         ## Transfer main parameters
         self.logger.debug("Transferring main parameters...")
@@ -131,18 +193,95 @@ class PulseSeqManager:
         ## Get list of pulses from inputPulseSeq (sorted by absolute_time)
         ##  and set the outputPulseSeq to this list
         self.logger.debug("Sorting pulses...")
-        sorted_pulses = self.inputPulseSeq.get_sorted_list()
-        self.outputPulseSeq.set_pulse_seq(sorted_pulses)
+        sorted_pulses = self.inputPulseSeq.get_sorted_list(vectorized = vectorized)
+        self.outputPulseSeq.set_pulse_seq(sorted_pulses, vectorized = vectorized)
         ## Transfer channel relations data
-        self.logger.debug("Transferring channel relations data...")
-        self.outputPulseSeq.add_channel_defs(self.inputPulseSeq.get_channel_defs())
-        self.outputPulseSeq.add_channel_relations(self.inputPulseSeq.get_channel_relations())
+        self.transfer_channel_relations()
         ####
-        ## Set flag
+        ## Set flags; the pulses are shared with (and have been modified by) the output sequence
         self.is_output_seq_populated = True
+        self._is_input_seq_stale = True
+        self._converted_specs = _copy_specs(self._input_specs)
         ## debug message
         self.logger.debug("Conversion to output sequence completed.")
 
+    def transfer_channel_relations(self):
+        '''
+        Transfer the channel definitions and relations from the input sequence to the output sequence.
+        '''
+        self.logger.debug("Transferring channel relations data...")
+        self.outputPulseSeq.add_channel_defs(self.inputPulseSeq.get_channel_defs())
+        self.outputPulseSeq.add_channel_relations(self.inputPulseSeq.get_channel_relations())
+
+    def get_param_changes(self):
+        '''
+        Get the pulse parameter changes in the input specifications since the last conversion, as a list of (pulse name, parameter, new value) tuples.
+
+        Parameters are given by their shortcodes, and a new value of None denotes a parameter which is no longer set. None is returned if the changes cannot be patched into the output sequence (see convert_seq).
+        '''
+        if self._converted_specs is None:
+            return None
+        if list(self._converted_specs.keys()) != list(self._input_specs.keys()):
+            self.logger.log(LogLevels.TRACE, "Pulses have been added, removed, or reordered.")
+            return None
+        param_changes = []
+        for spec_name, new_params in self._input_specs.items():
+            old_params = self._converted_specs[spec_name]
+            if old_params == new_params:
+                continue
+            if spec_name in ["main", "inverted"]:
+                if _get_spec_key(old_params) != _get_spec_key(new_params):
+                    self.logger.log(LogLevels.TRACE, "Parameters for {} have changed.".format(spec_name))
+                    return None
+                continue
+            old_columns = _get_spec_columns(old_params)
+            new_columns = _get_spec_columns(new_params)
+            if old_columns is None or new_columns is None:
+                return None
+            for param_name in set(old_columns) | set(new_columns):
+                old_value = old_columns.get(param_name)
+                new_value = new_columns.get(param_name)
+                if _get_spec_key(old_value) == _get_spec_key(new_value):
+                    continue
+                if param_name in _Pulse_rc.TIMING_PARAMS:
+                    self.logger.log(LogLevels.TRACE, "Timing parameter {} of pulse {} has changed.".format(param_name, spec_name))
+                    return None
+                param_changes.append((spec_name, param_name, new_value))
+        return param_changes
+
+    def patch_output_seq(self, param_changes):
+        '''
+        Apply the given parameter changes (see get_param_changes) to the existing output sequence.
+
+        The changed values undergo the same pre-conversion as in the full conversion: parameters no longer set are reset to their defaults, parameters set globally for inverted pulses are kept, and the script-rcfile pre-calculation conversions are applied.
+        '''
+        inverted_params = _get_spec_columns(self._input_specs.get("inverted", {}))
+        try:
+            pulse_converters = self._script_rc.parameter_pre_process["SQPG"]["pulse"]
+        except (AttributeError, KeyError):
+            pulse_converters = {}
+        pulse_converters = {_Pulse_rc.PULSE_PARAM_COLUMNS[param_name]: param_converter \
+                            for param_name, param_converter in pulse_converters.items() \
+                            if isinstance(param_converter, dict)}
+        try:
+            for pulse_name, param_name, param_value in param_changes:
+                pulse = self.outputPulseSeq[pulse_name]
+                if pulse["is_inverted"] and param_name in inverted_params:
+                    continue
+                if param_value is None:
+                    if param_name not in _Pulse_rc.PULSE_PARAM_DEFAULTS:
+                        del pulse[param_name]
+                        continue
+                    param_value = _Pulse_rc.PULSE_PARAM_DEFAULTS[param_name]
+                if param_name in pulse_converters:
+                    param_value = pulse_converters[param_name][param_value]
+                pulse[param_name] = param_value
+                self.logger.log(LogLevels.TRACE, "Patched pulse {} parameter {} to {}".format(pulse_name, param_name, param_value))
+        except:
+            ## The output sequence is only partially patched; the next conversion must be a full one
+            self.is_output_seq_populated = False
+            raise
+
     # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
     ## Output sequence export
 
@@ -181,3 +320,40 @@ class PulseSeqManager:
         self.logger.debug("Converting pulse names to numbers in iteration order...")
         new_iter_order = []
         return new_iter_order
+
+
+###############################################################################
+## Input specification comparison
+
+def _copy_specs(pulse_seq_dict):
+    '''
+    Copy a dict of pulse sequence specifications, down to the parameter dicts of each pulse (parameter values are not copied).
+    '''
+    return {spec_name: dict(spec_params) for spec_name, spec_params in pulse_seq_dict.items()}
+
+def _check_spec_params(spec_name, spec_params):
+    '''
+    Check that all parameter names of a single pulse specification are valid pulse parameters (shortcodes or full names), raising a KeyError otherwise.
+    '''
+    for param_name in spec_params:
+        if param_name not in _Pulse_rc.PULSE_PARAM_COLUMNS:
+            raise KeyError("Key {} (pulse {}) is not defined as a valid pulse parameter.".format(param_name, spec_name))
+
+def _get_spec_columns(spec_params):
+    '''
+    Get the parameters of a single pulse specification keyed by their shortcodes, or None if any of the parameter names is invalid.
+    '''
+    try:
+        return {_Pulse_rc.PULSE_PARAM_COLUMNS[param_name]: param_value for param_name, param_value in spec_params.items()}
+    except KeyError:
+        return None
+
+def _get_spec_key(value):
+    '''
+    Get a comparable representation of a specification value, such that equal IterationSpec objects compare equal.
+    '''
+    if isinstance(value, IterationSpec):
+        return ("IterationSpec",) + value.get_spec_key()
+    if isinstance(value, dict):
+        return {key: _get_spec_key(item) for key, item in value.items()}
+    return value
@@ -3,10 +3,11 @@
 ##  and output (used to set Labber parameters).
 
 from operator import attrgetter
+import numpy as np
 import warnings
 import logging
 
-from PSICT_UIF._include36.Pulse import Pulse
+from PSICT_UIF._include36.Pulse import Pulse, PulseTable, get_param_values, get_param_set_mask, get_param_array, set_param_values
 import PSICT_UIF._include36._Pulse_rc as _rc
 import PSICT_UIF._include36._LogLevels as LogLevels
 from PSICT_UIF._include36._Common import extract_relation_variables
@@ -25,6 +26,7 @@ class PulseSeq:
             logger_name = 'PulseSeq'
         self.logger = logging.getLogger(logger_name)
         ## initialise containers
+        self.pulse_table = PulseTable() # holds parameters of pulses created by this sequence
         self.pulse_list = []  # holds Pulse objects
         self.main_params = {} # holds parameters that are set for the whole sequence
         self.channel_defs = {}
@@ -63,6 +65,37 @@ class PulseSeq:
     @pulse_list.setter
     def pulse_list(self, new_list):
         self.__pulse_list = new_list
+        self.rebuild_indexes()
+
+    def rebuild_indexes(self):
+        '''
+        Rebuild the name and pulse number indexes from the pulse list.
+        '''
+        self._pulses_by_name = {pulse.name: pulse for pulse in self.pulse_list}
+        self.rebuild_number_index()
+
+    def rebuild_number_index(self):
+        '''
+        Rebuild the pulse number index from the pulse list.
+
+        This must be called whenever pulse numbers are changed after the pulses have been added to the sequence. If several pulses share a pulse number, the first one in the list is indexed.
+        '''
+        self._pulses_by_number = {}
+        ## Read the pulse numbers of all pulses at once
+        for pulse, pulse_number in zip(self.pulse_list, get_param_values(self.pulse_list, "pulse_number")):
+            if pulse_number is not None:
+                self._pulses_by_number.setdefault(pulse_number, pulse)
+
+    def get_pulse_by_number(self, pulse_number):
+        '''
+        Get the pulse with the given pulse number.
+
+        A KeyError is raised if there is no such pulse.
+        '''
+        try:
+            return self._pulses_by_number[pulse_number]
+        except KeyError:
+            raise KeyError("No pulse with pulse number {} exists.".format(pulse_number))
 
     ## Print list of pure pulse names when accessing pulse_names as attribute
     @property
@@ -76,17 +109,19 @@ class PulseSeq:
     def __getitem__(self, id):
         ## if id is string, attempt to get by name
         if isinstance(id, str):
-            id = self.pulse_names.index(id)
+            try:
+                return self._pulses_by_name[id]
+            except KeyError:
+                raise KeyError("No pulse with name {} exists.".format(id))
         ## else pass (hopefully valid index) directly
         else:
-            pass
-        return self.pulse_list[id]
+            return self.pulse_list[id]
 
     def add_pulse(self, new_pulse):
         '''
         Add a single pulse to the pulse sequence.
 
-        The passed-in pulse specification new_pulse can either be an existing Pulse object, or a dict of parameters with which the new pulse should be created. (A ValueError will be raised if it is neither of the two)
+        The passed-in pulse specification new_pulse can either be an existing Pulse object, or a dict of parameters with which the new pulse should be created (in the sequence's pulse table). (A ValueError will be raised if it is neither of the two)
 
         Note that the pulse name must be unique (relative to the other pulse names already stored in the sequence); a KeyError will be raised if a pulse with the same name already exists.
         '''
@@ -96,14 +131,19 @@ class PulseSeq:
             pass
         elif isinstance(new_pulse, dict):
             self.logger.log(LogLevels.TRACE, "Creating a new pulse by attribute list")
-            new_pulse = Pulse(new_pulse)
+            new_pulse = Pulse(new_pulse, table = self.pulse_table)
         else:
             raise ValueError(" ".join(["Cannot interpret", new_pulse, "as pulse identifier"]))
         ## Check if pulse with matching name already exists
-        if new_pulse.name in self.pulse_names:
+        if new_pulse.name in self._pulses_by_name:
             raise KeyError(" ".join(["Pulse with name", new_pulse.name, "already exists."]))
         ## Actually add pulse to list
         self.pulse_list.append(new_pulse)
+        ## Update indexes
+        self._pulses_by_name[new_pulse.name] = new_pulse
+        pulse_number = new_pulse.attributes.get("pulse_number")
+        if pulse_number is not None:
+            self._pulses_by_number.setdefault(pulse_number, new_pulse)
 
     ###########################################################################
     ## Information & verification
@@ -152,6 +192,8 @@ class InputPulseSeq(PulseSeq):
         else:
             logger_name = 'InputPulseSeq'
         self.logger = logging.getLogger(logger_name)
+        ## No global inverted-pulse parameters unless set in the input dict
+        self.inverted_params = {}
         ## Status message
         self.logger.log(LogLevels.TRACE, 'Instance initialized.')
 
@@ -192,6 +234,8 @@ class InputPulseSeq(PulseSeq):
         '''
         ## Status message
         self.logger.debug("Setting input pulse sequence parameters...")
+        ## Make room for all pulses in the pulse table at once
+        self.pulse_table.reserve(len(params_dict))
         ## Set pulse sequence from input dict
         for pulse_name, pulse_params in params_dict.items():
             if pulse_name == "main":        # check for main specification
@@ -209,6 +253,8 @@ class InputPulseSeq(PulseSeq):
                 self.add_pulse(pulse_params)
                 ## debug message
                 self.logger.log(LogLevels.TRACE, "Added pulse {} successfully.".format(pulse_name))
+        ## Pulse numbers may have been set through existing Pulse objects
+        self.rebuild_number_index()
         ## debug message
         self.logger.debug("Input pulse sequence parameters set.")
 
@@ -220,6 +266,8 @@ class InputPulseSeq(PulseSeq):
         Note that the pulse can, as usual, be specified by either name or index.
         '''
         self[pulse_id][param_name] = param_value
+        if param_name == "pulse_number":
+            self.rebuild_number_index()
         self.logger.debug("Set pulse {} parameter {} to {}".format(str(pulse_id), param_name, param_value))
 
 
@@ -276,11 +324,13 @@ class InputPulseSeq(PulseSeq):
     # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
     ## Pulse sequence sorting
 
-    def pulse_pre_conversion(self):
+    def pulse_pre_conversion(self, *, vectorized = False):
         '''
         Carry out all required pre-conversion operations on the pulse parameters.
 
         Most notably, this involves parameter value adjustment (eg converting to ns), as well as working out the timing/ordering of the entire pulse sequence.
+
+        If vectorized is set, the parameter defaults, inverted-pulse parameters, and pre-calculation conversions are applied to whole columns of the pulse parameters at once.
         '''
         ## Status message
         self.logger.debug("Carrying out pulse sequence pre-conversion...")
@@ -292,6 +342,10 @@ class InputPulseSeq(PulseSeq):
         self.logger.debug("Setting required pulse parameter defaults...")
         ## Set required pulse parameter defaults
         for _default_param, _default_value in _rc.PULSE_PARAM_DEFAULTS.items():
+            if vectorized:
+                unset_pulses = [pulse for pulse, is_set in zip(self.pulse_list, get_param_set_mask(self.pulse_list, _default_param)) if not is_set]
+                set_param_values(unset_pulses, _default_param, [_default_value]*len(unset_pulses))
+                continue
             for pulse in self.pulse_list:
                 if not _default_param in pulse.attributes:
                     pulse[_default_param] = _default_value
@@ -303,9 +357,14 @@ class InputPulseSeq(PulseSeq):
 
         self.logger.debug("Applying global inverted-pulse parameters... (pre-absolute_time calculation)")
         ## For each pulse that is_inverted, apply the global parameters
-        for pulse in self.pulse_list:
-            if pulse["is_inverted"]:
-                pulse.set_attributes(self.inverted_params)
+        if vectorized:
+            inverted_pulses = [pulse for pulse, is_inverted in zip(self.pulse_list, get_param_values(self.pulse_list, "is_inverted")) if is_inverted]
+            for inverted_param, inverted_value in self.inverted_params.items():
+                set_param_values(inverted_pulses, inverted_param, [inverted_value]*len(inverted_pulses))
+        else:
+            for pulse in self.pulse_list:
+                if pulse["is_inverted"]:
+                    pulse.set_attributes(self.inverted_params)
         self.logger.log(LogLevels.TRACE, "Global inverted-pulse parameters applied. (pre-absolute_time calculation)")
 
         ##############################################
@@ -329,6 +388,12 @@ class InputPulseSeq(PulseSeq):
                     self.logger.log(LogLevels.TRACE, "Carrying out pre-calculation conversion for {}".format(param_name))
                     ## Cycle through each pulse and apply the desired pre-calculations
                     if isinstance(param_converter, dict):
+                        if vectorized:
+                            if not np.all(get_param_set_mask(self.pulse_list, param_name)):
+                                raise KeyError(param_name)
+                            param_values = get_param_values(self.pulse_list, param_name)
+                            set_param_values(self.pulse_list, param_name, [param_converter[value] for value in param_values])
+                            continue
                         for pulse in self.pulse_list:
                             pulse[param_name] = param_converter[pulse[param_name]]
                     ## Leave skeleton for potentially adding different conversion objects
@@ -364,88 +429,7 @@ class InputPulseSeq(PulseSeq):
 
         ## debug message
         self.logger.log(LogLevels.TRACE, "Setting absolute time for pulses with 'previous' and 'relative' time reference...")
-        ## Loop through pulses for the next two processes, as there may be odd dependencies
-        max_loop_counter = len(self.pulse_list) # at least one pulse should be set each loop
-        loop_counter = 0
-        ## First, set the value of the pulse_number attribute to None for pulses where it is not already set; this will enable checking for it without errors
-        for pulse in self.pulse_list:
-            if "pulse_number" in pulse.attributes:
-                continue
-            else:
-                pulse["pulse_number"] = -1
-        ## Loop through pulses
-        while not all([pulse.valid_abs_time for pulse in self.pulse_list]):
-            self.logger.log(LogLevels.TRACE, "Looping through pulse list, iteration {}".format(loop_counter))
-            ## check maximum loops - could indicate improper time-ordering dependencies
-            if loop_counter >= max_loop_counter:
-                raise RuntimeError("Could not calculate pulse timing; please re-check dependencies to ensure calculation is possible!")
-
-            ## Then, any pulses with time_reference set to "previous", which will be set by incrementing upwards through user-specified pulse_number parameters
-
-            ##    Find the maximal user-defined pulse number to serve as an upper limit for iterating the pulse counter
-            max_pulse_number = max([pulse["pulse_number"] for pulse in self.pulse_list])
-            ##    Finally, iterate upwards through increasing pulse numbers, calculating the absolute times of all pulses with pulse numbers and time_reference = "previous"
-            pulse_counter = 0
-            previous_pulse = None
-            absolute_time = 0.0
-            while pulse_counter <= max_pulse_number:
-                current_pulse = next((pulse for pulse in self.pulse_list if pulse["pulse_number"] == pulse_counter), None)
-                if current_pulse is not None: # ensure that a pulse with this pulse number was returned above
-                    if current_pulse["time_reference"] == "previous":
-                        ## Check that we are not attempting to specify this for the first pulse (there is no previous pulse!)
-                        if previous_pulse is None:
-                            raise RuntimeError("Cannot use 'previous' time reference for first numbered pulse")
-                        ## Otherwise, calculate absolute time
-                        if current_pulse.valid_abs_time:
-                            pass
-                        else:
-                            self.calculate_absolute_time(current_pulse, previous_pulse)
-                    else: # the current pulse does not have 'previous' as its time_reference specification - do nothing
-                        pass
-                    ## If a pulse with this pulse_number exists, always update the previous_pulse reference
-                    previous_pulse = current_pulse
-                else:  # no pulse with this number exists
-                    pass
-                ## Update pulse counter
-                pulse_counter = pulse_counter + 1
-
-            ## Finally, any pulses which have their reference relative to a named pulse
-            for current_pulse in self.pulse_list:
-                if current_pulse["time_reference"] == 'relative':
-                    ## Ensure that reference pulse is specified by name
-                    try:
-                        ref_pulse_name = current_pulse["relative_to"]
-                    except KeyError:
-                        raise RuntimeError(" ".join([str(current_pulse), "has time_reference set as 'relative', but no reference pulse name is specified."]))
-                    ## Attempt to fetch ref pulse
-                    try:
-                        ref_pulse = self[ref_pulse_name]
-                    except KeyError:
-                        raise RuntimeError(" ".join(["No pulse with name", ref_pulse_name, "exists."]))
-                    ## Check if current pulse already has a valid absolute time set
-                    if current_pulse.valid_abs_time:
-                        # if verbose >= 4:
-                        #     print(str(current_pulse), "already has a valid absolute time, skipping...")
-                        pass
-                    else:
-                        # if verbose >= 4:
-                        #     print(str(current_pulse), "has no valid absolute time; calculating...")
-                        self.calculate_absolute_time(current_pulse, ref_pulse)
-                ##
-            ## debug message
-            # if verbose >= 4:
-            #     print("Current pulse state:")
-            #     self.print_info(pulse_params = True)
-            #     print("Absolute time validity:")
-            #     print([pulse.valid_abs_time for pulse in self.pulse_list])
-            ## Increment loop counter to prevent infinite loops
-            loop_counter = loop_counter + 1
-
-        ## End looping through pulses
-        ##    Clean up - remove artificially-added pulse_number specifications
-        for pulse in self.pulse_list:
-            if pulse["pulse_number"] == -1:
-                del pulse["pulse_number"]
+        self.resolve_timing_graph()
         ## Status message
         self.logger.log(LogLevels.TRACE, "Absolute time set for 'previous' and 'relative' reference pulses.")
         ## Absolute times calculations finished
@@ -455,13 +439,113 @@ class InputPulseSeq(PulseSeq):
         ## Status message
         self.logger.debug("Pulse sequence pre-conversion completed.")
 
+    def get_timing_references(self):
+        '''
+        Get the reference pulse for each pulse which does not yet have a valid absolute time, as a dict of {pulse name: reference pulse}.
+
+        Pulses with time_reference 'previous' reference the pulse with the next-lowest pulse_number, and pulses with time_reference 'relative' reference the pulse named by their relative_to parameter. Pulses whose reference cannot be determined are given a reference of None.
+        '''
+        pulses_by_name = self._pulses_by_name
+        ## Sequence of numbered pulses (the first pulse in the list with each pulse number)
+        pulses_by_number = {}
+        for pulse in self.pulse_list:
+            pulse_number = pulse.attributes.get("pulse_number")
+            if pulse_number is not None and pulse_number >= 0 and pulse_number == int(pulse_number):
+                pulses_by_number.setdefault(pulse_number, pulse)
+        previous_pulses = {}
+        previous_pulse = None
+        for pulse_number in sorted(pulses_by_number):
+            current_pulse = pulses_by_number[pulse_number]
+            if current_pulse["time_reference"] == "previous" and previous_pulse is None:
+                raise RuntimeError("Cannot use 'previous' time reference for first numbered pulse")
+            previous_pulses[current_pulse.name] = previous_pulse
+            previous_pulse = current_pulse
+        ## Check all relative references before resolving any
+        for current_pulse in self.pulse_list:
+            if current_pulse["time_reference"] == "relative":
+                try:
+                    ref_pulse_name = current_pulse["relative_to"]
+                except KeyError:
+                    raise RuntimeError(" ".join([str(current_pulse), "has time_reference set as 'relative', but no reference pulse name is specified."]))
+                if ref_pulse_name not in pulses_by_name:
+                    raise RuntimeError(" ".join(["No pulse with name", ref_pulse_name, "exists."]))
+        ## Reference for each unresolved pulse
+        timing_references = {}
+        for current_pulse in self.pulse_list:
+            if current_pulse.valid_abs_time:
+                continue
+            if current_pulse["time_reference"] == "previous" and \
+                    pulses_by_number.get(current_pulse.attributes.get("pulse_number")) is current_pulse:
+                timing_references[current_pulse.name] = previous_pulses[current_pulse.name]
+            elif current_pulse["time_reference"] == "relative":
+                timing_references[current_pulse.name] = pulses_by_name[current_pulse["relative_to"]]
+            else:
+                ## No pulse_number (or a repeated one) for 'previous', or an unknown time_reference
+                timing_references[current_pulse.name] = None
+        return timing_references
+
+    def resolve_timing_graph(self):
+        '''
+        Calculate the absolute times of all pulses with 'previous' and 'relative' time references.
+
+        The timing references form a graph, which is resolved in a single pass in topological order (each pulse is calculated once its reference pulse has a valid absolute time). A RuntimeError is raised listing the pulses which could not be resolved, along with any dependency cycle found between them.
+        '''
+        ## Nothing to do if all absolute times are already valid
+        if all([pulse.valid_abs_time for pulse in self.pulse_list]):
+            return
+        timing_references = self.get_timing_references()
+        ## Pulses waiting on each unresolved reference pulse
+        dependents = {}
+        ready_pulses = []
+        for current_pulse in self.pulse_list:
+            ref_pulse = timing_references.get(current_pulse.name)
+            if current_pulse.valid_abs_time or ref_pulse is None:
+                continue
+            if ref_pulse.valid_abs_time:
+                ready_pulses.append(current_pulse)
+            else:
+                dependents.setdefault(ref_pulse.name, []).append(current_pulse)
+        ## Resolve in topological order
+        n_resolved = 0
+        while ready_pulses:
+            current_pulse = ready_pulses.pop()
+            self.calculate_absolute_time(current_pulse, timing_references[current_pulse.name])
+            n_resolved += 1
+            ready_pulses.extend(dependents.pop(current_pulse.name, []))
+        self.logger.log(LogLevels.TRACE, "Absolute time calculated for {} pulses.".format(n_resolved))
+        ## Report any pulses which could not be resolved
+        unresolved_names = [pulse.name for pulse in self.pulse_list if not pulse.valid_abs_time]
+        if unresolved_names:
+            error_message = "Could not calculate pulse timing; please re-check dependencies to ensure calculation is possible! Unresolved pulses: {}".format(", ".join(unresolved_names))
+            timing_cycle = self.find_timing_cycle(timing_references, unresolved_names)
+            if timing_cycle:
+                error_message = "".join([error_message, ". Dependency cycle: ", " -> ".join(timing_cycle)])
+            raise RuntimeError(error_message)
+
+    def find_timing_cycle(self, timing_references, unresolved_names):
+        '''
+        Find a cycle among the timing references of the unresolved pulses, returned as a list of pulse names (starting and ending with the same pulse), or None if there is no cycle.
+        '''
+        for start_name in unresolved_names:
+            path = []
+            path_positions = {}
+            current_name = start_name
+            while current_name is not None and current_name not in path_positions:
+                path_positions[current_name] = len(path)
+                path.append(current_name)
+                ref_pulse = timing_references.get(current_name)
+                current_name = None if ref_pulse is None else ref_pulse.name
+            if current_name is not None:
+                return path[path_positions[current_name]:] + [current_name]
+        return None
+
     def calculate_absolute_time(self, current_pulse, reference_pulse):
         '''
         Calculate the absolute time of the current_pulse relative to the relative_marker (start or end) of the reference_pulse.
 
-        Note that if the reference pulse does not have a valid absolute time, the function will return nothing; this is intended to be used when looping through the pulse list to brute-force potentially-complex dependencies.
+        Note that if the reference pulse does not have a valid absolute time, the function will return nothing (the timing graph is resolved such that this does not occur).
         '''
-        ## Assert that the reference pulse already has a valid absolute time calculated; if not, the pulse is skipped, and the loop in pulse_pre_conversion will attempt this again
+        ## Assert that the reference pulse already has a valid absolute time calculated; if not, the pulse is skipped
         if reference_pulse.valid_abs_time:
             ## Check reference point - default to 'end' (as is usual for e2e spec in Labber GUI)
             if "relative_marker" not in current_pulse.attributes:
@@ -485,20 +569,23 @@ class InputPulseSeq(PulseSeq):
         ##
 
 
-    def get_sorted_list(self, sort_attribute = _rc.pulse_sort_attr):
+    def get_sorted_list(self, sort_attribute = _rc.pulse_sort_attr, *, vectorized = False):
         '''
         Fetch the list of pulses in the sequence, sorted by an attribute (should be absolute_time).
 
-        The output of this method can be passed directly to an OutputPulseSeq.
+        The output of this method can be passed directly to an OutputPulseSeq. If vectorized is set, the pre-conversion is vectorized (see pulse_pre_conversion), and the sort order is found with a (stable) NumPy argsort of the attribute values.
         '''
         ## Status message
         self.logger.debug("Getting sorted pulse sequence...")
         ## Carry out pre-sort processing
-        self.pulse_pre_conversion()
+        self.pulse_pre_conversion(vectorized = vectorized)
         ## Assert that each pulse in the sequence has the appropriate sort attribute set
         assert all([pulse.valid_abs_time for pulse in self.pulse_list]), "There are pulses which do not have a valid (set or calculated) absolute_time attribute."
         ## debug message
         self.logger.log(LogLevels.TRACE, "Sorting by attribute: {}".format(sort_attribute))
+        if vectorized:
+            sort_order = np.argsort(get_param_array(self.pulse_list, sort_attribute), kind = "stable")
+            return [self.pulse_list[index] for index in sort_order]
         return sorted(self.pulse_list, key = lambda x: x[sort_attribute])
 
 ###############################################################################
@@ -552,9 +639,11 @@ class OutputPulseSeq(PulseSeq):
         ##
         self.main_params = param_dict
 
-    def set_pulse_seq(self, pulse_list):
+    def set_pulse_seq(self, pulse_list, *, vectorized = False):
         '''
         Import data from a (sorted) list of pulses.
+
+        If vectorized is set, the post-conversion timing calculations are carried out on arrays of the pulse parameters (see pulse_post_conversion).
         '''
         ## debug message
         self.logger.debug("Setting pulse sequence in OutputPulseSeq...")
@@ -565,21 +654,27 @@ class OutputPulseSeq(PulseSeq):
         #     print("Imported pulse sequence in OutputPulseSeq:")
         #     self.print_info(pulse_params = True)
         ## Post-import processing
-        self.pulse_post_conversion()
+        self.pulse_post_conversion(vectorized = vectorized)
         ## debug message
         self.logger.log(LogLevels.TRACE, "OutputPulseSeq processing completed.")
 
-    def pulse_post_conversion(self):
+    def pulse_post_conversion(self, *, vectorized = False):
         '''
         Post-conversion pulse sequence cleanup.
 
         This method carries out any modifications to the pulse sequence parameters such that they are ready for export to Labber.
+
+        If vectorized is set, the pulse numbers and spacings are calculated for all pulses at once from arrays of the pulse parameters, with iteration parameters taken at their max_value (as in the pulse-by-pulse calculation).
         '''
         ## debug messsage
         self.logger.debug("Carrying out post-conversion processing on output sequence...")
         ## Assign pulse number attributes based on ordering
-        for index, pulse in enumerate(self.pulse_list):
-            pulse["pulse_number"] = index + 1  # pulse numbering starts at 0
+        if vectorized:
+            set_param_values(self.pulse_list, "pulse_number", list(range(1, len(self.pulse_list) + 1)))
+        else:
+            for index, pulse in enumerate(self.pulse_list):
+                pulse["pulse_number"] = index + 1  # pulse numbering starts at 0
+        self.rebuild_number_index()
         ## Set number of pulses
         self.main_params["# of pulses"] = len(self.pulse_list)
 
@@ -590,15 +685,21 @@ class OutputPulseSeq(PulseSeq):
         ###################
         ## Get first pulse delay from absolute time of first pulse
         self.main_params["First pulse delay"] = self.pulse_list[0]["absolute_time"]
-        ## Iterate through pulses, setting previous pulse's spacing based on next pulse's absolute_time
-        for current_pulse, next_pulse in zip(self.pulse_list[:-1], self.pulse_list[1:]):
-            # if verbose >= 4:
-            #     print("Calculating pulse spacing between", current_pulse, "and", next_pulse)
-            current_pulse["s"] = next_pulse["absolute_time"] - current_pulse.end_time
-            # if verbose >= 4:
-            #     print("\tNext pulse absolute time:", next_pulse['absolute_time'])
-            #     print("\tCurrent pulse end time:", current_pulse.end_time)
-            #     print("\tCurrent pulse spacing:", current_pulse['s'])
+        if vectorized:
+            ## Spacing of each pulse is the next pulse's absolute_time minus its end time
+            absolute_times = get_param_array(self.pulse_list, "absolute_time")
+            end_times = absolute_times + get_param_array(self.pulse_list, "w") + get_param_array(self.pulse_list, "v")
+            set_param_values(self.pulse_list[:-1], "s", (absolute_times[1:] - end_times[:-1]).tolist())
+        else:
+            ## Iterate through pulses, setting previous pulse's spacing based on next pulse's absolute_time
+            for current_pulse, next_pulse in zip(self.pulse_list[:-1], self.pulse_list[1:]):
+                # if verbose >= 4:
+                #     print("Calculating pulse spacing between", current_pulse, "and", next_pulse)
+                current_pulse["s"] = next_pulse["absolute_time"] - current_pulse.end_time
+                # if verbose >= 4:
+                #     print("\tNext pulse absolute time:", next_pulse['absolute_time'])
+                #     print("\tCurrent pulse end time:", current_pulse.end_time)
+                #     print("\tCurrent pulse spacing:", current_pulse['s'])
         ## Set pulse sequence length (number of points)
         if 'sequence_duration' in self.main_params and 'Sample rate' in self.main_params:
             self.main_params['Number of points'] = int(self.main_params['sequence_duration']*self.main_params['Sample rate'])
@@ -610,18 +711,10 @@ class OutputPulseSeq(PulseSeq):
         #     self.print_info(pulse_params = True)
 
         ####
-        ## Convert all physical parameter pulse shortcodes to full names
+        ## List all physical parameters under their full names (short and full names share the same storage, so no values are moved)
         self.logger.log(LogLevels.TRACE, "Converting parameter shortcodes...")
-        for param_full_name, param_short_name in _rc.FULL_NAMES_PULSES.items():
-            self.logger.log(LogLevels.TRACE, "Converting {} into {}...".format(param_short_name, param_full_name))
-            for pulse in self.pulse_list:
-                try:
-                    param_value = pulse[param_short_name]
-                except KeyError:
-                    continue
-                else:
-                    del pulse[param_short_name]
-                    pulse[param_full_name] = param_value
+        for pulse in self.pulse_list:
+            pulse.set_full_names()
         self.logger.log(LogLevels.TRACE, "Parameter shortcodes converted.")
 
         ## set flag
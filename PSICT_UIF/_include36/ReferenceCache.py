@@ -0,0 +1,141 @@
+## PSICT-UIF ReferenceCache class
+##  Stores prepared reference files (with all direct hdf5 edits applied) in a
+##  cache directory, so that repeated measurements from the same template
+##  and settings can skip re-applying the edits.
+
+import os
+import hashlib
+import tempfile
+import shutil
+import logging
+
+import PSICT_UIF._include36._LogLevels as LogLevels
+
+## Cache defaults
+DEFAULT_MAX_SIZE = 2**30      # maximum total size of cached files (in bytes)
+CACHE_FILE_EXT = "hdf5"       # extension of cached reference files
+CACHE_FORMAT_VERSION = "1"    # included in every key; change to invalidate existing entries
+
+## Template content hashes, memoized by (path, size, modification time)
+_template_hashes = {}
+
+def get_file_hash(file_path, *, chunk_size = 2**20):
+    '''
+    Get the sha1 hash of the contents of the file at file_path.
+
+    The hash is memoized by the file path, size, and modification time, so that the file is only read again if it has changed.
+    '''
+    file_stat = os.stat(file_path)
+    memo_key = (os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns)
+    if memo_key not in _template_hashes:
+        file_hash = hashlib.sha1()
+        with open(file_path, "rb") as hashed_file:
+            for chunk in iter(lambda: hashed_file.read(chunk_size), b""):
+                file_hash.update(chunk)
+        _template_hashes[memo_key] = file_hash.hexdigest()
+    return _template_hashes[memo_key]
+
+
+class ReferenceCache:
+    '''
+    Cache directory of prepared reference files.
+
+    Each entry is keyed by the content hash of the template file, together with a hash of all settings which affect the direct edits to the reference file (see LabberExporter.get_reference_state_hash). Entries are published atomically (written to a temporary file in the cache directory and then renamed), so that concurrent measurements never see a partially-written entry. When the total size of the entries exceeds max_size, the least recently used entries are evicted.
+    '''
+
+    def __init__(self, cache_dir, *, max_size = DEFAULT_MAX_SIZE, parent_logger_name = None):
+        ## Logging
+        if parent_logger_name is not None:
+            logger_name = '.'.join([parent_logger_name, 'ReferenceCache'])
+        else:
+            logger_name = 'ReferenceCache'
+        self.logger = logging.getLogger(logger_name)
+        ## Settings
+        self.cache_dir = os.path.abspath(os.path.expanduser(os.path.normpath(cache_dir)))
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok = True)
+        ## Status message
+        self.logger.log(LogLevels.TRACE, 'Instance initialized.')
+
+    def get_key(self, template_path, state_hash):
+        '''
+        Get the cache key for the given template file and reference state hash.
+        '''
+        key_hash = hashlib.sha1()
+        for key_part in [CACHE_FORMAT_VERSION, get_file_hash(template_path), state_hash]:
+            key_hash.update(key_part.encode('utf-8'))
+            key_hash.update(b'\0')
+        return key_hash.hexdigest()
+
+    def get_entry_path(self, key):
+        '''
+        Get the path of the cache entry for the given key (which may not exist).
+        '''
+        return os.path.join(self.cache_dir, ".".join([key, CACHE_FILE_EXT]))
+
+    def lookup(self, key):
+        '''
+        Get the path of the cached reference file for the given key, or None if there is no such entry.
+
+        The entry is marked as most recently used.
+        '''
+        entry_path = self.get_entry_path(key)
+        try:
+            os.utime(entry_path)
+        except FileNotFoundError:
+            self.logger.debug('Reference cache miss: {}'.format(key))
+            return None
+        self.logger.debug('Reference cache hit: {}'.format(key))
+        return entry_path
+
+    def publish(self, key, source_path):
+        '''
+        Add a copy of the prepared reference file at source_path to the cache under the given key, and evict old entries if necessary.
+        '''
+        entry_path = self.get_entry_path(key)
+        ## Write to temporary file first, so that the entry only appears once it is complete
+        temp_fd, temp_path = tempfile.mkstemp(dir = self.cache_dir, suffix = ".tmp")
+        os.close(temp_fd)
+        try:
+            shutil.copyfile(source_path, temp_path)
+            os.replace(temp_path, entry_path)
+        except:
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+            raise
+        self.logger.debug('Reference file published to cache: {}'.format(key))
+        self.evict()
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the total size of the cache is within max_size.
+        '''
+        entries = []
+        for entry_name in os.listdir(self.cache_dir):
+            if not entry_name.endswith("." + CACHE_FILE_EXT):
+                continue
+            entry_path = os.path.join(self.cache_dir, entry_name)
+            try:
+                entry_stat = os.stat(entry_path)
+            except FileNotFoundError:
+                continue
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_path))
+        total_size = sum(entry[1] for entry in entries)
+        for _, entry_size, entry_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            total_size -= entry_size
+            self.logger.log(LogLevels.TRACE, 'Evicted reference cache entry: {}'.format(entry_path))
+
+    def clear(self):
+        '''
+        Remove all entries from the cache.
+        '''
+        for entry_name in os.listdir(self.cache_dir):
+            if entry_name.endswith("." + CACHE_FILE_EXT):
+                os.remove(os.path.join(self.cache_dir, entry_name))
+        self.logger.debug('Reference cache cleared.')
@@ -0,0 +1,250 @@
+## PSICT-UIF ReferenceFileSession class
+##  Holds the reference hdf5 file open for a whole set of direct edits,
+##  and writes all buffered changes back in a single flush.
+
+import numpy as np
+import logging
+
+import PSICT_UIF._include36._LogLevels as LogLevels
+
+class ReferenceFileSession:
+    '''
+    Editing session on the reference hdf5 database file.
+
+    The file is opened once when the session is opened, and the 'Step list' is loaded into memory. All edits to the 'Step list' entries, the 'Step config' relation parameters and step items, and the 'Instrument config' attributes are buffered in the session, and are only written back to the file (followed by a single flush) when the session is committed.
+
+    The session can be used as a context manager; it is committed on a clean exit from the context, and the buffered edits are discarded if an exception is raised.
+    '''
+
+    def __init__(self, file_path, *, parent_logger_name = None):
+        ## Logging
+        if parent_logger_name is not None:
+            logger_name = '.'.join([parent_logger_name, 'ReferenceFileSession'])
+        else:
+            logger_name = 'ReferenceFileSession'
+        self.logger = logging.getLogger(logger_name)
+        ## File attributes
+        self.file_path = file_path
+        self._config_file = None
+        ## Buffered contents and edits
+        self._step_list = None             # in-memory copy of the 'Step list' dataset
+        self._sl_index = {}                # 'Step list' row index, by full channel name
+        self._is_step_list_modified = False
+        self._relation_params = {}         # replacement 'Relation parameters' datasets, by full channel name
+        self._step_items = {}              # replacement 'Step items' datasets, by full channel name
+        self._instr_config_attrs = {}      # Instrument Config attribute values, by full instrument string
+        ## Status message
+        self.logger.log(LogLevels.TRACE, 'Instance initialized.')
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.logger.warning('Discarding buffered reference file edits due to error.')
+        finally:
+            self.close()
+
+    @property
+    def is_open(self):
+        return self._config_file is not None
+
+    # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+    ## Opening and closing
+
+    def open(self):
+        '''
+        Open the reference file and load the 'Step list' into memory.
+        '''
+        self.logger.debug('Opening reference file session: {}'.format(self.file_path))
+        import h5py
+        self._config_file = h5py.File(self.file_path, 'r+')
+        self._step_list = self._config_file['Step list'][()]
+        self.build_step_list_index()
+        self._is_step_list_modified = False
+        self._relation_params = {}
+        self._step_items = {}
+        self._instr_config_attrs = {}
+        self.logger.log(LogLevels.TRACE, 'Step list loaded with {} entries.'.format(len(self._step_list)))
+
+    def commit(self):
+        '''
+        Write all buffered edits back to the reference file, and flush it.
+        '''
+        self.logger.debug('Committing reference file edits...')
+        ## Step list is written back in a single assignment
+        if self._is_step_list_modified:
+            self._config_file['Step list'][...] = self._step_list
+            self._is_step_list_modified = False
+        ## Replace relation parameters for each edited channel
+        for label_string, new_sc_entries in self._relation_params.items():
+            step_config = self._config_file['Step config'][label_string]
+            try:
+                del step_config['Relation parameters']
+            except KeyError:
+                pass
+            step_config.create_dataset('Relation parameters', data = new_sc_entries)
+        self._relation_params = {}
+        ## Replace step items for each edited channel
+        for label_string, new_step_items in self._step_items.items():
+            step_config = self._config_file['Step config'][label_string]
+            del step_config['Step items']
+            step_config.create_dataset('Step items', data = new_step_items)
+        self._step_items = {}
+        ## Set Instrument Config attributes
+        for instrument_string, instrument_attrs in self._instr_config_attrs.items():
+            config_attrs = self._config_file['Instrument config'][instrument_string].attrs
+            for param_name, param_value in instrument_attrs.items():
+                config_attrs[param_name] = param_value
+        self._instr_config_attrs = {}
+        ## Single flush for all edits
+        self._config_file.flush()
+        self.logger.debug('Reference file edits committed.')
+
+    def close(self):
+        '''
+        Close the reference file. Any edits which have not been committed are discarded.
+        '''
+        if self._config_file is not None:
+            self._config_file.close()
+            self._config_file = None
+        self._step_list = None
+        self._sl_index = {}
+        self.logger.debug('Reference file session closed.')
+
+    # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+    ## Step list
+
+    @property
+    def step_list(self):
+        '''
+        The in-memory copy of the 'Step list' dataset.
+        '''
+        return self._step_list
+
+    def build_step_list_index(self):
+        '''
+        Build the index of full channel name to row in the 'Step list'.
+        '''
+        self._sl_index = {}
+        for index, entry in enumerate(self._step_list):
+            self._sl_index.setdefault(decode_label(entry['channel_name']), index)
+
+    def get_step_list_index(self, label_string):
+        '''
+        Get the row of the 'Step list' entry matching the full channel name label_string.
+
+        A ValueError is raised if there is no such entry.
+        '''
+        try:
+            return self._sl_index[label_string]
+        except KeyError:
+            raise ValueError('{} is not in the step list'.format(label_string))
+
+    def get_step_list_labels(self):
+        '''
+        Get the full channel names of the 'Step list' entries, in their current order.
+        '''
+        return [decode_label(entry['channel_name']) for entry in self._step_list]
+
+    def get_step_list_entry(self, index):
+        '''
+        Get a copy of the 'Step list' entry at the given index.
+        '''
+        return self._step_list[index].copy()
+
+    def set_step_list_entry(self, index, new_entry):
+        '''
+        Replace the 'Step list' entry at the given index.
+        '''
+        old_label = decode_label(self._step_list[index]['channel_name'])
+        self._step_list[index] = new_entry
+        self._is_step_list_modified = True
+        ## Keep index up to date if the entry label has changed
+        new_label = decode_label(self._step_list[index]['channel_name'])
+        if new_label != old_label:
+            if self._sl_index.get(old_label) == index:
+                del self._sl_index[old_label]
+            self._sl_index[new_label] = index
+
+    def reorder_step_list(self, channel_names):
+        '''
+        Re-order the 'Step list' so that the entries for channel_names come first, in the given order.
+
+        All other entries keep their current relative order. The new order is applied as a single permutation of the in-memory step list.
+        '''
+        ## Requested rows first (ignoring repeats), followed by all other rows in their current order
+        requested_rows = []
+        for channel_name in channel_names:
+            row = self.get_step_list_index(channel_name)
+            if row not in requested_rows:
+                requested_rows.append(row)
+        requested_set = set(requested_rows)
+        permutation = requested_rows + [row for row in range(len(self._step_list)) \
+                                                if row not in requested_set]
+        ## Apply permutation and update index
+        self._step_list = self._step_list[permutation]
+        self._is_step_list_modified = True
+        self.build_step_list_index()
+
+    # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+    ## Step config and Instrument config
+
+    def get_relation_params_dtype(self):
+        '''
+        Get the dtype of the 'Relation parameters' entries in the 'Step config'.
+        '''
+        for label_string in self._config_file['Step config']:
+            return np.dtype(self._config_file['Step config'][label_string]['Relation parameters'].dtype)
+
+    def set_relation_params(self, label_string, new_sc_entries):
+        '''
+        Set the 'Relation parameters' of the 'Step config' for the given full channel name.
+        '''
+        ## Fail early if the channel does not have a step config entry
+        if label_string not in self._config_file['Step config']:
+            raise KeyError('No step config entry exists for {}'.format(label_string))
+        self._relation_params[label_string] = new_sc_entries
+
+    def set_step_items(self, label_string, step_items):
+        '''
+        Set the 'Step items' of the 'Step config' for the given full channel name.
+
+        step_items is a list of dicts of 'Step items' field values; fields which are not given are copied from the first existing step item.
+        '''
+        ## Fail early if the channel does not have step items
+        try:
+            old_step_items = self._config_file['Step config'][label_string]['Step items']
+        except KeyError:
+            raise KeyError('No step items exist for {}'.format(label_string))
+        new_step_items = np.zeros(len(step_items), dtype = old_step_items.dtype)
+        if len(old_step_items) > 0:
+            new_step_items[:] = old_step_items[0]
+        for row_index, step_item in enumerate(step_items):
+            for field_name, field_value in step_item.items():
+                if field_name in new_step_items.dtype.names:
+                    new_step_items[row_index][field_name] = field_value
+        self._step_items[label_string] = new_step_items
+
+    def set_instr_config_attr(self, instrument_string, param_name, param_value):
+        '''
+        Set an attribute of the 'Instrument config' for the given full instrument string.
+        '''
+        ## Fail early if the instrument does not exist in the instrument config
+        if instrument_string not in self._config_file['Instrument config']:
+            raise KeyError('No instrument config entry exists for {}'.format(instrument_string))
+        self._instr_config_attrs.setdefault(instrument_string, {})[param_name] = param_value
+
+###############################################################################
+
+def decode_label(label):
+    '''
+    Get a step list label as a string, regardless of whether it is read from the file as bytes or str.
+    '''
+    if isinstance(label, bytes):
+        return label.decode('utf-8')
+    return label
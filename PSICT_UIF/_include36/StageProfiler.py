@@ -0,0 +1,125 @@
+## PSICT-UIF StageProfiler class
+##  Records the wall and CPU time spent in each stage of the measurement
+##  pre-processing, along with counters of expensive events (eg hdf5 file
+##  opens), so that the overhead can be tracked across measurements.
+
+import time
+import json
+import threading
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+
+import PSICT_UIF._include36._LogLevels as LogLevels
+
+## Separator between the names of nested stages, eg "apply_all/relations"
+STAGE_SEPARATOR = "/"
+
+class StageProfiler:
+    '''
+    Records per-stage timings and event counters.
+
+    Stages are timed with the stage context manager, and may be nested; nested stages are recorded under their full name (eg "apply_all/relations"), and the time of the outer stage includes that of the inner stages. Both wall time and CPU time (of the whole process, ie including any worker threads) are recorded, along with the number of times each stage was entered. Events (eg "hdf5_opens", "bytes_copied", "client_round_trips") are counted with the count method; the totals are kept both overall and for each stage during which they occurred.
+
+    The results since initialisation (or the last reset) are returned as a dict by get_results, and can be appended as a single JSON line to a file with append_results.
+    '''
+
+    def __init__(self, *, parent_logger_name = None):
+        ## Logging
+        if parent_logger_name is not None:
+            logger_name = '.'.join([parent_logger_name, 'StageProfiler'])
+        else:
+            logger_name = 'StageProfiler'
+        self.logger = logging.getLogger(logger_name)
+        ## Counters may be updated from worker threads
+        self._lock = threading.Lock()
+        ## Recorded values
+        self.reset()
+        ## Status message
+        self.logger.log(LogLevels.TRACE, 'Instance initialized.')
+
+    def reset(self):
+        '''
+        Discard all recorded stage timings and counters.
+        '''
+        self._stages = {}        # full stage name: stage record, in order of first entry
+        self._counters = {}      # counter name: total count
+        self._stage_names = []   # names of the currently open (nested) stages
+
+    # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+    ## Recording
+
+    @contextmanager
+    def stage(self, stage_name):
+        '''
+        Time the enclosed code as the given stage, nested under any stages which are currently open.
+        '''
+        self._stage_names.append(stage_name)
+        full_name = STAGE_SEPARATOR.join(self._stage_names)
+        with self._lock:
+            stage_record = self._stages.setdefault(full_name, \
+                                {"calls": 0, "wall_time": 0.0, "cpu_time": 0.0, "counters": {}})
+            counters_start = dict(self._counters)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - wall_start
+            cpu_time = time.process_time() - cpu_start
+            self._stage_names.pop()
+            with self._lock:
+                stage_record["calls"] += 1
+                stage_record["wall_time"] += wall_time
+                stage_record["cpu_time"] += cpu_time
+                for counter_name, count in self._counters.items():
+                    count_change = count - counters_start.get(counter_name, 0)
+                    if count_change:
+                        stage_record["counters"][counter_name] = stage_record["counters"].get(counter_name, 0) + count_change
+            self.logger.log(LogLevels.TRACE, 'Stage {} took {:.6f} s'.format(full_name, wall_time))
+
+    def count(self, counter_name, count = 1):
+        '''
+        Add count to the given counter.
+        '''
+        with self._lock:
+            self._counters[counter_name] = self._counters.get(counter_name, 0) + count
+
+    # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+    ## Results
+
+    def get_results(self):
+        '''
+        Get the recorded results, as a dict with the "stages" (full stage name: dict of "calls", "wall_time", "cpu_time" in seconds, and "counters") and the total "counters".
+        '''
+        with self._lock:
+            return {
+                    "stages": {full_name: dict(stage_record, counters = dict(stage_record["counters"])) \
+                                    for full_name, stage_record in self._stages.items()},
+                    "counters": dict(self._counters),
+                }
+
+    def log_results(self, level = LogLevels.VERBOSE):
+        '''
+        Log the recorded stage timings and counters, one line per stage.
+        '''
+        results = self.get_results()
+        for full_name, stage_record in results["stages"].items():
+            self.logger.log(level, 'Stage {}: {:.6f} s wall, {:.6f} s CPU, {} call(s){}'.format(\
+                                    full_name, stage_record["wall_time"], stage_record["cpu_time"], stage_record["calls"], \
+                                    "".join(", {} {}".format(count, counter_name) \
+                                                for counter_name, count in stage_record["counters"].items())))
+        self.logger.log(level, 'Counters: {}'.format(results["counters"]))
+
+    def append_results(self, file_path, **record_fields):
+        '''
+        Append the recorded results as a single JSON line to the file at file_path.
+
+        The line also contains the current time ("timestamp"), and any additional fields given as keyword arguments (eg the output file name), so that the overhead can be tracked over a whole series of measurements.
+        '''
+        record = {"timestamp": datetime.now().isoformat()}
+        record.update(record_fields)
+        record.update(self.get_results())
+        with open(file_path, "a") as profile_file:
+            profile_file.write(json.dumps(record, default = repr) + "\n")
+        self.logger.debug('Profiling results appended to: {}'.format(file_path))
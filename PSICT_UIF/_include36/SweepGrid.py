@@ -0,0 +1,180 @@
+## PSICT-UIF SweepGrid class
+##  Expands the iteration specifications of a measurement into a lazy
+##  N-dimensional grid, and evaluates the channel relations over it, so that
+##  the size of the measurement can be estimated offline.
+
+import logging
+from functools import reduce
+from operator import mul
+
+import numpy as np
+
+from PSICT_UIF._include36.ParameterSpec import IterationSpec
+from PSICT_UIF._include36.ChannelRelation import compile_relation
+import PSICT_UIF._include36._LogLevels as LogLevels
+
+## Grid defaults
+DEFAULT_CHUNK_SIZE = 2**20 # maximum number of grid points evaluated at once
+DEFAULT_VALUE_SIZE = 8     # bytes per stored value (float64)
+
+class SweepGrid:
+    '''
+    Lazy N-dimensional grid of the channel values of a measurement.
+
+    Each swept channel (one with an IterationSpec value) is an axis of the grid, in the given iteration order followed by any swept channels not in it. Channels with relations are derived from the other channel values at each grid point. As in Labber, a relation takes precedence over an iteration specification for the same channel.
+
+    The grid is never materialised. A derived channel is evaluated only over the axes it (transitively) depends on, in chunks of at most chunk_size points.
+
+    channel_values maps full channel names to point values or IterationSpec objects. channel_defs maps channel keys to full channel names. channel_relations maps full channel names to [<relation string>, [<channel key>, ...]].
+    '''
+
+    def __init__(self, channel_values, *, iteration_order = None, channel_defs = None, channel_relations = None, \
+                                          chunk_size = DEFAULT_CHUNK_SIZE, parent_logger_name = None):
+        ## Logging
+        if parent_logger_name is not None:
+            logger_name = '.'.join([parent_logger_name, 'SweepGrid'])
+        else:
+            logger_name = 'SweepGrid'
+        self.logger = logging.getLogger(logger_name)
+        ## Settings
+        self.chunk_size = chunk_size
+        self.channel_values = channel_values
+        self.channel_defs = {} if channel_defs is None else channel_defs
+        self.channel_relations = {} if channel_relations is None else channel_relations
+        ## Axes: swept channels without relations, in iteration order first
+        iteration_order = [] if iteration_order is None else iteration_order
+        swept_channels = [channel_name for channel_name, channel_value in channel_values.items() \
+                          if isinstance(channel_value, IterationSpec) and channel_name not in self.channel_relations]
+        ordered_channels = [channel_name for channel_name in iteration_order if channel_name in swept_channels]
+        ordered_channels += [channel_name for channel_name in swept_channels if channel_name not in ordered_channels]
+        self.axis_channels = ordered_channels
+        self.axis_values = [channel_values[channel_name].get_values() for channel_name in ordered_channels]
+        self._axis_indices = {channel_name: axis_index for axis_index, channel_name in enumerate(ordered_channels)}
+        ## Status message
+        self.logger.log(LogLevels.TRACE, 'Instance initialized.')
+
+    ###########################################################################
+    ## Grid size
+
+    @property
+    def shape(self):
+        return tuple(len(values) for values in self.axis_values)
+
+    @property
+    def n_points(self):
+        return reduce(mul, self.shape, 1)
+
+    @property
+    def derived_channels(self):
+        return list(self.channel_relations.keys())
+
+    def get_file_size_estimate(self, *, n_log_values = 1, value_size = DEFAULT_VALUE_SIZE):
+        '''
+        Estimate the size (in bytes) of the measured data.
+
+        At every grid point, the values of all swept and derived channels are stored, along with n_log_values logged values. Each value takes value_size bytes, eg 8 for float64 or 16 for complex128; for logged traces, include the trace length in n_log_values. The size of the instrument configuration and hdf5 overhead is not included.
+        '''
+        n_values = len(self.axis_channels) + len(self.channel_relations) + n_log_values
+        return self.n_points*n_values*value_size
+
+    ###########################################################################
+    ## Channel evaluation
+
+    def get_channel_name(self, channel_key):
+        '''
+        Get the full channel name for the given channel key.
+        '''
+        try:
+            return self.channel_defs[channel_key]
+        except KeyError:
+            raise KeyError("Channel key {} is not defined.".format(channel_key))
+
+    def get_dependencies(self, channel_name, _visiting = None):
+        '''
+        Get the (sorted) indices of the axes on which the given channel depends, following relations through other derived channels.
+
+        A ValueError is raised if the relations are circular.
+        '''
+        if channel_name in self._axis_indices:
+            return [self._axis_indices[channel_name]]
+        if channel_name not in self.channel_relations:
+            return []
+        _visiting = set() if _visiting is None else _visiting
+        if channel_name in _visiting:
+            raise ValueError("Channel relations are circular through {}".format(channel_name))
+        _visiting.add(channel_name)
+        dependencies = set()
+        for channel_key in compile_relation(self.channel_relations[channel_name][0]).variables:
+            dependencies.update(self.get_dependencies(self.get_channel_name(channel_key), _visiting))
+        _visiting.remove(channel_name)
+        return sorted(dependencies)
+
+    def iterate_channel_values(self, channel_name):
+        '''
+        Iterate over the values of the given channel, as 1-dimensional arrays of at most chunk_size points each.
+
+        The values cover the sub-grid of the axes on which the channel depends (see get_dependencies), in C order; the full grid is never materialised.
+        '''
+        dependencies = self.get_dependencies(channel_name)
+        sub_shape = tuple(len(self.axis_values[axis_index]) for axis_index in dependencies)
+        n_sub_points = reduce(mul, sub_shape, 1)
+        for chunk_start in range(0, n_sub_points, self.chunk_size):
+            chunk_stop = min(chunk_start + self.chunk_size, n_sub_points)
+            chunk_indices = np.unravel_index(np.arange(chunk_start, chunk_stop), sub_shape) if sub_shape else ()
+            axis_chunks = {axis_index: self.axis_values[axis_index][axis_chunk_indices] \
+                           for axis_index, axis_chunk_indices in zip(dependencies, chunk_indices)}
+            chunk_values = self._evaluate(channel_name, axis_chunks, {})
+            yield np.broadcast_to(chunk_values, (chunk_stop - chunk_start,))
+
+    def _evaluate(self, channel_name, axis_chunks, evaluated):
+        ## Values of derived channels are shared within a chunk
+        if channel_name in evaluated:
+            return evaluated[channel_name]
+        if channel_name in self.channel_relations:
+            compiled_relation = compile_relation(self.channel_relations[channel_name][0])
+            variable_values = {channel_key: self._evaluate(self.get_channel_name(channel_key), axis_chunks, evaluated) \
+                               for channel_key in compiled_relation.variables}
+            channel_values = compiled_relation.evaluate(variable_values)
+        elif channel_name in self._axis_indices:
+            channel_values = axis_chunks[self._axis_indices[channel_name]]
+        else:
+            try:
+                channel_values = np.asarray(self.channel_values[channel_name])
+            except KeyError:
+                raise KeyError("No value is set for channel {}".format(channel_name))
+        evaluated[channel_name] = channel_values
+        return channel_values
+
+    def get_channel_range(self, channel_name):
+        '''
+        Get the (min, max) values of the given channel over the grid.
+        '''
+        channel_min = None
+        channel_max = None
+        for chunk_values in self.iterate_channel_values(channel_name):
+            chunk_min = np.min(chunk_values).item()
+            chunk_max = np.max(chunk_values).item()
+            channel_min = chunk_min if channel_min is None else min(channel_min, chunk_min)
+            channel_max = chunk_max if channel_max is None else max(channel_max, chunk_max)
+        return channel_min, channel_max
+
+    ###########################################################################
+    ## Summary
+
+    def summarize(self, *, n_log_values = 1, value_size = DEFAULT_VALUE_SIZE):
+        '''
+        Get a summary of the grid, as a dict with the grid shape, the total number of points, the estimated file size (see get_file_size_estimate), and the (min, max) values of each swept and derived channel.
+        '''
+        channel_ranges = {}
+        for channel_name in self.axis_channels + self.derived_channels:
+            channel_ranges[channel_name] = self.get_channel_range(channel_name)
+            self.logger.debug("Range of {}: {}".format(channel_name, channel_ranges[channel_name]))
+        summary = {
+                "shape": self.shape,
+                "n_points": self.n_points,
+                "file_size": self.get_file_size_estimate(n_log_values = n_log_values, value_size = value_size),
+                "channel_ranges": channel_ranges,
+            }
+        self.logger.log(LogLevels.VERBOSE, "Sweep grid: {} points, shape {}, estimated file size {} bytes".format( \
+                                           summary["n_points"], summary["shape"], summary["file_size"]))
+        return summary
@@ -1,18 +1,11 @@
 ## Functions common to multiple modules
 
-import re
+from PSICT_UIF._include36.ChannelRelation import compile_relation
 
 def extract_relation_variables(input_string):
     '''
-    Given an equation string (for a Labber channel relation), extract the valid python variable names (excluding those from modules such as numpy)
+    Given an equation string (for a Labber channel relation), extract the valid python variable names (excluding functions and those from modules such as numpy)
+
+    The equation is parsed once and cached (see ChannelRelation.compile_relation); each variable is listed once, in order of first appearance.
     '''
-    re_pattern = re.compile('[A-Za-z_]+[A-Za-z0-9_]*\s*\.?\s*[A-Za-z0-9_]*')
-    match_list = re.findall(re_pattern, input_string)
-    extracted_vars = []
-    ## Filter out matches with dots ('.')
-    for match_string in match_list:
-        if '.' in match_string:
-            continue
-        else:
-            extracted_vars.append(match_string.strip())
-    return extracted_vars
+    return list(compile_relation(input_string).variables)
@@ -10,5 +10,14 @@ REF_COPY_POSTFIX = "__copy"  # postfixed to filename of temporary reference file
 SCRIPT_COPY_EXTENSION = "py"  # script file extension - should be .py
 SCRIPTRC_COPY_EXTENSION = "py" # script rcfile extension - should be .py
 
+## Reference file copy strategies, tried in order until one succeeds
+##  "reflink": copy-on-write clone of the template (Linux, on filesystems supporting FICLONE)
+##  "config_only": new hdf5 file with the template contents, excluding the stored data groups
+##  "copy": full copy of the template
+REF_COPY_STRATEGIES = ["reflink", "config_only", "copy"]
+REF_COPY_EXCLUDED_GROUPS = r"^(Data|Traces|Log_\d+)$"  # top-level groups omitted by "config_only"
+REF_CONFIG_ONLY_MIN_SIZE = 64 * 2**20  # "config_only" is skipped for templates smaller than this (in bytes), as a full copy is faster
+
 ## Output filename incrementation defaults
 INCREMENT_MAX_ATTEMPTS = 10000   # emergency break out of incrementation loop
+OUTFILE_RESERVED_POSTFIX = ".reserved"  # postfixed to the output file path for the placeholder reserving the output file name
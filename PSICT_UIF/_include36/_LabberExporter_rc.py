@@ -0,0 +1,17 @@
+## Resource file for LabberExporter and related classes
+
+## Labber 'Step items' field codes (for direct editing of the step config in the reference file)
+##  Only iterations which cannot be set through the Labber API (ie anything other than a single linear range) are written as step items.
+STEP_ITEM_RANGE_TYPES = {
+            "single": 0,      # Single
+            "start_stop": 1,  # Start - Stop
+            "center_span": 2, # Center - Span
+        }
+STEP_ITEM_STEP_TYPES = {
+            "fixed_step": 0,  # Fixed step
+            "n_pts": 1,       # Fixed # of pts
+        }
+STEP_ITEM_INTERP_TYPES = {
+            "linear": 0,      # Linear
+            "log": 1,         # Log
+        }
@@ -50,6 +50,15 @@ FULL_NAMES_PULSES = {
 ## all single-pulse parameter names (for checking validity etc)
 PULSE_PARAMS = [param for param_list in [NAME_PARAMS, PHYS_PARAMS, ORD_PARAMS, FULL_NAMES_PULSES.keys()] for param in param_list]
 
+## Pulse table columns (one per parameter; full names share the column of the corresponding shortcode)
+PULSE_TABLE_COLUMNS = [param for param_list in [NAME_PARAMS, PHYS_PARAMS, ORD_PARAMS] for param in param_list]
+PULSE_PARAM_COLUMNS = dict({param: param for param in PULSE_TABLE_COLUMNS}, **FULL_NAMES_PULSES)
+SHORT_NAMES_PULSES = {short_name: full_name for full_name, short_name in FULL_NAMES_PULSES.items()}
+## Pulse table column types; all other columns (eg name, time_reference, relative_to, output) hold arbitrary objects. Values which are not of the column type (eg IterationSpec objects) are held separately as objects.
+PULSE_TABLE_FLOAT_COLUMNS = ["a", "w", "v", "s", "DRAG", "b", "p", "f", "r", "d", "absolute_time", "time_offset"]
+PULSE_TABLE_INT_COLUMNS = ["pulse_number"]
+PULSE_TABLE_BOOL_COLUMNS = ["is_inverted", "is_measurement"]
+
 
 ## Overall pulse sequence parameters
 MAIN_PARAMS = [
@@ -74,6 +83,8 @@ PULSE_PARAM_DEFAULTS = {
             "is_inverted": False,
             "is_measurement": False,
         }
+## Parameters which affect the timing or ordering of the pulse sequence (or which parameters are set on a pulse); changes to any other parameters can be patched into an existing output sequence without a full re-conversion (see PulseSeqManager.convert_seq).
+TIMING_PARAMS = ["name", "w", "v", "s", "pulse_number", "time_reference", "absolute_time", "relative_to", "relative_marker", "time_offset", "is_inverted"]
 SQPG_CONSTS = {
             "end_buffer_time": 2e-6, # buffer time for end-of-sequence calculation inaccuracies due to potential iterations or relations
         }
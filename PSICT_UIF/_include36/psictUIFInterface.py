@@ -12,6 +12,7 @@ from datetime import datetime
 from PSICT_UIF._include36.FileManager import FileManager
 from PSICT_UIF._include36.PulseSeqManager import PulseSeqManager
 from PSICT_UIF._include36.LabberExporter import LabberExporter
+from PSICT_UIF._include36.StageProfiler import StageProfiler
 import PSICT_UIF._include36._LogLevels as LogLevels
 
 class psictUIFInterface:
@@ -40,12 +41,17 @@ class psictUIFInterface:
         self._script_inv = sys.argv[0]
         ## Add attributes
         self.is_SQPG_used = False
+        self.profile_results = {}  # stage timings and counters of the last measurement
+        self._profile_path = None  # JSON-lines file to which the profiling results are appended
         ## Add constituent objects
+        self.profiler = StageProfiler(parent_logger_name = self.logger.name)
         self.fileManager = FileManager(parent_logger_name = self.logger.name)
         self.pulseSeqManager = PulseSeqManager(parent_logger_name = self.logger.name)
         self.labberExporter = LabberExporter(parent_logger_name = self.logger.name)
         ## Add attributes for constituent objects
         self.fileManager.set_original_wd(self._original_wd, self._script_inv)
+        self.fileManager.profiler = self.profiler
+        self.labberExporter.profiler = self.profiler
         ## Assign config to delegates
         self.assign_config_to_delegates()
         ## Set worker status as standalone script by default
@@ -217,7 +223,26 @@ class psictUIFInterface:
 
         Wraps the FileManager.set_template_file method.
         '''
-        self.fileManager.set_template_file(template_dir, template_file)
+        with self.profiler.stage("set_template_file"):
+            self.fileManager.set_template_file(template_dir, template_file)
+
+    def set_reference_copy_strategies(self, strategies):
+        '''
+        Set the strategies used to copy the template file to the reference file, in the order in which they are tried. Must be called before set_template_file.
+
+        Wraps the FileManager.set_reference_copy_strategies method.
+        '''
+        self.fileManager.set_reference_copy_strategies(strategies)
+
+    def set_reference_cache(self, cache_dir, *, max_size = None):
+        '''
+        Use a cache directory of prepared reference files (with all direct hdf5 edits applied), with a maximum total size of max_size bytes. Must be called before set_template_file.
+
+        When the template file and all settings affecting the direct edits match a cached entry, the cached file is used as the reference file and the edits are not re-applied.
+
+        Wraps the FileManager.set_reference_cache method.
+        '''
+        self.fileManager.set_reference_cache(cache_dir, max_size = max_size)
 
     def set_output_file(self, output_dir, output_file):
         '''
@@ -259,6 +284,16 @@ class psictUIFInterface:
         ## Initialise MeasurementObject
         self.labberExporter.init_MeasurementObject(self.fileManager.reference_path, self.fileManager.output_path, auto_init = auto_init)
 
+    def set_api_backend(self, backend):
+        '''
+        Set the backend through which Labber API value updates are applied.
+
+        By default, updates are applied through the Labber MeasurementObject. Setting a backend which does not require a MeasurementObject (eg a RecordingBackend) allows the pre-processing to be run as a dry run without Labber.
+
+        Wraps the LabberExporter.set_api_backend method.
+        '''
+        self.labberExporter.set_api_backend(backend)
+
 
     # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
     ## Instrument parameter setting methods
@@ -298,6 +333,30 @@ class psictUIFInterface:
         ## Status message
         self.logger.debug('Instrument parameter API client values added.')
 
+    def set_client_readback(self, readback):
+        '''
+        Set whether string values set through the InstrumentClient interface are read back from the instrument for logging (disabled by default).
+
+        Wraps the LabberExporter.set_client_readback method.
+        '''
+        self.labberExporter.set_client_readback(readback)
+
+    def set_client_force_refresh(self, force_refresh):
+        '''
+        Set whether all InstrumentClient values are sent on each measurement, even if unchanged since they were last applied (disabled by default).
+
+        Wraps the LabberExporter.set_client_force_refresh method.
+        '''
+        self.labberExporter.set_client_force_refresh(force_refresh)
+
+    def set_client_max_workers(self, max_workers):
+        '''
+        Set the maximum number of instruments to which InstrumentClient values are applied concurrently (1 by default, ie one instrument at a time).
+
+        Wraps the LabberExporter.set_client_max_workers method.
+        '''
+        self.labberExporter.set_client_max_workers(max_workers)
+
     def set_instr_config_values(self, instr_config_values_dict, hardware_names, server_name = 'localhost'):
         '''
         Set values by directly editing the reference hdf5 file's 'Instrument config' attributes.
@@ -323,6 +382,8 @@ class psictUIFInterface:
         Set instrument parameters as (independent) iteration values.
 
         Iteration values are set as custom IterationSpec objects. They live within the same structure as the point values, and so overwrite any point values that were previously specified using the set_point_values method. As there is no simple way to implement general relationships amongst variables, all inter-pulse calculations carried out using IterationSpec objects will always take the maximal values in the iteration range.
+
+        Each iteration is specified as a [start, stop, n_pts] list, optionally with the spacing ("linear" or "log") as a fourth element. Explicit values can be given as a NumPy array, and sweeps made up of several ranges as a list of such range lists, eg [[0, 1e-6, 11], [1e-6, 1e-4, 21, "log"]]. Iterations other than a single linear range are written directly to the step items of the reference file.
         '''
         ## Status message
         self.logger.log(LogLevels.VERBOSE, "Adding iteration values for instrument parameters...")
@@ -368,9 +429,67 @@ class psictUIFInterface:
         ## Status message
         self.logger.debug("Channel relations added.")
 
+    def set_vectorized_conversion(self, vectorized):
+        '''
+        Set whether the pulse sequence conversion is carried out on arrays of the pulse parameters (False by default).
+
+        Sets the PulseSeqManager.vectorized_conversion attribute.
+        '''
+        self.pulseSeqManager.vectorized_conversion = bool(vectorized)
+
+    # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+    ## Profiling
+
+    def set_profile_file(self, profile_path):
+        '''
+        Append the profiling results of each measurement as a single JSON line to the file at profile_path (None to disable, the default).
+
+        The results are always available in the profile_results attribute after the measurement, and are logged at the VERBOSE level.
+        '''
+        self._profile_path = None if profile_path is None else os.path.abspath(profile_path)
+        self.logger.log(LogLevels.VERBOSE, 'Profiling results file set to: {}'.format(self._profile_path))
+
+    def record_profile(self):
+        '''
+        Store the profiling results (recorded since the last measurement) in the profile_results attribute, log them, and append them to the profiling results file (if set); the profiler is then reset for the next measurement.
+        '''
+        self.profile_results = self.profiler.get_results()
+        self.profiler.log_results()
+        if self._profile_path is not None:
+            self.profiler.append_results(self._profile_path, output_path = getattr(self.fileManager, 'output_path', None))
+        self.profiler.reset()
+
     # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
     ## Measurement
 
+    def process_pulse_sequence(self):
+        '''
+        Convert the pulse sequence (if SQPG is used), and transfer it along with its relations to the LabberExporter.
+
+        The iteration order is processed into full channel names in either case.
+        '''
+        ## Check if SPQG is being used
+        if self.is_SQPG_used:
+            ## Convert stored input pulse sequence to output pulse sequence
+            with self.profiler.stage("convert_seq"):
+                self.pulseSeqManager.convert_seq()
+            ## Transfer output pulse sequence and main SQPG params to LabberExporter
+            self.labberExporter.add_point_value_spec("SQPG", self.pulseSeqManager.get_main_params())
+            self.labberExporter.receive_pulse_sequence(self.pulseSeqManager.export_output())
+            ## Transfer pulse sequence relations to LabberExporter
+            self.labberExporter.receive_pulse_rels(*self.pulseSeqManager.export_relations())
+        else:
+            self.labberExporter.process_iteration_order()
+
+    def get_sweep_grid(self):
+        '''
+        Get a SweepGrid of all iteration values and channel relations set so far, without calling Labber or editing the reference file.
+
+        The pulse sequence is processed (see process_pulse_sequence) first. The converted output sequence is kept, so that a following perform_measurement does not convert the sequence again, unless the pulse specifications have since changed (in which case only the changes are patched in, where possible; see PulseSeqManager.convert_seq). The summarize method of the returned SweepGrid gives the total number of points, the estimated output file size, and the range of values of every swept and derived channel.
+        '''
+        self.process_pulse_sequence()
+        return self.labberExporter.get_sweep_grid()
+
     def perform_measurement(self, *, dry_run = False):
         '''
         Calls Labber to perform the measurement.
@@ -384,43 +503,62 @@ class psictUIFInterface:
 
         Following the pre-processing, Labber is called to carry out the measurement using the Labber MeasurementObject's performMeasurement() method.
 
+        The wall and CPU time of each of these stages (as well as of copying the template file, if this was done since the last measurement), and the numbers of hdf5 file opens, bytes copied, and InstrumentClient round trips, are recorded by the profiler and stored in the profile_results attribute after the measurement (see also set_profile_file).
+
         There are currently no post-measurement operations (beyond changing the working directory back to the original one, which is probably redundant anyway...)
         '''
-        ## Status message
-        self.logger.log(LogLevels.VERBOSE, "Carrying out measurement pre-processing...")
-        ##### Measurement pre-processing
-        ## Set ScriptTools executable path
-        self.fileManager.apply_labber_exe_path()
-        ## Initialise Labber MeasurementObject if not already done
-        self.init_MeasurementObject(auto_init = True)
-        ## Check if SPQG is being used
-        if self.is_SQPG_used:
-            ## Convert stored input pulse sequence to output pulse sequence
-            self.pulseSeqManager.convert_seq()
-            ## Transfer output pulse sequence and main SQPG params to LabberExporter
-            self.labberExporter.add_point_value_spec("SQPG", self.pulseSeqManager.get_main_params())
-            self.labberExporter.receive_pulse_sequence(self.pulseSeqManager.export_output())
-            ## Transfer pulse sequence relations to LabberExporter
-            self.labberExporter.receive_pulse_rels(*self.pulseSeqManager.export_relations())
-        else:
-            self.labberExporter.process_iteration_order()
-        ## Apply all parameters stored in LabberExporter
-        self.labberExporter.apply_all()
-        ## Copy script - carried out before measurement to allow editing the script file while the measurement is running in Labber
-        self.pre_measurement_copy()
-        ## Status message
-        self.logger.debug("Measurement pre-processing completed.")
-        #### End measurement pre-processing
-        ## Status message
-        self.logger.log(LogLevels.SPECIAL, "Calling Labber to perform measurement...")
-        ## Call Labber to perform measurement
-        if self.MeasurementObject is not None:
+        try:
+            ## Status message
+            self.logger.log(LogLevels.VERBOSE, "Carrying out measurement pre-processing...")
+            ##### Measurement pre-processing
+            if self.labberExporter.requires_MeasurementObject():
+                ## Set ScriptTools executable path
+                with self.profiler.stage("apply_labber_exe_path"):
+                    self.fileManager.apply_labber_exe_path()
+                ## Initialise Labber MeasurementObject if not already done
+                with self.profiler.stage("init_MeasurementObject"):
+                    self.init_MeasurementObject(auto_init = True)
+            else:
+                ## API backend does not use Labber; only the reference file is required
+                self.labberExporter.set_reference_path(self.fileManager.reference_path)
+            ## Convert pulse sequence and transfer to LabberExporter
+            with self.profiler.stage("process_pulse_sequence"):
+                self.process_pulse_sequence()
+            ## Apply all parameters stored in LabberExporter
+            if self.fileManager.referenceCache is None:
+                with self.profiler.stage("apply_all"):
+                    self.labberExporter.apply_all()
+            else:
+                ## Start from a cached reference file if one exists for the current settings
+                with self.profiler.stage("prepare_reference_file"):
+                    is_cached = self.fileManager.prepare_reference_file(self.labberExporter.get_reference_state_hash())
+                with self.profiler.stage("apply_all"):
+                    self.labberExporter.apply_all(reference_edits = not is_cached)
+                if not is_cached:
+                    with self.profiler.stage("publish_reference_file"):
+                        self.fileManager.publish_reference_file()
+            ## Copy script - carried out before measurement to allow editing the script file while the measurement is running in Labber
+            with self.profiler.stage("pre_measurement_copy"):
+                self.pre_measurement_copy()
+            ## Status message
+            self.logger.debug("Measurement pre-processing completed.")
+            #### End measurement pre-processing
+            ## Status message
+            self.logger.log(LogLevels.SPECIAL, "Calling Labber to perform measurement...")
+            ## Call Labber to perform measurement
             if dry_run:  # allows debugging w/o a Labber license
                 self.logger.warning("Measurement dry run; skipping actual measurement...")
-            else:        # actually perform measurement
-                self.MeasurementObject.performMeasurement()
-        else:
-            raise RuntimeError("MeasurementObject has not been set!")
+            elif self.MeasurementObject is not None:
+                ## Actually perform measurement
+                with self.profiler.stage("performMeasurement"):
+                    self.MeasurementObject.performMeasurement()
+            else:
+                raise RuntimeError("MeasurementObject has not been set!")
+        finally:
+            ## Release the output file name reservation, whether or not the measurement succeeded (the output file exists if it did)
+            self.fileManager.release_output_file()
+        ## Store, log, and (optionally) save profiling results
+        self.record_profile()
         ## Status message
         self.logger.log(LogLevels.SPECIAL, "Measurement completed.")
         ## Change working directory back to original - this is here so Dany will be happy (it also exists in the destructor, but that is not run until ipython exits!)
@@ -5,10 +5,17 @@ import numpy as np
 
 import os
 import logging
+import tempfile
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 from PSICT_MultiPulse_tools import delistifyPulseDefs
-from waveforms_handling import generatePulse, calculateWaveform, gen_pulse_sequence
+from waveforms_handling import generatePulse, generatePulseIQ, calculateWaveform, gen_pulse_sequence
+from waveforms_handling import WAVEFORM_PARAMETERS, getWaveformKey, generateSequenceWaveforms
+from waveforms_store import WaveformStore, storeSequenceWaveforms
 
 
 class Driver(InstrumentDriver.InstrumentWorker):
@@ -28,6 +35,18 @@ class Driver(InstrumentDriver.InstrumentWorker):
         self.lDefKeyOrder = []
         self.lPulseDefinitions = []
         self.lPulseSequences = []
+        ## Cache of pulse envelopes and DRAG terms, keyed by pulse definition index and waveform parameters
+        self.dEnvelopeCache = {}
+        ## Precomputed waveforms (least-recently-used first), keyed by sequence index and waveform parameters
+        self.oWaveformCache = OrderedDict()
+        self.iWaveformCacheSize = 0
+        ## Waveforms being precomputed in the process pool, keyed as in the waveform cache
+        self.dPendingWaveforms = {}
+        self.oWaveformLock = threading.Lock()
+        self.oPrecomputeExecutor = None
+        ## On-disk waveform store, and the parameters for which it is valid
+        self.oWaveformStore = None
+        self.tWaveformStoreParams = None
         ## Log completion of opening operation
         self._logger.info('Instrument opened successfully.')
 
@@ -67,6 +86,11 @@ class Driver(InstrumentDriver.InstrumentWorker):
                 ## Parse raw pulse definitions
                 self.lPulseDefinitions = delistifyPulseDefs(lRawPulseDefinitions, self.lDefKeyOrder)
                 self._logger.debug('Pulse definitions: {}'.format(self.lPulseDefinitions))
+                ## Cached envelopes are keyed by definition index, so are no longer valid
+                self.dEnvelopeCache.clear()
+                self.clearWaveformCache()
+                if self.getValue('Precompute sequences'):
+                    self.startPrecompute()
         elif quant.name == 'Pulse sequences file':
             ## Only fetch if input string is not empty
             if value is not '':
@@ -76,6 +100,19 @@ class Driver(InstrumentDriver.InstrumentWorker):
                     self.lPulseSequences = [[int(yy) for yy in xx.strip().split(',')] \
                                                  for xx in psfile.readlines()]
                 self._logger.debug('Imported pulse sequences: {}'.format(self.lPulseSequences))
+                ## Precomputed waveforms are keyed by sequence index, so are no longer valid
+                self.clearWaveformCache()
+                if self.getValue('Precompute sequences'):
+                    self.startPrecompute()
+        elif quant.name in ['Use waveform store', 'Store waveforms as float32', 'Waveform store directory']:
+            ## Stored waveforms are no longer valid
+            if value != self.getValue(quant.name):
+                self.clearWaveformCache()
+        elif quant.name == 'Precompute sequences':
+            if value and not self.getValue('Precompute sequences'):
+                self.startPrecompute()
+            elif not value and not self.getValue('Use waveform store'):
+                self.clearWaveformCache()
         ## Return value, regardless of quant
         return value
 
@@ -87,14 +124,14 @@ class Driver(InstrumentDriver.InstrumentWorker):
         if quant.name[:5] == 'Trace':
             ## Recalculate waveform if necessary
             if self.isConfigUpdated():
-                self.calculateWaveform()
+                self.updateWaveform()
             vData = self.getWaveformFromMemory(quant)
             dt = 1/self.getValue('Sample rate')
             value = quant.getTraceDict(vData, dt=dt)
         elif quant.name[:10] == 'Quadrature':
             ## Recalculate waveform if necessary
             if self.isConfigUpdated():
-                self.calculateWaveform()
+                self.updateWaveform()
             vData = self.getWaveformFromMemory(quant)
             dt = 1/self.getValue('Sample rate')
             value = quant.getTraceDict(vData, dt=dt)
@@ -105,8 +142,203 @@ class Driver(InstrumentDriver.InstrumentWorker):
         self._logger.debug('GetValue: {} {} {}'.format(quant.name, value, type(value)))
         return value
 
+    def performClose(self, bError = False, options = {}):
+        '''Close the instrument connection'''
+        self.clearWaveformCache()
+        if self.oPrecomputeExecutor is not None:
+            self.oPrecomputeExecutor.shutdown(wait = False)
+            self.oPrecomputeExecutor = None
+
+    def updateWaveform(self):
+        '''
+        Update the waveforms for the current 'Pulse sequence counter' value, using the precomputed or stored waveforms if enabled
+        '''
+        bPrecompute = self.getValue('Precompute sequences')
+        if not (bPrecompute or self.getValue('Use waveform store')) or self.lPulseSequences == []:
+            self.calculateWaveform()
+            return
+        dValues = {sKey: self.getValue(sKey) for sKey in WAVEFORM_PARAMETERS}
+        tKey = getWaveformKey(self.getValue('Pulse sequence counter'), dValues)
+        oStore = self.updateWaveformStore(dValues)
+        oWaveforms = self.getPrecomputedWaveform(tKey)
+        if oWaveforms is None:
+            ## Not (yet) precomputed for the current waveform parameters
+            self._logger.info('Waveform for sequence {} not precomputed'.format(tKey[0]))
+            self.calculateWaveform()
+            self.storeWaveform(tKey, (self.lWaveforms, self.lQuadratures, self.getValue('Number of points')))
+            ## Use stored waveforms, so that they are always of the same precision
+            if oStore is not None:
+                self.lWaveforms, self.lQuadratures, _ = oStore.read(tKey[0])
+            if bPrecompute:
+                self.startPrecompute()
+            return
+        self._logger.info('Using precomputed waveform for sequence {}'.format(tKey[0]))
+        self.lWaveforms, self.lQuadratures, dNPoints = oWaveforms
+        ## Keep the following sequences precomputed if not all of them fit in the cache
+        if bPrecompute and oStore is None and 0 < self.iWaveformCacheSize < len(self.lPulseSequences):
+            self.startPrecompute()
+        if not self.getValue('Use fixed number of points'):
+            self.setValue('Number of points', dNPoints)
+        self.vTime = np.arange(int(dNPoints), dtype=float)/self.getValue('Sample rate')
+
+    def startPrecompute(self):
+        '''
+        Start generating the waveforms of the pulse sequences in the process pool, for the current waveform parameters
+
+        If the waveform store is used, the waveforms of all sequences are written directly into the store by the process pool. Otherwise, all sequences are generated if they fit in the waveform cache; if not, only the sequences following the current 'Pulse sequence counter' value are generated, filling half of the cache so that they are not evicted before they are used. Sequences which are already precomputed (or pending) are skipped, and pending sequences for other waveform parameters are cancelled.
+        '''
+        if self.lPulseSequences == [] or self.lPulseDefinitions == []:
+            return
+        dValues = {sKey: self.getValue(sKey) for sKey in WAVEFORM_PARAMETERS}
+        iNWorkers = int(self.getValue('Precompute workers'))
+        self.iWaveformCacheSize = int(self.getValue('Waveform cache size'))
+        oStore = self.updateWaveformStore(dValues)
+        iNSeqs = len(self.lPulseSequences)
+        iStart = int(self.getValue('Pulse sequence counter'))
+        if oStore is None and 0 < self.iWaveformCacheSize < iNSeqs:
+            iNPrecompute = max(1, self.iWaveformCacheSize // 2)
+        else:
+            iNPrecompute = iNSeqs
+        lKeys = [getWaveformKey((iStart + iOffset) % iNSeqs, dValues) for iOffset in range(iNPrecompute)]
+        with self.oWaveformLock:
+            ## Drop pending sequences for outdated parameters
+            tParams = lKeys[0][1:]
+            lCancelled = [self.dPendingWaveforms.pop(tKey) for tKey in list(self.dPendingWaveforms) \
+                                                                if tKey[1:] != tParams]
+            lKeys = [tKey for tKey in lKeys if tKey not in self.oWaveformCache \
+                                                and tKey not in self.dPendingWaveforms \
+                                                and (oStore is None or not oStore.isWritten(tKey[0]))]
+        ## Cancelling runs the done callbacks, so must be done without holding the lock
+        for oFuture in lCancelled:
+            oFuture.cancel()
+        if lKeys == []:
+            return
+        self._logger.info('Precomputing {} pulse sequences...'.format(len(lKeys)))
+        try:
+            if self.oPrecomputeExecutor is None:
+                self.oPrecomputeExecutor = ProcessPoolExecutor(max_workers = iNWorkers if iNWorkers > 0 else None)
+            for tKey in lKeys:
+                if oStore is None:
+                    oFuture = self.oPrecomputeExecutor.submit(generateSequenceWaveforms, self.nTrace, \
+                                        self.lPulseDefinitions, self.lPulseSequences[tKey[0]], dValues)
+                else:
+                    oFuture = self.oPrecomputeExecutor.submit(storeSequenceWaveforms, oStore.sBasePath, tKey[0], \
+                                        self.nTrace, self.lPulseDefinitions, self.lPulseSequences[tKey[0]], dValues)
+                with self.oWaveformLock:
+                    self.dPendingWaveforms[tKey] = oFuture
+                oFuture.add_done_callback(lambda oFuture, tKey = tKey: self.collectWaveform(tKey, oFuture))
+        except Exception as oError:
+            ## Waveforms are still generated on demand if the process pool is not available
+            self._logger.warning('Unable to precompute pulse sequences: {}'.format(oError))
+
+    def collectWaveform(self, tKey, oFuture):
+        '''
+        Move a precomputed waveform from the pending futures into the waveform cache (called from the process pool)
+
+        Waveforms which were written into the waveform store by the process pool are left there.
+        '''
+        with self.oWaveformLock:
+            if self.dPendingWaveforms.get(tKey) is not oFuture:
+                ## Cancelled or cleared in the meantime
+                return
+            del self.dPendingWaveforms[tKey]
+        if oFuture.cancelled():
+            return
+        if oFuture.exception() is not None:
+            self._logger.warning('Precomputing sequence {} failed: {}'.format(tKey[0], oFuture.exception()))
+            return
+        if oFuture.result() is not None:
+            self.storeWaveform(tKey, oFuture.result())
+
+    def getPrecomputedWaveform(self, tKey):
+        '''
+        Get the precomputed waveform with the given key, waiting for it if it is already being generated
+
+        Returns None if the waveform is not cached or stored, and is either not pending or not yet started (in which case it is cancelled, as it is quicker to generate it on demand).
+        '''
+        oStore = self.oWaveformStore
+        if oStore is not None and oStore.isWritten(tKey[0]):
+            return oStore.read(tKey[0])
+        with self.oWaveformLock:
+            if tKey in self.oWaveformCache:
+                self.oWaveformCache.move_to_end(tKey)
+                return self.oWaveformCache[tKey]
+            oFuture = self.dPendingWaveforms.get(tKey)
+        if oFuture is None or oFuture.cancel():
+            return None
+        try:
+            oWaveforms = oFuture.result()
+        except Exception as oError:
+            self._logger.warning('Precomputing sequence {} failed: {}'.format(tKey[0], oError))
+            return None
+        if oWaveforms is None and oStore is not None and oStore.isWritten(tKey[0]):
+            return oStore.read(tKey[0])
+        return oWaveforms
+
+    def storeWaveform(self, tKey, oWaveforms):
+        '''
+        Store a waveform in the waveform store if used, or otherwise in the waveform cache, evicting the least recently used waveforms beyond 'Waveform cache size'
+        '''
+        if self.oWaveformStore is not None:
+            self.oWaveformStore.write(tKey[0], *oWaveforms)
+            return
+        with self.oWaveformLock:
+            self.oWaveformCache[tKey] = oWaveforms
+            self.oWaveformCache.move_to_end(tKey)
+            while 0 < self.iWaveformCacheSize < len(self.oWaveformCache):
+                self.oWaveformCache.popitem(last = False)
+
+    def clearWaveformCache(self):
+        '''
+        Clear all precomputed waveforms, cancelling any which are still pending, and deleting the waveform store
+        '''
+        with self.oWaveformLock:
+            lCancelled = list(self.dPendingWaveforms.values())
+            self.dPendingWaveforms.clear()
+            self.oWaveformCache.clear()
+        for oFuture in lCancelled:
+            oFuture.cancel()
+        if self.oWaveformStore is not None:
+            ## Current waveforms may be views onto the store, which would prevent its deletion
+            self.lWaveforms = [np.array(vData) for vData in self.lWaveforms]
+            self.lQuadratures = [np.array(vData) for vData in self.lQuadratures]
+            self.oWaveformStore.close(bDelete = True)
+            self.oWaveformStore = None
+            self.tWaveformStoreParams = None
+
+    def updateWaveformStore(self, dValues):
+        '''
+        Get the waveform store for the given waveform parameters, replacing the current store if they have changed
+
+        Returns None if the waveform store is not used. The store is held in memory-mapped files in 'Waveform store directory' (or the system temporary directory if not set), which are deleted when the store is replaced or cleared.
+        '''
+        if not self.getValue('Use waveform store'):
+            if self.oWaveformStore is not None:
+                self.clearWaveformCache()
+            return None
+        bFloat32 = self.getValue('Store waveforms as float32')
+        tStoreParams = (getWaveformKey(0, dValues)[1:], bFloat32, self.getValue('Waveform store directory'))
+        if self.oWaveformStore is not None and tStoreParams == self.tWaveformStoreParams:
+            return self.oWaveformStore
+        ## Stored waveforms are no longer valid
+        self.clearWaveformCache()
+        if dValues['Use fixed number of points']:
+            iNPoints = int(dValues['Number of points'])
+        else:
+            iNPoints = max(int(np.round(self.calculateTotalSeqTime(pulseSeq, dValues['Truncation range']) \
+                                            * dValues['Sample rate'])) for pulseSeq in self.lPulseSequences)
+        sDirectory = tStoreParams[2] if tStoreParams[2] != '' else tempfile.gettempdir()
+        ## Each store gets new files, so that pool processes never write into the files of a replaced store
+        sBasePath = os.path.join(sDirectory, 'MultiPulse_{}'.format(uuid.uuid4().hex))
+        self._logger.info('Creating waveform store for {} sequences of {} points: {}'.format(\
+                                len(self.lPulseSequences), iNPoints, sBasePath))
+        self.oWaveformStore = WaveformStore(sBasePath, len(self.lPulseSequences), self.nTrace, iNPoints, bFloat32)
+        self.tWaveformStoreParams = tStoreParams
+        return self.oWaveformStore
+
     def getWaveformFromMemory(self, quant):
         '''Return data from calculated waveforms'''
+        ## Waveforms read from the waveform store are views onto the memory-mapped file, so are not copied
         if quant.name[:5] == 'Trace':
             iDataIndex = int(quant.name[-1]) - 1
             self._logger.debug('Fetching waveform for output {}'.format(iDataIndex))
@@ -147,6 +379,7 @@ class Driver(InstrumentDriver.InstrumentWorker):
 
     calculateWaveform = calculateWaveform
     generatePulse = generatePulse
+    generatePulseIQ = generatePulseIQ
     gen_pulse_sequence = gen_pulse_sequence
 
 if __name__ == '__main__':
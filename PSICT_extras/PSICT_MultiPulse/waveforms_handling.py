@@ -2,6 +2,13 @@
 # -*- coding: utf-8 -*-
 from PSICT_MultiPulse_tools import delistifyPulseDefs
 import numpy as np
+import logging
+
+## Maximum number of envelopes kept in the envelope cache before it is cleared
+ENVELOPE_CACHE_MAX_SIZE = 10000
+## Number of points outside the truncation range used to compute the DRAG term accurately
+## I think 1 would be sufficient, nonetheless 3 is safer and not much slower
+DRAG_BLEED_POINTS = 3
 
 
 def calculateWaveform(self):
@@ -51,8 +58,7 @@ def calculateWaveform(self):
     if bReversed:
         pulseSeq = pulseSeq[::-1]
     ## Generate pulse sequence
-    self.lWaveforms, self.lQuadratures = gen_pulse_sequence(
-        self,
+    self.lWaveforms, self.lQuadratures = self.gen_pulse_sequence(
         self.nTrace,
         self.getValue('Number of points'),
         pulseSeq,
@@ -67,13 +73,126 @@ def calculateWaveform(self):
 
 
 def gen_pulse_sequence(self, nTrace, num_points, pulseSeq, vTime, dHeadTime, pulseDef, params_dict, bReversed):
+    '''
+    Generate the waveforms and quadratures for the given pulse sequence
+
+    The head times of all pulses are calculated at once (see calculateHeadTimes). All occurrences of each pulse definition are then generated together, and added onto the output with a scatter-add (see placePulseGroup). Occurrences which extend beyond the ends of the time vector are generated one at a time, as in gen_pulse_sequence_loop. The result agrees with gen_pulse_sequence_loop to within floating-point rounding, as overlapping pulses may be summed in a different order.
+    '''
+    ## Re-create waveforms with correct size
+    lWaveforms   = np.zeros((nTrace, int(num_points)), dtype=float)
+    lQuadratures = np.zeros((nTrace, int(num_points)), dtype=float)
+    if len(pulseSeq) == 0:
+        return lWaveforms, lQuadratures
+    ## Get head times of all pulses
+    vPulseSeq = np.asarray(pulseSeq, dtype=int)
+    vHeadTimes = calculateHeadTimes(self, vPulseSeq, dHeadTime, pulseDef, bReversed)
+    ## Get common params
+    deltaT = 1/self.getValue("Sample rate")
+    truncRange = params_dict['Truncation range']
+    bApplyDragToSquare = params_dict['Apply DRAG to square pulses']
+    for iPulseIndex in np.unique(vPulseSeq).tolist():
+        oPulseDef = pulseDef[iPulseIndex]
+        vAbsTimes = vHeadTimes[vPulseSeq == iPulseIndex]
+        ## Get definition params
+        dWidth = oPulseDef['w']
+        dPlateau = oPulseDef['v']
+        if params_dict['Use global DRAG']:
+            dDragScaling = params_dict['Global DRAG coefficient']
+        else:
+            dDragScaling = oPulseDef['DRAG']
+        dStd = dWidth / np.sqrt(2 * np.pi)
+        ## Get index range of each occurrence, as in getPulseEnvelope
+        t0 = vTime[0] - vAbsTimes
+        tmin = (-(dPlateau) - truncRange*dWidth + dWidth + dPlateau )/2 - t0
+        tmax = ( (dPlateau) + truncRange*dWidth + dWidth + dPlateau )/2 - t0
+        vImin = np.round(tmin/deltaT).astype(int)
+        vImax = np.round(tmax/deltaT).astype(int)
+        if (dStd > 0 or bApplyDragToSquare) and (dDragScaling!=0):
+            vImin -= DRAG_BLEED_POINTS
+            vImax += DRAG_BLEED_POINTS
+        ## Generate occurrences extending beyond the time vector one at a time
+        bInRange = (vImin >= 0) & (vImax < len(vTime))
+        iOutputIndex = int(oPulseDef['o']) - 1
+        for dAbsTime in vAbsTimes[~bInRange]:
+            vNewPulse, vNewPulseQuad = self.generatePulseIQ(vTime, dAbsTime, oPulseDef, params_dict, iDefIndex=iPulseIndex)
+            lWaveforms[iOutputIndex][vNewPulse['imin']:vNewPulse['imax']+1] += vNewPulse['pulse']
+            lQuadratures[iOutputIndex][vNewPulseQuad['imin']:vNewPulseQuad['imax']+1] += vNewPulseQuad['pulse']
+        ## Generate all other occurrences together, grouped by number of points
+        vNPoints = vImax - vImin + 1
+        for iNPoints in np.unique(vNPoints[bInRange]).tolist():
+            bGroup = bInRange & (vNPoints == iNPoints)
+            placePulseGroup(self, lWaveforms, lQuadratures, vTime, vAbsTimes[bGroup], vImin[bGroup], iNPoints, \
+                            oPulseDef, params_dict, iPulseIndex)
+    return lWaveforms, lQuadratures
+
+
+def placePulseGroup(self, lWaveforms, lQuadratures, vTime, vAbsTimes, vImin, iNPoints, oPulseDef, params_dict, iDefIndex=None):
+    '''
+    Generate all occurrences of a pulse with the given definition and head times vAbsTimes, and add them onto the waveforms and quadratures
+
+    All occurrences must span iNPoints points starting at the indices vImin (including the DRAG bleed points), within the time vector. Occurrences with the same sub-sample offset share their envelope (see getCachedEnvelope), and all occurrences are modulated as a single 2D array.
+    '''
+    ## Get definition params
+    dWidth = oPulseDef['w']
+    dPlateau = oPulseDef['v']
+    deltaT = 1/self.getValue("Sample rate")
+    ## Get (rounded) times of all occurrences, as in getPulseEnvelope
+    vIndices = vImin[:, None] + np.arange(iNPoints)
+    vShiftedTimes = vTime[vIndices] - (dWidth + dPlateau) / 2 - vAbsTimes[:, None]
+    vRelTimes = vShiftedTimes + (dWidth + dPlateau) / 2
+    vShiftedTimes = np.round(vShiftedTimes/deltaT)*deltaT
+    vRelTimes = np.round(vRelTimes/deltaT)*deltaT
+    ## Get envelope and DRAG term for each distinct sub-sample offset
+    ## Occurrences are grouped by their first shifted time, which fixes the offset unless the rounding is irregular
+    _, vFirstIndices, vEnvelopeIndices = np.unique(vShiftedTimes[:, 0], return_index=True, return_inverse=True)
+    vUniqueShiftedTimes = vShiftedTimes[vFirstIndices]
+    if not np.array_equal(vUniqueShiftedTimes[vEnvelopeIndices.reshape(-1)], vShiftedTimes):
+        vUniqueShiftedTimes, vEnvelopeIndices = np.unique(vShiftedTimes, axis=0, return_inverse=True)
+    lEnvelopes = [getCachedEnvelope(self, vUniqueTimes, deltaT, oPulseDef, params_dict, iDefIndex) \
+                        for vUniqueTimes in vUniqueShiftedTimes]
+    vEnvelopeIndices = vEnvelopeIndices.reshape(-1)
+    vPulse = np.array([tEnvelope[0] for tEnvelope in lEnvelopes])[vEnvelopeIndices]
+    vDrag = np.array([tEnvelope[1] for tEnvelope in lEnvelopes])[vEnvelopeIndices]
+    ## Remove DRAG bleed points
+    iBleed = (iNPoints - vPulse.shape[1]) // 2
+    if iBleed > 0:
+        vRelTimes = vRelTimes[:, iBleed:-iBleed]
+        vIndices = vIndices[:, iBleed:-iBleed]
+    ## Apply modulation
+    if not oPulseDef['fix_phase']:
+        vRelTimes = vRelTimes + vAbsTimes[:, None]
+    vPulseMod, vPulseModQuad = modulatePulseIQ(vPulse, vDrag, vRelTimes, oPulseDef)
+    ## Add all occurrences onto output; occurrences may overlap
+    iOutputIndex = int(oPulseDef['o']) - 1
+    np.add.at(lWaveforms[iOutputIndex], vIndices, vPulseMod)
+    np.add.at(lQuadratures[iOutputIndex], vIndices, vPulseModQuad)
+
+
+def calculateHeadTimes(self, pulseSeq, dHeadTime, pulseDef, bReversed=False):
+    '''
+    Calculate the head times of all pulses in the sequence at once, as a cumulative sum over the pulse lengths
+
+    Equivalent to successive calls to updateHeadTime (including the order of the additions). If bReversed, the sequence must already be reversed, with dHeadTime the head time of the final pulse.
+    '''
+    ## Get edge-to-edge length of each pulse (including spacing)
+    vDefLengths = np.array([oPulseDef['w'] + oPulseDef['v'] + oPulseDef['s'] for oPulseDef in pulseDef])
+    vPulseLengths = vDefLengths[np.asarray(pulseSeq, dtype=int)]
+    ## Each head time follows from the previous one by the length of the previous (or, if reversed, the current) pulse
+    if bReversed:
+        vSteps = -vPulseLengths[1:]
+    else:
+        vSteps = vPulseLengths[:-1]
+    return np.cumsum(np.concatenate(([dHeadTime], vSteps)))
+
+
+# Pulse-by-pulse generation, kept for comparison testing
+def gen_pulse_sequence_loop(self, nTrace, num_points, pulseSeq, vTime, dHeadTime, pulseDef, params_dict, bReversed):
     ## Re-create waveforms with correct size
     lWaveforms   = np.zeros((nTrace, int(num_points)), dtype=float)
     lQuadratures = np.zeros((nTrace, int(num_points)), dtype=float)
     for iPulse, iPulseIndex in enumerate(pulseSeq):
         ## Generate pulse
-        vNewPulse = self.generatePulse(vTime, dHeadTime, pulseDef[iPulseIndex], params_dict)
-        vNewPulseQuad = self.generatePulse(vTime, dHeadTime, pulseDef[iPulseIndex], params_dict, genQuadrature=True)
+        vNewPulse, vNewPulseQuad = self.generatePulseIQ(vTime, dHeadTime, pulseDef[iPulseIndex], params_dict, iDefIndex=iPulseIndex)
         ## Add new pulse to waveform at index
         iOutputIndex = int(pulseDef[iPulseIndex]['o']) - 1
         lWaveforms[iOutputIndex][vNewPulse['imin']:vNewPulse['imax']+1] += vNewPulse['pulse']
@@ -109,11 +228,80 @@ def calculateTotalSeqTime(self, pulseSeq, truncRange):
     return totalTime
 
 
-def generatePulse(self, vTimes, dAbsTime, oPulseDef, params_dict, genQuadrature=False):
+def generatePulse(self, vTimes, dAbsTime, oPulseDef, params_dict, genQuadrature=False, iDefIndex=None):
     '''
     Generate a pulse with the given definition
 
     NB times are specified relative to the start point (ie the leading-edge FWHM point), and so can be negative!
+
+    If the index of the pulse definition is given as iDefIndex, the envelope and DRAG term are taken from (or stored in) the envelope cache (see getPulseEnvelope).
+    '''
+    ## Get envelope, DRAG term, and (rounded) times
+    oEnvelope = getPulseEnvelope(self, vTimes, dAbsTime, oPulseDef, params_dict, iDefIndex)
+    vPulse = oEnvelope['envelope']
+    vDrag = oEnvelope['drag']
+    vRelTimes = oEnvelope['times']
+
+    ## Get modulation parameters
+    freq = 2 * np.pi * oPulseDef['f']
+    phase = oPulseDef['p'] * np.pi/180
+    ## Apply modulation - check for fixed phase
+    function = np.cos if not genQuadrature else np.sin
+    if genQuadrature:
+        vPulse = vPulse * oPulseDef['r']
+        phase += oPulseDef['d']* np.pi/180
+    if oPulseDef['fix_phase']:
+        vPulseMod = vPulse * (function(freq*vRelTimes - phase)) - vDrag * (function(freq*vRelTimes - phase + np.pi/2))
+    else:
+        vPulseMod = vPulse * (function(freq*(vRelTimes+dAbsTime) - phase)) - vDrag * (function(freq*(vRelTimes+dAbsTime) - phase + np.pi/2))
+    ## Return value
+    return dict(imin=oEnvelope['imin'], imax=oEnvelope['imax'], pulse=vPulseMod)
+
+
+def generatePulseIQ(self, vTimes, dAbsTime, oPulseDef, params_dict, iDefIndex=None):
+    '''
+    Generate both the in-phase and quadrature components of a pulse with the given definition
+
+    Equivalent to generatePulse with and without genQuadrature (up to floating-point rounding), but the time vectors, envelope, and DRAG term are only computed once, and the cos and sin of the modulation are taken from a single complex exponential. Returns the in-phase and quadrature pulses (as dicts, as for generatePulse).
+    '''
+    ## Get envelope, DRAG term, and (rounded) times
+    oEnvelope = getPulseEnvelope(self, vTimes, dAbsTime, oPulseDef, params_dict, iDefIndex)
+    vPulse = oEnvelope['envelope']
+    vDrag = oEnvelope['drag']
+    vRelTimes = oEnvelope['times']
+
+    ## Apply modulation - check for fixed phase
+    if not oPulseDef['fix_phase']:
+        vRelTimes = vRelTimes + dAbsTime
+    vPulseMod, vPulseModQuad = modulatePulseIQ(vPulse, vDrag, vRelTimes, oPulseDef)
+    ## Return values
+    return dict(imin=oEnvelope['imin'], imax=oEnvelope['imax'], pulse=vPulseMod), \
+           dict(imin=oEnvelope['imin'], imax=oEnvelope['imax'], pulse=vPulseModQuad)
+
+
+def modulatePulseIQ(vPulse, vDrag, vRelTimes, oPulseDef):
+    '''
+    Apply the modulation of the given pulse definition to the envelope and DRAG term, for both the in-phase and quadrature components
+
+    The cos and sin of the modulation are taken from a single complex exponential. The arrays can have any (matching) shape, eg a 2D array of several pulses.
+    '''
+    ## Get modulation parameters
+    freq = 2 * np.pi * oPulseDef['f']
+    phase = oPulseDef['p'] * np.pi/180
+    ## Modulation for both quadratures; the quadrature phase is offset by 'd'
+    vModulation = np.exp(1j*(freq*vRelTimes - phase))
+    vModulationQuad = vModulation * np.exp(-1j*oPulseDef['d']*np.pi/180)
+    ## cos(x + pi/2) = -sin(x) and sin(x + pi/2) = cos(x) for the DRAG term
+    vPulseMod = vPulse * vModulation.real + vDrag * vModulation.imag
+    vPulseModQuad = vPulse * oPulseDef['r'] * vModulationQuad.imag - vDrag * vModulationQuad.real
+    return vPulseMod, vPulseModQuad
+
+
+def getPulseEnvelope(self, vTimes, dAbsTime, oPulseDef, params_dict, iDefIndex=None):
+    '''
+    Get the envelope and DRAG term of a pulse with the given definition, along with the (rounded) times and index range of the pulse
+
+    If the index of the pulse definition is given as iDefIndex, the envelope and DRAG term are taken from (or stored in) the envelope cache self.dEnvelopeCache, so that they are only calculated once for each definition, global DRAG settings, sample rate, and sub-sample offset of the pulse. The cache must be cleared whenever the pulse definitions change.
     '''
     ## Get definition params
     dWidth = oPulseDef['w']
@@ -144,7 +332,7 @@ def generatePulse(self, vTimes, dAbsTime, oPulseDef, params_dict, genQuadrature=
     # We bleed outside of the truncation range to compute the Drag term accurately
     if (dStd > 0 or bApplyDragToSquare) and (dDragScaling!=0):
         # The extra points will be padded to 0 after the Drag term is computed
-        bleed_idx = 3   # I think 1 would be sufficient, nonetheless 3 is safer and not much slower
+        bleed_idx = DRAG_BLEED_POINTS
         imin -= bleed_idx
         imax += bleed_idx
 
@@ -155,6 +343,56 @@ def generatePulse(self, vTimes, dAbsTime, oPulseDef, params_dict, genQuadrature=
     vShiftedTimes = np.round(vShiftedTimes/deltaT)*deltaT
     vRelTimes = np.round(vRelTimes/deltaT)*deltaT
 
+    ## Get envelope and DRAG term, from the cache if possible
+    vPulse, vDrag = getCachedEnvelope(self, vShiftedTimes, deltaT, oPulseDef, params_dict, iDefIndex)
+    if (dStd > 0 or bApplyDragToSquare) and (dDragScaling!=0):
+        # We now respect the truncation range after the Drag term is computed
+        vRelTimes = vRelTimes[bleed_idx:-bleed_idx]
+        imin += bleed_idx
+        imax -= bleed_idx
+    ## Return values
+    return dict(imin=imin, imax=imax, times=vRelTimes, envelope=vPulse, drag=vDrag)
+
+
+def getCachedEnvelope(self, vShiftedTimes, deltaT, oPulseDef, params_dict, iDefIndex=None):
+    '''
+    Get the envelope and DRAG term of a pulse with the given definition over the given (rounded) shifted times, from the envelope cache if possible
+
+    The rounded shifted times are the sample grid relative to the pulse centre, ie they fix the sub-sample offset of the pulse. If iDefIndex is None, the envelope is always calculated, and is not cached.
+    '''
+    ## Get definition params
+    dPlateau = oPulseDef['v']
+    dAmp = oPulseDef['a']
+    dStd = oPulseDef['w'] / np.sqrt(2 * np.pi)
+    bUseGlobalDrag = params_dict['Use global DRAG']
+    if bUseGlobalDrag:
+        dDragScaling = params_dict['Global DRAG coefficient']
+    else:
+        dDragScaling = oPulseDef['DRAG']
+    bApplyDragToSquare = params_dict['Apply DRAG to square pulses']
+    ## Look up envelope in cache
+    if iDefIndex is not None:
+        tEnvelopeKey = (iDefIndex, bUseGlobalDrag, dDragScaling, bApplyDragToSquare, self.getValue('Sample rate'), params_dict['Truncation range'], vShiftedTimes.tobytes())
+        tEnvelope = self.dEnvelopeCache.get(tEnvelopeKey)
+    else:
+        tEnvelopeKey = None
+        tEnvelope = None
+    ## Calculate envelope if not cached
+    if tEnvelope is None:
+        tEnvelope = calculateEnvelope(self, vShiftedTimes, deltaT, dPlateau, dStd, dAmp, dDragScaling, bApplyDragToSquare)
+        if tEnvelopeKey is not None:
+            if len(self.dEnvelopeCache) >= ENVELOPE_CACHE_MAX_SIZE:
+                self.dEnvelopeCache.clear()
+            self.dEnvelopeCache[tEnvelopeKey] = tEnvelope
+    return tEnvelope
+
+
+def calculateEnvelope(self, vShiftedTimes, deltaT, dPlateau, dStd, dAmp, dDragScaling, bApplyDragToSquare):
+    '''
+    Calculate the (amplitude-scaled) envelope and DRAG term of a pulse over the given shifted times, within the truncation range
+
+    If the DRAG term is applied, vShiftedTimes must include the bleed points on either side of the truncation range. The returned arrays are read-only, as they may be shared through the envelope cache.
+    '''
     ## Generate envelope; algorithm copied from SQPG driver
     if dPlateau > 0:
         ## Start with plateau
@@ -181,28 +419,15 @@ def generatePulse(self, vTimes, dAbsTime, oPulseDef, params_dict, genQuadrature=
         # The Drag term will bleed outside of the truncation range, but the calculation will be accurate within it
         vDrag = dDragScaling * np.gradient(vPulse) * self.getValue('Sample rate')
         # We now respect the truncation range after the Drag term is computed
+        bleed_idx = DRAG_BLEED_POINTS
         vPulse = vPulse[bleed_idx:-bleed_idx]
         vDrag = vDrag[bleed_idx:-bleed_idx]
-        vRelTimes = vRelTimes[bleed_idx:-bleed_idx]
-        imin += bleed_idx
-        imax -= bleed_idx
     else:
         vDrag = np.zeros(vPulse.shape)
-
-    ## Get modulation parameters
-    freq = 2 * np.pi * oPulseDef['f']
-    phase = oPulseDef['p'] * np.pi/180
-    ## Apply modulation - check for fixed phase
-    function = np.cos if not genQuadrature else np.sin
-    if genQuadrature:
-        vPulse *= oPulseDef['r']
-        phase += oPulseDef['d']* np.pi/180
-    if oPulseDef['fix_phase']:
-        vPulseMod = vPulse * (function(freq*vRelTimes - phase)) - vDrag * (function(freq*vRelTimes - phase + np.pi/2))
-    else:
-        vPulseMod = vPulse * (function(freq*(vRelTimes+dAbsTime) - phase)) - vDrag * (function(freq*(vRelTimes+dAbsTime) - phase + np.pi/2))
-    ## Return value
-    return dict(imin=imin, imax=imax, pulse=vPulseMod)
+    ## Cached arrays must not be modified in place
+    vPulse.flags.writeable = False
+    vDrag.flags.writeable = False
+    return vPulse, vDrag
 
 
 # Legacy kept explicitly as-is for comparison testing
@@ -374,6 +599,90 @@ def updateHeadTime(self, dOldHeadTime, oPulseDef, bReversed = False):
         dNewHeadTime = dOldHeadTime + dPulseLength
     return dNewHeadTime
 
+# **************************************************************** #
+#
+#   Precomputation of whole pulse sequences (eg in a process pool)
+#
+# **************************************************************** #
+
+## Driver values which affect the generated waveforms (used to key precomputed waveforms)
+WAVEFORM_PARAMETERS = [
+    'Sample rate',
+    'Number of points',
+    'Use fixed number of points',
+    'Truncation range',
+    'First pulse delay',
+    'Generate from final pulse',
+    'Final pulse time',
+    'Use global DRAG',
+    'Global DRAG coefficient',
+    'Apply DRAG to square pulses',
+    'Correct nonlinearity',
+]
+
+
+def getWaveformKey(iSeqIndex, dValues):
+    '''
+    Get the key of the waveforms for the given sequence index and values of WAVEFORM_PARAMETERS
+
+    'Number of points' is only part of the key if 'Use fixed number of points' is set, as it is otherwise calculated from the sequence itself.
+    '''
+    bFixedPoints = dValues['Use fixed number of points']
+    return (int(iSeqIndex),) + tuple(dValues[sKey] for sKey in WAVEFORM_PARAMETERS \
+                                        if bFixedPoints or sKey != 'Number of points')
+
+
+class WaveformWorker():
+    '''
+    Stand-alone waveform generator, with the same interface to the waveform functions as the driver
+
+    Holds its own copy of the pulse definitions and of the values of WAVEFORM_PARAMETERS, so that waveforms can be generated outside of the driver process.
+    '''
+    def __init__(self, nTrace, lPulseDefinitions, dValues):
+        self._logger = logging.getLogger('MultiPulse.worker')
+        self.nTrace = nTrace
+        self.lPulseDefinitions = lPulseDefinitions
+        self.lPulseSequences = []
+        self.dEnvelopeCache = {}
+        self.values_dict = dict(dValues)
+        self.vTime = np.array([], dtype=float)
+
+    def getValue(self, key):
+        return self.values_dict[key]
+
+    def setValue(self, key, val):
+        self.values_dict[key] = val
+
+    calculateWaveform = calculateWaveform
+    calculateTotalSeqTime = calculateTotalSeqTime
+    generatePulse = generatePulse
+    generatePulseIQ = generatePulseIQ
+    gen_pulse_sequence = gen_pulse_sequence
+    updateHeadTime = updateHeadTime
+
+
+## Worker kept by each pool process, so that its envelope cache is re-used across sequences
+_oProcessWorker = None
+
+
+def generateSequenceWaveforms(nTrace, lPulseDefinitions, pulseSeq, dValues):
+    '''
+    Generate the waveforms and quadratures for a single pulse sequence, returning them with the number of points
+
+    Intended as the target function for a process pool; the worker (and its envelope cache) is re-used for as long as the pulse definitions do not change.
+    '''
+    global _oProcessWorker
+    if _oProcessWorker is None or _oProcessWorker.nTrace != nTrace \
+            or _oProcessWorker.lPulseDefinitions != lPulseDefinitions:
+        _oProcessWorker = WaveformWorker(nTrace, lPulseDefinitions, dValues)
+    else:
+        _oProcessWorker.values_dict = dict(dValues)
+    _oProcessWorker.lPulseSequences = [pulseSeq]
+    _oProcessWorker.setValue('Pulse sequence counter', 0)
+    _oProcessWorker.calculateWaveform()
+    return _oProcessWorker.lWaveforms, _oProcessWorker.lQuadratures, _oProcessWorker.getValue('Number of points')
+
+
 # **************************************************************** #
 #
 #   Follows testing code without any Labber dependencies
@@ -389,6 +698,7 @@ class test_self():
     def __init__(self, *args, **kwargs):
         self._logger = dummy_logger()
         self.nTrace = kwargs.get('nTrace', 4)
+        self.dEnvelopeCache = {}
         
         with open('waveforms_sequences.txt', 'r') as psfile:
             self.lPulseSequences = [[int(yy) for yy in xx.strip().split(',')] for xx in psfile.readlines()]
@@ -422,9 +732,34 @@ class test_self():
     calculateWaveform = calculateWaveform
     calculateTotalSeqTime = calculateTotalSeqTime
     generatePulse = generatePulse
+    generatePulseIQ = generatePulseIQ
+    gen_pulse_sequence = gen_pulse_sequence
     updateHeadTime = updateHeadTime
 
 
+class loop_self(test_self):
+    def __init__(self, *args, **kwargs):
+        test_self.__init__(self, *args, **kwargs)
+    gen_pulse_sequence = gen_pulse_sequence_loop
+
+
+class uncached_self(loop_self):
+    def __init__(self, *args, **kwargs):
+        loop_self.__init__(self, *args, **kwargs)
+    # Generate every pulse from scratch, ignoring the envelope cache
+    def generatePulseIQ(self, *args, **kwargs):
+        kwargs.pop('iDefIndex', None)
+        return generatePulseIQ(self, *args, **kwargs)
+
+
+class twopass_self(loop_self):
+    def __init__(self, *args, **kwargs):
+        loop_self.__init__(self, *args, **kwargs)
+    # Generate the in-phase and quadrature components with separate generatePulse calls
+    def generatePulseIQ(self, *args, **kwargs):
+        return self.generatePulse(*args, **kwargs), self.generatePulse(*args, genQuadrature=True, **kwargs)
+
+
 class legacy_self(test_self):
     def __init__(self, *args, **kwargs):
         test_self.__init__(self, *args, **kwargs)
@@ -432,8 +767,65 @@ class legacy_self(test_self):
     calculateWaveform = calculateWaveform_legacy
 
 
+## Number of repeats of each timed calculation in test(); the best time is reported
+N_TEST_REPEATS = 10
+## Lengths of the additional [2, 3, 2, 3, ..., 0, 1] sequences used to time the pulse placement in test()
+LONG_SEQUENCE_PULSES = [400, 4000]
+## Tolerances of the comparisons in test(), as the maximum absolute difference relative to the peak of the reference waveforms
+## (the envelope cache must give bit-identical results)
+SINGLE_PASS_TOLERANCE = 1e-10   # the single pass takes the I and Q components from the same phase array, so rounding differs
+VECTORIZED_TOLERANCE = 1e-12    # overlapping pulses may be summed in a different order
+
+
+def timeCalculations(lSetups, nRepeats=N_TEST_REPEATS):
+    '''
+    Get the best time of calculateWaveform over nRepeats runs for each of a list of (fMakeSelf, bWarm) setups, along with the test object used for each
+
+    For a cold envelope cache, each run is carried out on a new object from fMakeSelf; if bWarm is set, the runs are instead repeated on a single object after an untimed run which fills the cache. The runs of the different setups are interleaved, so that they are compared under the same conditions. The logger output of the runs is suppressed.
+    '''
+    from timeit import default_timer
+    import contextlib
+    import io
+    lTimes = [[] for _ in lSetups]
+    lSelfs = [None for _ in lSetups]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for iSetup, (fMakeSelf, bWarm) in enumerate(lSetups):
+            if bWarm:
+                lSelfs[iSetup] = fMakeSelf()
+                lSelfs[iSetup].calculateWaveform()
+        for _ in range(nRepeats):
+            for iSetup, (fMakeSelf, bWarm) in enumerate(lSetups):
+                if not bWarm:
+                    lSelfs[iSetup] = fMakeSelf()
+                dStart = default_timer()
+                lSelfs[iSetup].calculateWaveform()
+                lTimes[iSetup].append(default_timer() - dStart)
+    return [(min(lSetupTimes), oSelf) for lSetupTimes, oSelf in zip(lTimes, lSelfs)]
+
+
+def getRelativeDifferences(oSelf, oReference):
+    '''
+    Get the maximum absolute differences of the waveforms and quadratures of oSelf from those of oReference, relative to the peak of the reference
+    '''
+    return [abs(np.asarray(mValues) - np.asarray(mReference)).max() / max(abs(np.asarray(mReference)).max(), np.finfo(float).tiny) \
+            for mValues, mReference in [(oSelf.lWaveforms, oReference.lWaveforms), (oSelf.lQuadratures, oReference.lQuadratures)]]
+
+
+def setLongSequence(oSelf, nPulses):
+    '''
+    Add a [2, 3, 2, 3, ..., 0, 1] pulse sequence of nPulses pulses to the test object, and select it (nothing is changed if nPulses is None)
+    '''
+    if nPulses is not None:
+        oSelf.lPulseSequences.append([2, 3] * (nPulses // 2) + [0, 1])
+        oSelf.values_dict['Pulse sequence counter'] = len(oSelf.lPulseSequences) - 1
+        oSelf.values_dict['Final pulse time'] = nPulses * 24e-9 + 1e-6
+        oSelf.values_dict['Number of points'] = int((nPulses * 24e-9 + 2e-6) * 1e9)
+    return oSelf
+
+
 def test():
     print("\nRunning TESTS!\n")
+    lFailures = []
     
     print("\nTEST: Creating test and legacy objects\n")
     test = test_self()
@@ -458,7 +850,72 @@ def test():
     if failed:
         print("  Signal Max Abs difference:          {:11.6g}".format(errs_max[0]))
         print("  Quadra Max Abs diffirence:          {:11.6g}".format(errs_max[1]))
-    
+
+    print("\nTEST: Calculating Waveforms pulse by pulse without envelope cache (best of {})".format(N_TEST_REPEATS))
+    print("TEST: Calculating Waveforms pulse by pulse with cold envelope cache (best of {})".format(N_TEST_REPEATS))
+    print("TEST: Calculating Waveforms pulse by pulse with warm envelope cache (best of {})\n".format(N_TEST_REPEATS))
+    (uncached_time, uncached), (cached_time, cached), (warm_time, _) = \
+            timeCalculations([(uncached_self, False), (loop_self, False), (loop_self, True)])
+
+    identical = np.array_equal(cached.lWaveforms, uncached.lWaveforms) and np.array_equal(cached.lQuadratures, uncached.lQuadratures)
+
+    print("\nEnvelope cache results:")
+    print("  uncached time:        {:11.6f} s".format(uncached_time))
+    print("  cold cache time:      {:11.6f} s".format(cached_time))
+    print("  warm cache time:      {:11.6f} s".format(warm_time))
+    print("  Speed increase (cold):{:11.6f} x".format(uncached_time/cached_time - 1))
+    print("  Speed increase (warm):{:11.6f} x".format(uncached_time/warm_time - 1))
+    ## The envelopes of a single sequence are already reused within a run, so a warm cache only saves computing these once
+    print("  Cached envelopes:     {:11d}".format(len(cached.dEnvelopeCache)))
+    print("  Bit-identical results:    ", identical)
+    if not identical:
+        lFailures.append("envelope cache: results are not bit-identical")
+
+    print("\nTEST: Calculating Waveforms with separate in-phase and quadrature passes (best of {})".format(N_TEST_REPEATS))
+    print("TEST: Calculating Waveforms in a single pass with cold envelope cache (best of {})\n".format(N_TEST_REPEATS))
+    (twopass_time, twopass), (singlepass_time, singlepass) = timeCalculations([(twopass_self, False), (loop_self, False)])
+
+    errs_max = [(abs(singlepass.lWaveforms-twopass.lWaveforms)).max(),(abs(singlepass.lQuadratures-twopass.lQuadratures)).max()]
+    errs_rel = getRelativeDifferences(singlepass, twopass)
+    if max(errs_rel) > SINGLE_PASS_TOLERANCE:
+        lFailures.append("single pass: relative difference {:.3g} exceeds {:.3g}".format(max(errs_rel), SINGLE_PASS_TOLERANCE))
+
+    print("\nSingle-pass I/Q results:")
+    print("  two-pass time:        {:11.6f} s".format(twopass_time))
+    print("  single-pass time:     {:11.6f} s".format(singlepass_time))
+    print("  Speed increase:       {:11.6f} x".format(twopass_time/singlepass_time - 1))
+    print("  Signal Max Abs difference:          {:11.6g}".format(errs_max[0]))
+    print("  Quadra Max Abs difference:          {:11.6g}".format(errs_max[1]))
+    print("  Max relative difference:            {:11.6g} (tolerance {:.3g})".format(max(errs_rel), SINGLE_PASS_TOLERANCE))
+
+    print("\nTEST: Calculating Waveforms with vectorized and pulse-by-pulse placement, warm envelope cache (best of {})\n".format(N_TEST_REPEATS))
+    lPlacementResults = []
+    for nPulses in [None] + LONG_SEQUENCE_PULSES:
+        (loop_time, loop), (vectorized_time, vectorized) = timeCalculations([ \
+                (lambda: setLongSequence(loop_self(), nPulses), True), \
+                (lambda: setLongSequence(test_self(), nPulses), True)])
+        errs_max = [(abs(vectorized.lWaveforms-loop.lWaveforms)).max(),(abs(vectorized.lQuadratures-loop.lQuadratures)).max()]
+        errs_rel = getRelativeDifferences(vectorized, loop)
+        sName = "sequence {}".format(loop.getValue('Pulse sequence counter')) if nPulses is None else "[2,3]*n, {} pulses".format(nPulses)
+        lPlacementResults.append((sName, loop_time, vectorized_time, errs_max, errs_rel))
+        if max(errs_rel) > VECTORIZED_TOLERANCE:
+            lFailures.append("vectorized placement, {}: relative difference {:.3g} exceeds {:.3g}".format(sName, max(errs_rel), VECTORIZED_TOLERANCE))
+
+    print("\nVectorized placement results:")
+    for sName, loop_time, vectorized_time, errs_max, errs_rel in lPlacementResults:
+        print("  {}:".format(sName))
+        print("    pulse-by-pulse time:  {:11.6f} s".format(loop_time))
+        print("    vectorized time:      {:11.6f} s".format(vectorized_time))
+        print("    Speed increase:       {:11.6f} x".format(loop_time/vectorized_time - 1))
+        print("    Signal Max Abs difference:          {:11.6g}".format(errs_max[0]))
+        print("    Quadra Max Abs difference:          {:11.6g}".format(errs_max[1]))
+        print("    Max relative difference:            {:11.6g} (tolerance {:.3g})".format(max(errs_rel), VECTORIZED_TOLERANCE))
+
+    ## The legacy comparison above is informational only; the optimized paths must match their references
+    if lFailures:
+        raise AssertionError("Waveform checks failed:\n  " + "\n  ".join(lFailures))
+    print("\nAll waveform checks passed.")
+
     return test, legacy
 
 
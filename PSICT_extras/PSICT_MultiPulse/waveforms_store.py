@@ -0,0 +1,87 @@
+#!/bin/python3
+# -*- coding: utf-8 -*-
+from waveforms_handling import generateSequenceWaveforms
+import numpy as np
+import os
+
+
+class WaveformStore():
+    '''
+    On-disk store of the waveforms and quadratures of all pulse sequences, indexed by sequence number
+
+    The waveforms of all sequences are held in a single memory-mapped .npy file of shape (sequences, 2, traces, points), stored as float64 or float32; sequences which are shorter than the number of points are padded with zeros. The number of points and a written flag for each sequence are held in separate .npy files; the flag is only set once the waveforms have been written, so that the store can be written from several processes at once.
+    '''
+    def __init__(self, sBasePath, nSeqs=None, nTrace=None, nPoints=None, bFloat32=False):
+        self.sBasePath = sBasePath
+        if nSeqs is None:
+            ## Open existing store for writing (eg in a process pool)
+            sMode = 'r+'
+            tShape = None
+            dtype = None
+        else:
+            ## Create new store, replacing any existing files
+            sMode = 'w+'
+            tShape = (int(nSeqs), 2, int(nTrace), int(nPoints))
+            dtype = np.float32 if bFloat32 else np.float64
+        self.mWaveforms = np.lib.format.open_memmap(sBasePath + '_waveforms.npy', mode=sMode, \
+                                                    dtype=dtype, shape=tShape)
+        tSeqShape = None if tShape is None else tShape[:1]
+        self.vPoints = np.lib.format.open_memmap(sBasePath + '_points.npy', mode=sMode, \
+                                                 dtype=None if tShape is None else np.int64, shape=tSeqShape)
+        self.vWritten = np.lib.format.open_memmap(sBasePath + '_written.npy', mode=sMode, \
+                                                  dtype=None if tShape is None else np.uint8, shape=tSeqShape)
+
+    def isWritten(self, iSeqIndex):
+        return bool(self.vWritten[iSeqIndex])
+
+    def write(self, iSeqIndex, lWaveforms, lQuadratures, dNPoints):
+        '''
+        Write the waveforms and quadratures of the given sequence, and mark it as written
+        '''
+        iNPoints = int(dNPoints)
+        self.mWaveforms[iSeqIndex, 0, :, :iNPoints] = lWaveforms
+        self.mWaveforms[iSeqIndex, 1, :, :iNPoints] = lQuadratures
+        self.vPoints[iSeqIndex] = iNPoints
+        ## Mappings of the same file are shared between processes, so no flush is needed before setting the flag
+        self.vWritten[iSeqIndex] = 1
+
+    def read(self, iSeqIndex):
+        '''
+        Get the waveforms and quadratures of the given sequence, with the number of points
+
+        The waveforms and quadratures are views onto the memory-mapped file, so no data is copied.
+        '''
+        iNPoints = int(self.vPoints[iSeqIndex])
+        return self.mWaveforms[iSeqIndex, 0, :, :iNPoints], self.mWaveforms[iSeqIndex, 1, :, :iNPoints], iNPoints
+
+    def close(self, bDelete=False):
+        '''
+        Close the store, optionally deleting its files
+
+        Files which are still mapped elsewhere (eg by views which are still in use) may not be deletable on all platforms; these are left in place.
+        '''
+        lPaths = [oArray.filename for oArray in (self.mWaveforms, self.vPoints, self.vWritten)]
+        self.mWaveforms = self.vPoints = self.vWritten = None
+        if bDelete:
+            for sPath in lPaths:
+                try:
+                    os.remove(sPath)
+                except OSError:
+                    pass
+
+
+## Store kept open by each pool process, so that it is not re-opened for every sequence
+_oProcessStore = None
+
+
+def storeSequenceWaveforms(sBasePath, iSeqIndex, nTrace, lPulseDefinitions, pulseSeq, dValues):
+    '''
+    Generate the waveforms and quadratures for a single pulse sequence, and write them into the waveform store at sBasePath
+
+    Intended as the target function for a process pool; nothing is returned, as the waveforms are passed back through the store.
+    '''
+    global _oProcessStore
+    lWaveforms, lQuadratures, dNPoints = generateSequenceWaveforms(nTrace, lPulseDefinitions, pulseSeq, dValues)
+    if _oProcessStore is None or _oProcessStore.sBasePath != sBasePath:
+        _oProcessStore = WaveformStore(sBasePath)
+    _oProcessStore.write(iSeqIndex, lWaveforms, lQuadratures, dNPoints)
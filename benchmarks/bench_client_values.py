@@ -0,0 +1,60 @@
+## Benchmark of LabberExporter.apply_client_values with concurrent instruments
+##  Applies InstrumentClient values to several instruments on a
+##  FakeInstrumentServer with a fixed latency per round trip, with different
+##  numbers of client workers, and checks that the values set on each
+##  instrument are the same in all cases. Runs without Labber.
+##
+##  Usage: python benchmarks/bench_client_values.py [n_instruments] [latency_ms]
+
+import os
+import sys
+import time
+import logging
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import numpy as np
+
+from PSICT_UIF._include36.LabberExporter import LabberExporter
+from PSICT_UIF._include36.InstrumentServerPool import InstrumentServerPool, FakeInstrumentServer
+
+WORKER_COUNTS = [1, 2, 4, 8]
+
+def run(max_workers, n_instruments, latency):
+    '''
+    Apply the client values with the given number of workers, and return the time taken, the write statistics, and the values set on each instrument.
+    '''
+    servers = []
+    def connect(server_name):
+        servers.append(FakeInstrumentServer(server_name, latency = latency))
+        return servers[-1]
+    exporter = LabberExporter()
+    exporter.set_server_pool(InstrumentServerPool(connect_function = connect))
+    exporter.set_client_max_workers(max_workers)
+    rnd = np.random.RandomState(0)
+    for index in range(n_instruments):
+        exporter.add_client_value_spec('AWG{}'.format(index), \
+                    {'Waveform': rnd.rand(1000), 'Mode': 'Triggered', 'Levels': [1.0, 2.0]}, 'Keysight')
+    start_time = time.perf_counter()
+    exporter.apply_client_values()
+    run_time = time.perf_counter() - start_time
+    values = {key: {param_name: np.asarray(value).tolist() for param_name, value in instrument.values.items()} \
+              for server in servers for key, instrument in server.instruments.items()}
+    return run_time, exporter.client_write_stats, values
+
+def main(n_instruments = 8, latency_ms = 20):
+    logging.disable(logging.WARNING)
+    latency = latency_ms/1000
+    print('{} instruments, {} ms per round trip'.format(n_instruments, latency_ms))
+    results = {max_workers: run(max_workers, n_instruments, latency) for max_workers in WORKER_COUNTS}
+    serial_time = results[1][0]
+    for max_workers, (run_time, write_stats, _) in results.items():
+        print('  {} worker(s): {:.3f} s ({:.1f}x), {} writes, {} round trips'.format( \
+                    max_workers, run_time, serial_time/run_time, write_stats['writes'], write_stats['round_trips']))
+    assert all(values == results[1][2] for _, _, values in results.values()), \
+                'Instrument values differ between worker counts'
+    print('  instrument values identical')
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,76 @@
+## Benchmark of the reference file copy strategies of FileManager
+##  Creates the reference file from synthetic templates with increasing
+##  amounts of stored data, using each of the copy strategies ("copy",
+##  "reflink", "config_only"), and checks that the copied configuration is
+##  the same. Reflink copies are only available on some filesystems (eg
+##  btrfs, xfs); the directory used can be set with the second argument.
+##
+##  Usage: python benchmarks/bench_copy_strategies.py [max_data_MB] [directory]
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, 'tests'))
+
+import h5py
+import numpy as np
+
+from PSICT_UIF._include36.FileManager import copy_reflink, copy_config_only
+from reference_file import make_reference_file
+
+COPY_FUNCTIONS = [('copy', shutil.copy), ('reflink', copy_reflink), ('config_only', copy_config_only)]
+DATA_SIZES_MB = [1, 10, 50, 200]
+
+def make_template(file_path, data_size_mb):
+    '''
+    Write a synthetic template file with data_size_mb MB of random stored data (and a small trace), and return its size in MB.
+    '''
+    make_reference_file(file_path, n_channels = 300, data_shape = (data_size_mb*2**20//8,))
+    with h5py.File(file_path, 'a') as config_file:
+        config_file['Data/Data'][:] = np.random.rand(len(config_file['Data/Data']))
+        config_file.create_dataset('Traces/Trace', data = np.random.rand(10))
+        config_file.attrs['creation_time'] = 1.0
+    return os.path.getsize(file_path)/2**20
+
+def read_config(file_path):
+    '''
+    Get the contents of the file which are kept by all copy strategies.
+    '''
+    with h5py.File(file_path, 'r') as config_file:
+        return config_file['Step list'][()].tolist(), sorted(config_file['Step config']), \
+               sorted(config_file['Instrument config']), dict(config_file.attrs)
+
+def main(max_data_mb = 200, directory = None):
+    logging.disable(logging.WARNING)
+    with tempfile.TemporaryDirectory(dir = directory) as temp_dir:
+        template_path = os.path.join(temp_dir, 'template.hdf5')
+        reference_path = os.path.join(temp_dir, 'reference.hdf5')
+        for data_size_mb in [size for size in DATA_SIZES_MB if size <= int(max_data_mb)]:
+            template_size = make_template(template_path, data_size_mb)
+            template_config = read_config(template_path)
+            results = []
+            for strategy, copy_function in COPY_FUNCTIONS:
+                start_time = time.perf_counter()
+                try:
+                    copy_function(template_path, reference_path)
+                except OSError as copy_error:
+                    results.append('{} n/a ({})'.format(strategy, copy_error.strerror or copy_error))
+                else:
+                    copy_time = time.perf_counter() - start_time
+                    assert read_config(reference_path) == template_config, \
+                                'Configuration differs after {} copy'.format(strategy)
+                    results.append('{} {:.3f} s ({:.1f} MB)'.format(strategy, copy_time, \
+                                                                  os.path.getsize(reference_path)/2**20))
+                if os.path.exists(reference_path):
+                    os.remove(reference_path)
+            print('{:6.1f} MB template: {}'.format(template_size, ' | '.join(results)))
+    print('copied configuration identical for all strategies')
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
@@ -0,0 +1,113 @@
+## Benchmark of the pulse sequence conversion on long sequences
+##  Converts random sequences of thousands of pulses (as generated
+##  programmatically, eg for randomized benchmarking) with PulseSeqManager,
+##  pulse by pulse and vectorized, and exports the output pulse parameters
+##  through LabberExporter.apply_api_values (into a RecordingBackend). Reports
+##  the best time of each stage and the memory held by the converted sequences.
+##  Runs without Labber.
+##
+##  Usage: python benchmarks/bench_pulse_conversion.py [n_pulses] [n_repeats]
+
+import os
+import sys
+import copy
+import time
+import types
+import random
+import logging
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from PSICT_UIF._include36.PulseSeqManager import PulseSeqManager
+from PSICT_UIF._include36.LabberExporter import LabberExporter
+from PSICT_UIF._include36.ApiUpdateBatch import RecordingBackend
+
+SCRIPT_RC = types.SimpleNamespace(parameter_pre_process = \
+                {'SQPG': {'pulse': {'o': {'XY': 1, 'Z': 2, 'Readout': 3}}}})
+
+def generate_sequence(n_pulses, seed = 0):
+    '''
+    Generate a random sequence spec of absolute, 'previous' and 'relative' pulses, with a few inverted pulses.
+    '''
+    rnd = random.Random(seed)
+    spec = {'main': {'Truncation range': 3, 'Sample rate': 1e9, 'sequence_duration': 1e-5}, \
+            'inverted': {'a': 0.5, 'o': 'Z'}}
+    names = ['p{}'.format(index) for index in range(n_pulses)]
+    for index, name in enumerate(names):
+        pulse_spec = {'a': rnd.random(), 'w': rnd.random()*1e-8, 'v': rnd.random()*1e-8, \
+                      'time_offset': rnd.random()*1e-8, 'pulse_number': index + 1, 'f': 1e8, \
+                      'o': rnd.choice(['XY', 'Z', 'Readout']), 'p': 0.0, 'DRAG': 0.0}
+        choice = rnd.random()
+        if index == 0 or choice < 0.1:
+            pulse_spec['time_reference'] = 'absolute'
+        elif choice < 0.55:
+            pulse_spec['time_reference'] = 'previous'
+        else:
+            pulse_spec['time_reference'] = 'relative'
+            pulse_spec['relative_to'] = names[rnd.randrange(index)]
+            pulse_spec['relative_marker'] = rnd.choice(['start', 'end'])
+        if rnd.random() < 0.05:
+            pulse_spec['is_inverted'] = True
+        spec[name] = pulse_spec
+    return spec
+
+def convert(spec, vectorized):
+    '''
+    Convert the spec, and return the time taken by each stage along with the PulseSeqManager.
+    '''
+    manager = PulseSeqManager()
+    manager.assign_script_rcmodule(SCRIPT_RC, None)
+    manager.set_input_pulse_seq(spec)
+    times = {}
+    start_time = time.perf_counter()
+    manager.build_input_pulse_seq()
+    times['build'] = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    if vectorized:
+        manager.convert_seq(vectorized = True)
+    else:
+        manager.convert_seq()
+    times['convert'] = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    exporter = LabberExporter()
+    backend = RecordingBackend()
+    exporter.set_api_backend(backend)
+    exporter.receive_pulse_sequence(manager.export_output())
+    exporter.apply_api_values(sort_iteration = False)
+    exported = backend.updates
+    times['export'] = time.perf_counter() - start_time
+    times['total'] = times['build'] + times['convert'] + times['export']
+    return times, manager, exported
+
+def main(n_pulses = 20000, n_repeats = 5):
+    logging.disable(logging.WARNING)
+    n_pulses, n_repeats = int(n_pulses), int(n_repeats)
+    spec = generate_sequence(n_pulses)
+    print('{} pulses (best of {})'.format(n_pulses, n_repeats))
+    results = {}
+    for vectorized in (False, True):
+        best_times = {}
+        for _ in range(n_repeats):
+            times, _, exported = convert(copy.deepcopy(spec), vectorized)
+            for stage, stage_time in times.items():
+                best_times[stage] = min(stage_time, best_times.get(stage, stage_time))
+        results[vectorized] = exported
+        print('  {:15s} build {:.3f} s  convert {:.3f} s  export {:.3f} s  total {:.3f} s'.format( \
+                    'vectorized:' if vectorized else 'pulse by pulse:', \
+                    best_times['build'], best_times['convert'], best_times['export'], best_times['total']))
+    assert results[False] == results[True], 'Vectorized and pulse-by-pulse outputs differ'
+    ## Memory held by the converted sequences
+    spec_copy = copy.deepcopy(spec)
+    tracemalloc.start()
+    _, manager, _ = convert(spec_copy, False)
+    ## Only count memory allocated by the pulse and pulse sequence modules
+    snapshot = tracemalloc.take_snapshot().filter_traces([ \
+                    tracemalloc.Filter(True, '*Pulse.py'), tracemalloc.Filter(True, '*PulseSequence.py')])
+    tracemalloc.stop()
+    memory = sum(stat.size for stat in snapshot.statistics('filename'))
+    print('  memory held by pulses after conversion: {:.1f} MB'.format(memory/2**20))
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
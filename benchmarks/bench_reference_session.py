@@ -0,0 +1,80 @@
+## Benchmark of the reference file edits in LabberExporter.apply_all
+##  Compares applying all direct edits in a single ReferenceFileSession with
+##  opening the reference file for each individual edit, on a synthetic
+##  reference file with several hundred step list entries. Runs without
+##  Labber (values set through the API are recorded by a RecordingBackend).
+##
+##  Usage: python benchmarks/bench_reference_session.py [n_channels] [n_repeats]
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, 'tests'))
+
+import h5py
+
+from PSICT_UIF._include36.LabberExporter import LabberExporter
+from PSICT_UIF._include36.ApiUpdateBatch import RecordingBackend
+from reference_file import make_reference_file
+
+def make_exporter(reference_path, labels):
+    '''
+    Set up a LabberExporter with point values, Instrument Config values, an iteration order, and relations on about 40 channels.
+    '''
+    n_channels = len(labels)
+    exporter = LabberExporter()
+    exporter.set_api_backend(RecordingBackend())
+    exporter.set_reference_path(reference_path)
+    exporter.add_point_value_spec('Instr0', {'Param0': 1.0})
+    exporter.add_instr_config_spec('Instr1', {'foo': 1.5, 'bar': 'baz'}, 'Driver1')
+    exporter.add_channel_defs({'Instr2': {'k{}'.format(index): 'Param{}'.format(index) for index in range(2, 12, 5)}})
+    exporter.set_channel_relations({'Instr3': {'Param{}'.format(index): 'k2 + 2*k7' \
+                                               for index in range(3, n_channels, max(n_channels // 40, 1))}})
+    exporter.set_iteration_order([labels[-1], labels[n_channels // 2], labels[5]])
+    return exporter
+
+def dump_reference(reference_path):
+    '''
+    Get the contents of the reference file which are edited by apply_all.
+    '''
+    with h5py.File(reference_path, 'r') as config_file:
+        step_list = config_file['Step list'][()].tolist()
+        relation_params = {label: config_file['Step config'][label]['Relation parameters'][()].tolist() \
+                           for label in config_file['Step config']}
+        instr_config = {instrument: dict(config_file['Instrument config'][instrument].attrs) \
+                        for instrument in config_file['Instrument config']}
+    return step_list, relation_params, instr_config
+
+def main(n_channels = 400, n_repeats = 5):
+    logging.disable(logging.WARNING)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        template_path = os.path.join(temp_dir, 'template.hdf5')
+        labels = make_reference_file(template_path, n_channels = n_channels)
+        times = {}
+        dumps = {}
+        for single_session in (False, True):
+            reference_path = os.path.join(temp_dir, 'reference_{}.hdf5'.format(int(single_session)))
+            run_times = []
+            for _ in range(n_repeats):
+                shutil.copy(template_path, reference_path)
+                exporter = make_exporter(reference_path, labels)
+                start_time = time.perf_counter()
+                exporter.apply_all(single_session = single_session)
+                run_times.append(time.perf_counter() - start_time)
+            times[single_session] = min(run_times)
+            dumps[single_session] = dump_reference(reference_path)
+        n_relations = len(make_exporter(template_path, labels)._channel_relations)
+    print('{} step list entries, {} relations (best of {})'.format(n_channels, n_relations, n_repeats))
+    print('  per-edit:       {:.3f} s'.format(times[False]))
+    print('  single session: {:.3f} s ({:.1f}x)'.format(times[True], times[False]/times[True]))
+    assert dumps[False] == dumps[True], 'Reference file contents differ between single-session and per-edit paths'
+    print('  reference file contents identical')
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,139 @@
+## Benchmark of the pulse timing resolution in InputPulseSeq
+##  Times get_sorted_list on random sequences of absolute, 'previous' and
+##  'relative' pulses (declared in shuffled order, so that references point
+##  forwards as well as backwards), with the timing resolved either as a
+##  dependency graph (resolve_timing_graph) or by the previous fixed-point
+##  loop over the pulse list, and checks that both give the same sorted pulses
+##  and absolute times. The errors raised for unresolvable sequences are
+##  printed for both.
+##
+##  Usage: python benchmarks/bench_timing_graph.py [max_pulses]
+
+import os
+import sys
+import copy
+import time
+import types
+import random
+import logging
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from PSICT_UIF._include36.PulseSequence import InputPulseSeq
+
+SEQUENCE_SIZES = [10, 100, 300, 1000]
+SCRIPT_RC = types.SimpleNamespace(parameter_pre_process = {})
+
+class FixedPointInputPulseSeq(InputPulseSeq):
+    '''
+    InputPulseSeq with the previous timing resolution: loop over the whole pulse list (stepping through the pulse numbers for 'previous' pulses) until all absolute times are valid.
+    '''
+    def resolve_timing_graph(self):
+        max_loop_counter = len(self.pulse_list)
+        loop_counter = 0
+        for pulse in self.pulse_list:
+            if "pulse_number" not in pulse.attributes:
+                pulse["pulse_number"] = -1
+        while not all([pulse.valid_abs_time for pulse in self.pulse_list]):
+            if loop_counter >= max_loop_counter:
+                raise RuntimeError("Could not calculate pulse timing; please re-check dependencies to ensure calculation is possible!")
+            max_pulse_number = max([pulse["pulse_number"] for pulse in self.pulse_list])
+            previous_pulse = None
+            for pulse_counter in range(max_pulse_number + 1):
+                current_pulse = next((pulse for pulse in self.pulse_list if pulse["pulse_number"] == pulse_counter), None)
+                if current_pulse is None:
+                    continue
+                if current_pulse["time_reference"] == "previous":
+                    if previous_pulse is None:
+                        raise RuntimeError("Cannot use 'previous' time reference for first numbered pulse")
+                    if not current_pulse.valid_abs_time:
+                        self.calculate_absolute_time(current_pulse, previous_pulse)
+                previous_pulse = current_pulse
+            for current_pulse in self.pulse_list:
+                if current_pulse["time_reference"] == "relative":
+                    try:
+                        ref_pulse_name = current_pulse["relative_to"]
+                    except KeyError:
+                        raise RuntimeError(" ".join([str(current_pulse), "has time_reference set as 'relative', but no reference pulse name is specified."]))
+                    try:
+                        ref_pulse = self[ref_pulse_name]
+                    except KeyError:
+                        raise RuntimeError(" ".join(["No pulse with name", ref_pulse_name, "exists."]))
+                    if not current_pulse.valid_abs_time:
+                        self.calculate_absolute_time(current_pulse, ref_pulse)
+            loop_counter = loop_counter + 1
+        for pulse in self.pulse_list:
+            if pulse["pulse_number"] == -1:
+                del pulse["pulse_number"]
+
+def generate_sequence(n_pulses, seed):
+    '''
+    Generate a random pulse sequence spec of absolute, 'previous' and 'relative' pulses, in shuffled order.
+    '''
+    rnd = random.Random(seed)
+    names = ['p{}'.format(index) for index in range(n_pulses)]
+    spec = {}
+    for index, name in enumerate(names):
+        pulse_spec = {'a': 1.0, 'w': rnd.random()*1e-8, 'v': rnd.random()*1e-8, \
+                      'time_offset': rnd.random()*1e-8, 'pulse_number': index + 1}
+        choice = rnd.random()
+        if index == 0 or choice < 0.1:
+            pulse_spec['time_reference'] = 'absolute'
+        elif choice < 0.55:
+            pulse_spec['time_reference'] = 'previous'
+        else:
+            pulse_spec['time_reference'] = 'relative'
+            pulse_spec['relative_to'] = names[rnd.randrange(index)]
+            pulse_spec['relative_marker'] = rnd.choice(['start', 'end'])
+        spec[name] = pulse_spec
+    items = list(spec.items())
+    rnd.shuffle(items)
+    return dict(items)
+
+def run(sequence_class, spec):
+    '''
+    Get the sorted pulse list for the spec, and return the time taken and the sorted (name, absolute_time) pairs.
+    '''
+    pulse_seq = sequence_class()
+    pulse_seq.assign_script_rcmodule(SCRIPT_RC, None)
+    pulse_seq.set_pulse_seq(copy.deepcopy(spec))
+    start_time = time.perf_counter()
+    sorted_pulses = pulse_seq.get_sorted_list()
+    run_time = time.perf_counter() - start_time
+    return run_time, [(pulse.name, pulse['absolute_time']) for pulse in sorted_pulses]
+
+def describe_error(sequence_class, spec):
+    try:
+        run(sequence_class, spec)
+    except Exception as error:
+        return '{}: {}'.format(type(error).__name__, error)
+    return 'no error'
+
+ERROR_CASES = [
+    ('cycle', {'a': {'time_reference': 'relative', 'relative_to': 'b', 'time_offset': 0}, \
+               'b': {'time_reference': 'relative', 'relative_to': 'a', 'time_offset': 0}, \
+               'c': {'time_reference': 'absolute', 'time_offset': 0}}),
+    ('previous on first pulse', {'a': {'time_reference': 'previous', 'pulse_number': 1, 'time_offset': 0}}),
+    ('previous without number', {'a': {'time_reference': 'previous', 'time_offset': 0}, \
+                                 'c': {'time_reference': 'absolute', 'time_offset': 0}}),
+    ('missing relative_to target', {'a': {'time_reference': 'relative', 'relative_to': 'zz', 'time_offset': 0}}),
+]
+
+def main(max_pulses = 1000):
+    logging.disable(logging.WARNING)
+    print('{:>7}  {:>12}  {:>12}'.format('pulses', 'fixed point', 'graph'))
+    for n_pulses in [size for size in SEQUENCE_SIZES if size <= int(max_pulses)]:
+        spec = generate_sequence(n_pulses, n_pulses)
+        fixed_point_time, fixed_point_result = run(FixedPointInputPulseSeq, spec)
+        graph_time, graph_result = min(run(InputPulseSeq, spec) for _ in range(5))
+        assert graph_result == fixed_point_result, 'Sorted pulses differ for {} pulses'.format(n_pulses)
+        print('{:>7}  {:>10.4f} s  {:>10.4f} s'.format(n_pulses, fixed_point_time, graph_time))
+    print('sorted pulses and absolute times identical')
+    for case_name, spec in ERROR_CASES:
+        print('{}:'.format(case_name))
+        print('  fixed point: {}'.format(describe_error(FixedPointInputPulseSeq, spec)))
+        print('  graph:       {}'.format(describe_error(InputPulseSeq, spec)))
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
@@ -0,0 +1,50 @@
+## Import time of PSICT_UIF, and check that Labber and h5py are imported lazily
+##  Each run imports PSICT_UIF in a fresh interpreter with -X importtime, and
+##  fails if Labber or h5py (or any of their submodules) have been imported.
+##
+##  Usage: python benchmarks/check_import_time.py [n_runs]
+
+import os
+import sys
+import statistics
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+## Modules which must only be imported when first used
+LAZY_MODULES = ['Labber', 'h5py']
+
+IMPORT_SCRIPT = '; '.join([
+    'import sys',
+    'import PSICT_UIF',
+    'loaded = sorted(set(name.split(".")[0] for name in sys.modules) & set({}))'.format(LAZY_MODULES),
+    'sys.exit("Imported with PSICT_UIF: " + ", ".join(loaded) if loaded else 0)',
+])
+
+def run_import():
+    '''
+    Import PSICT_UIF in a fresh interpreter, and return the cumulative import time (in us) reported by -X importtime.
+    '''
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')])))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', IMPORT_SCRIPT], env = env, \
+                            stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True)
+    import_lines = [line for line in result.stderr.splitlines() if line.startswith('import time:')]
+    other_lines = [line for line in result.stderr.splitlines() if not line.startswith('import time:')]
+    if result.returncode != 0:
+        raise AssertionError('\n'.join(other_lines))
+    for line in import_lines:
+        module_name = line.split('|')[-1].strip()
+        assert module_name.split('.')[0] not in LAZY_MODULES, 'Imported with PSICT_UIF: {}'.format(module_name)
+    for line in import_lines:
+        if line.split('|')[-1].strip() == 'PSICT_UIF':
+            return int(line.split('|')[1])
+    raise AssertionError('PSICT_UIF not found in -X importtime output')
+
+def main(n_runs = 21):
+    import_times = [run_import() for _ in range(n_runs)]
+    print('import PSICT_UIF: median {:.1f} ms over {} runs (min {:.1f} ms)'.format( \
+                statistics.median(import_times)/1000, n_runs, min(import_times)/1000))
+    print('{} not imported'.format(' and '.join(LAZY_MODULES)))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,10 @@
+## Test configuration for PSICT_UIF
+##  Makes the package importable from the repository root, without
+##  installing it (and without Labber).
+
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
@@ -0,0 +1,39 @@
+## Helpers for tests which use a psictUIFInterface
+##  The interface is created from the sample config file, with logging and
+##  script copying disabled. Labber is not required, as long as an API backend
+##  which does not use a MeasurementObject (eg a RecordingBackend) is set.
+
+import os
+import platform
+
+from PSICT_UIF._include36.psictUIFInterface import psictUIFInterface
+
+SAMPLE_CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sample', 'PSICT_config.py')
+
+def use_supported_system(monkeypatch):
+    '''
+    Make the FileManager identify the system as macOS, for which it has a default Labber executable path.
+    '''
+    monkeypatch.setattr(platform, 'system', lambda: 'Darwin')
+
+def make_config_file(dir_path):
+    '''
+    Write a copy of the sample config file (with logging and script copying disabled) to dir_path, and return its path.
+    '''
+    with open(SAMPLE_CONFIG_PATH) as sample_config:
+        config_source = sample_config.read()
+    config_source = "\n".join([config_source, \
+                               "logging_config['console_log_enabled'] = False", \
+                               "logging_config['file_log_enabled'] = False", \
+                               "script_copy_enabled = False", ""])
+    config_path = os.path.join(str(dir_path), 'PSICT_config.py')
+    with open(config_path, 'w') as config_file:
+        config_file.write(config_source)
+    return config_path
+
+def make_interface(dir_path, monkeypatch):
+    '''
+    Create a psictUIFInterface using a copy of the sample config file.
+    '''
+    use_supported_system(monkeypatch)
+    return psictUIFInterface(make_config_file(dir_path))
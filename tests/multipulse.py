@@ -0,0 +1,97 @@
+## Helpers for tests of the PSICT MultiPulse driver
+##  The driver modules import each other from their own directory (as they do
+##  when loaded by Labber), so this directory is added to the path. The driver
+##  itself is created on a minimal InstrumentWorker base class, which holds the
+##  quantity values in a dict initialised from the defaults in the driver .ini.
+
+import os
+import sys
+import types
+import logging
+import importlib
+import configparser
+
+import numpy as np
+
+MULTIPULSE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), \
+                              'PSICT_extras', 'PSICT_MultiPulse')
+if MULTIPULSE_DIR not in sys.path:
+    sys.path.insert(0, MULTIPULSE_DIR)
+
+DEFINITIONS_PATH = os.path.join(MULTIPULSE_DIR, 'waveforms_definitions.txt')
+SEQUENCES_PATH = os.path.join(MULTIPULSE_DIR, 'waveforms_sequences.txt')
+
+def get_default_values():
+    '''
+    Get the default values of all input quantities in the driver .ini file.
+    '''
+    config = configparser.ConfigParser()
+    config.read(os.path.join(MULTIPULSE_DIR, 'PSICT_MultiPulse.ini'))
+    default_values = {}
+    for quant_name in config.sections():
+        datatype = config[quant_name].get('datatype')
+        def_value = config[quant_name].get('def_value')
+        if datatype == 'DOUBLE':
+            default_values[quant_name] = float(def_value)
+        elif datatype == 'BOOLEAN':
+            default_values[quant_name] = def_value in ['True', '1']
+        elif datatype in ['PATH', 'STRING']:
+            default_values[quant_name] = '' if def_value is None else def_value
+    return default_values
+
+class InstrumentWorker:
+    '''
+    Minimal stand-in for the Labber InstrumentWorker, with quantity values held in a dict.
+    '''
+    def __init__(self):
+        self.values_dict = get_default_values()
+
+    def getValue(self, quant_name):
+        return self.values_dict[quant_name]
+
+    def setValue(self, quant_name, value):
+        self.values_dict[quant_name] = value
+
+    def isConfigUpdated(self):
+        return True
+
+class Quantity:
+    def __init__(self, name):
+        self.name = name
+
+def import_driver_module(monkeypatch):
+    '''
+    Import the PSICT_MultiPulse driver module on the minimal InstrumentWorker base class.
+    '''
+    instrument_driver = types.ModuleType('InstrumentDriver')
+    instrument_driver.InstrumentWorker = InstrumentWorker
+    monkeypatch.setitem(sys.modules, 'InstrumentDriver', instrument_driver)
+    monkeypatch.delitem(sys.modules, 'PSICT_MultiPulse', raising = False)
+    return importlib.import_module('PSICT_MultiPulse')
+
+def make_driver(monkeypatch, values = None):
+    '''
+    Create and open a MultiPulse driver (logging to the 'MultiPulse' logger only), with the given quantity values set before the pulse definitions and sequences files.
+    '''
+    driver_module = import_driver_module(monkeypatch)
+    monkeypatch.setattr(driver_module.Driver, 'initLogger', \
+                        lambda self: setattr(self, '_logger', logging.getLogger('MultiPulse')))
+    driver = driver_module.Driver()
+    driver.performOpen()
+    for quant_name, value in (values or {}).items():
+        set_value(driver, quant_name, value)
+    set_value(driver, 'Pulse definitions file', DEFINITIONS_PATH)
+    set_value(driver, 'Pulse sequences file', SEQUENCES_PATH)
+    return driver
+
+def set_value(driver, quant_name, value):
+    '''
+    Set a quantity value through the driver, as Labber does.
+    '''
+    driver.setValue(quant_name, driver.performSetValue(Quantity(quant_name), value))
+
+def get_waveforms(driver):
+    '''
+    Get copies of the current waveforms and quadratures of the driver, as arrays of shape (traces, points).
+    '''
+    return np.array(driver.lWaveforms), np.array(driver.lQuadratures)
@@ -0,0 +1,29 @@
+## Synthetic reference hdf5 files
+##  Builds a minimal Labber-style reference database (Step list, Step config
+##  relation parameters, Instrument config, and a data block), so that the
+##  reference file edits can be exercised without Labber.
+
+import h5py
+import numpy as np
+
+def make_reference_file(file_path, n_channels = 300, n_instruments = 5, data_shape = (1000, 100)):
+    '''
+    Write a synthetic reference file with n_channels step list entries spread over n_instruments instruments, and return the list of channel labels (in step list order).
+    '''
+    string_dtype = h5py.string_dtype()
+    step_list_dtype = np.dtype([('channel_name', string_dtype), ('step_unit', 'i4'), ('equation', string_dtype), \
+                                ('use_relations', '?'), ('show_advanced', '?')])
+    relation_params_dtype = np.dtype([('variable', string_dtype), ('channel_name', string_dtype), ('use_lookup', '?')])
+    labels = ['Instr{} - Param{}'.format(index % n_instruments, index) for index in range(n_channels)]
+    with h5py.File(file_path, 'w') as config_file:
+        config_file.create_dataset('Step list', data = np.array( \
+                    [(label, 0, 'x', False, False) for label in labels], dtype = step_list_dtype))
+        step_config = config_file.create_group('Step config')
+        for label in labels:
+            step_config.create_group(label).create_dataset('Relation parameters', \
+                    data = np.array([('x', label, False)], dtype = relation_params_dtype))
+        instrument_config = config_file.create_group('Instrument config')
+        for index in range(n_instruments):
+            instrument_config.create_group('Driver{0} - , Instr{0} at localhost'.format(index))
+        config_file.create_dataset('Data/Data', data = np.zeros(data_shape))
+    return labels
@@ -0,0 +1,88 @@
+## Batching of the Labber API value updates
+##  Only the last update to each channel and item type is applied, at the
+##  position of that last write; updates are queued by the exporter and only
+##  applied when the batch is flushed.
+
+import logging
+
+import numpy as np
+
+from PSICT_UIF._include36.ApiUpdateBatch import ApiUpdateBatch, RecordingBackend
+from PSICT_UIF._include36.LabberExporter import LabberExporter
+
+def test_dedupe_keeps_position_of_last_write():
+    batch = ApiUpdateBatch()
+    batch.add('A - x', 1.0)
+    batch.add('B - y', 0.0, 'START')
+    batch.add('B - y', 1.0, 'STOP')
+    batch.add('A - x', 2.0)
+    ## A different item type of the same channel is a separate update
+    batch.add('A - x', 5, 'N_PTS')
+    batch.add('B - y', 0.5, 'START')
+    assert len(batch) == 4
+    assert list(batch) == [('B - y', 1.0, 'STOP'), ('A - x', 2.0, 'SINGLE'), ('A - x', 5, 'N_PTS'), \
+                           ('B - y', 0.5, 'START')]
+
+def test_flush_applies_in_order_and_clears():
+    batch = ApiUpdateBatch()
+    backend = RecordingBackend()
+    batch.add('A - x', 1.0)
+    batch.add('B - y', 'on')
+    batch.add('A - x', 3.0)
+    assert batch.flush(backend) == 2
+    assert len(batch) == 0
+    assert backend.updates == [('B - y', 'on', 'SINGLE'), ('A - x', 3.0, 'SINGLE')]
+    ## Flushing an empty batch applies nothing
+    assert batch.flush(backend) == 0
+    assert len(backend.updates) == 2
+
+def test_recording_backend():
+    backend = RecordingBackend()
+    assert not backend.requires_MeasurementObject
+    backend.update_value('A - x', 1.0, 'SINGLE')
+    backend.update_value('A - x', 2.0, 'SINGLE')
+    backend.update_value('A - x', 11, 'N_PTS')
+    ## All updates are recorded, but only the last value is returned for each channel and item type
+    assert len(backend.updates) == 3
+    assert backend.get_values() == {('A - x', 'SINGLE'): 2.0, ('A - x', 'N_PTS'): 11}
+    backend.clear()
+    assert backend.updates == []
+    assert backend.get_values() == {}
+
+def test_exporter_queues_until_flushed():
+    exporter = LabberExporter()
+    backend = RecordingBackend()
+    exporter.set_api_backend(backend)
+    assert not exporter.requires_MeasurementObject()
+    exporter.update_api_value('A - x', 1.0)
+    exporter.add_iteration_spec('B', {'y': [0.0, 1.0, 11], 'z': np.array([0.1, 0.3])})
+    for param_name, param_value in exporter._api_values['B'].items():
+        exporter.update_api_value('B - ' + param_name, param_value)
+    exporter.update_api_value('A - x', 2.0)
+    assert backend.updates == []
+    exporter.apply_api_values(sort_iteration = False)
+    ## The stored values are queued again, and each update is applied once; the explicit-value iteration is not set through the API
+    assert backend.updates == [('A - x', 2.0, 'SINGLE'), ('B - y', 0.0, 'START'), ('B - y', 1.0, 'STOP'), \
+                               ('B - y', 11, 'N_PTS')]
+
+class CountingFormat:
+    '''
+    Value which counts how many times it is formatted.
+    '''
+    def __init__(self):
+        self.n_formatted = 0
+
+    def __format__(self, format_spec):
+        self.n_formatted += 1
+        return 'value'
+
+    def __str__(self):
+        return self.__format__('')
+
+def test_status_messages_formatted_lazily():
+    exporter = LabberExporter()
+    exporter.set_api_backend(RecordingBackend())
+    value = CountingFormat()
+    exporter.logger.setLevel(logging.INFO)
+    exporter.update_api_value('A - x', value)
+    assert value.n_formatted == 0
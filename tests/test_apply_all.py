@@ -0,0 +1,58 @@
+## Order of the Labber API updates and the direct reference file edits in apply_all
+##  The MeasurementObject writes Labber API updates to the reference file
+##  itself, so these must not be overwritten by the (buffered) direct edits.
+
+import h5py
+import pytest
+
+from PSICT_UIF._include36.LabberExporter import LabberExporter
+from PSICT_UIF._include36.ReferenceFileSession import decode_label
+
+from reference_file import make_reference_file
+
+class FileWritingBackend:
+    '''
+    Stand-in for the MeasurementObject backend, which writes each update to the 'Step list' of the reference file (as the equation of the channel entry).
+    '''
+    requires_MeasurementObject = False
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+    def update_value(self, target_string, value, item_type):
+        with h5py.File(self.file_path, 'r+') as config_file:
+            step_list = config_file['Step list'][()]
+            for entry in step_list:
+                if decode_label(entry['channel_name']) == target_string:
+                    entry['equation'] = '{} {}'.format(item_type, value)
+            config_file['Step list'][...] = step_list
+
+def read_step_list(file_path):
+    with h5py.File(file_path, 'r') as config_file:
+        return {decode_label(entry['channel_name']): decode_label(entry['equation']) \
+                    for entry in config_file['Step list'][()]}, \
+               [decode_label(entry['channel_name']) for entry in config_file['Step list'][()]]
+
+@pytest.mark.parametrize('single_session', [True, False])
+def test_api_updates_kept_with_direct_edits(tmp_path, single_session):
+    file_path = str(tmp_path / 'reference.hdf5')
+    labels = make_reference_file(file_path, n_channels = 10, n_instruments = 2, data_shape = (10, 10))
+    exporter = LabberExporter()
+    exporter.set_reference_path(file_path)
+    exporter.set_api_backend(FileWritingBackend(file_path))
+    exporter.add_point_value_spec('Instr0', {'Param2': 0.5})
+    exporter.add_iteration_spec('Instr1', {'Param3': [0.0, 1.0, 11]})
+    exporter._iteration_order = ['Instr1 - Param3', 'Instr0 - Param2']
+    exporter._instr_config_values = {'Instr0': {'Output': True}}
+    exporter._hardware_names = {'Instr0': 'Driver0'}
+    exporter.apply_all(single_session = single_session)
+    equations, step_list_labels = read_step_list(file_path)
+    ## API updates written by the backend
+    assert equations['Instr0 - Param2'] == 'SINGLE 0.5'
+    assert equations['Instr1 - Param3'] == 'N_PTS 11'
+    assert equations['Instr0 - Param4'] == 'x'
+    ## Direct edits
+    assert step_list_labels[:2] == ['Instr1 - Param3', 'Instr0 - Param2']
+    assert sorted(step_list_labels) == sorted(labels)
+    with h5py.File(file_path, 'r') as config_file:
+        assert config_file['Instrument config']['Driver0 - , Instr0 at localhost'].attrs['Output']
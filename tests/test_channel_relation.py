@@ -0,0 +1,54 @@
+## Compilation and evaluation of channel relation strings
+##  Python builtins used in relations must evaluate element-wise over arrays,
+##  as they would for each point of the sweep.
+
+import numpy as np
+import pytest
+
+from PSICT_UIF._include36.ChannelRelation import compile_relation
+from PSICT_UIF._include36._Common import extract_relation_variables
+
+def test_variables_exclude_functions_and_modules():
+    assert compile_relation('a*np.sin(b) + sqrt(a) - np.pi').variables == ['a', 'b']
+    assert extract_relation_variables('int(x)+1') == ['x']
+    assert extract_relation_variables('max(x, y) + min(y, z)') == ['x', 'y', 'z']
+
+def test_int():
+    relation = compile_relation('int(x)+1')
+    assert relation.evaluate({'x': 2.7}) == 3
+    assert relation.evaluate({'x': [2.7, -2.7, 4.0]}).tolist() == [3, -1, 5]
+
+def test_float():
+    relation = compile_relation('float(x)/2')
+    assert relation.evaluate({'x': 3}) == 1.5
+    assert relation.evaluate({'x': [1, 3]}).tolist() == [0.5, 1.5]
+
+@pytest.mark.parametrize('relation_string, expected', [
+    ('max(x, y)', [3, 5]),
+    ('min(x, y)', [1, 2]),
+    ('max(x, y, 4)', [4, 5]),
+    ('min(x, y, 2)', [1, 2]),
+])
+def test_max_min_element_wise(relation_string, expected):
+    assert compile_relation(relation_string).evaluate({'x': [1, 5], 'y': [3, 2]}).tolist() == expected
+
+def test_max_min_single_argument():
+    assert compile_relation('max(x)').evaluate({'x': [1, 5, 3]}) == 5
+    assert compile_relation('min(x)').evaluate({'x': [1, 5, 3]}) == 1
+
+def test_abs_round():
+    assert compile_relation('abs(x)').evaluate({'x': [-1.5, 2.0]}).tolist() == [1.5, 2.0]
+    assert compile_relation('round(x, 1)').evaluate({'x': [1.24, -1.26]}).tolist() == [1.2, -1.3]
+
+def test_numpy_functions():
+    relation = compile_relation('np.cos(x) + sin(x)')
+    assert np.allclose(relation.evaluate({'x': [0.0, np.pi/2]}), [1.0, 1.0])
+
+@pytest.mark.parametrize('relation_string', ['open(x)', 'eval(x)', 'foo(x)', 'x.__class__', '__import__(x)', 'x +'])
+def test_invalid_relations(relation_string):
+    with pytest.raises(ValueError):
+        compile_relation(relation_string)
+
+def test_missing_variables():
+    with pytest.raises(KeyError):
+        compile_relation('x + y').evaluate({'x': 1})
@@ -0,0 +1,71 @@
+## Output file names of the FileManager
+##  Existing output files are skipped by taking the next sequential id after
+##  the highest one in use, and the chosen name is reserved with a placeholder
+##  file until the measurement has been carried out (or has failed).
+
+import os
+
+import pytest
+
+from PSICT_UIF._include36.ApiUpdateBatch import RecordingBackend
+
+from interface import make_interface
+from reference_file import make_reference_file
+
+def touch(file_path):
+    with open(str(file_path), 'w'):
+        pass
+
+@pytest.fixture
+def interface(tmp_path, monkeypatch):
+    return make_interface(tmp_path, monkeypatch)
+
+def test_free_file_name_kept(interface, tmp_path):
+    output_dir = tmp_path / 'output'
+    interface.fileManager.set_output_file(str(output_dir), 'data_001')
+    assert interface.fileManager.output_file == 'data_001'
+    assert os.listdir(str(output_dir)) == ['data_001.hdf5.reserved']
+
+def test_next_index_after_highest_existing(interface, tmp_path):
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+    for file_name in ['data_001.hdf5', 'data_003.hdf5', 'data_004.hdf5.reserved', 'data_099.txt', 'other_007.hdf5']:
+        touch(output_dir / file_name)
+    interface.fileManager.set_output_file(str(output_dir), 'data_001')
+    ## data_002 is free, but lies below the highest id in use
+    assert interface.fileManager.output_file == 'data_005'
+    assert (output_dir / 'data_005.hdf5.reserved').exists()
+
+def test_next_free_filename(interface):
+    file_manager = interface.fileManager
+    existing_files = {'run9', 'run10', 'run_2', 'run'}
+    assert file_manager.get_next_free_filename('run1', existing_files) == 'run11'
+    assert file_manager.get_next_free_filename('run12', existing_files) == 'run13'
+    assert file_manager.get_next_free_filename('run001', set()) == 'run002'
+    with pytest.raises(RuntimeError):
+        file_manager.get_next_free_filename('run', existing_files)
+
+def test_reservation_released_after_measurement(interface, tmp_path):
+    output_dir = tmp_path / 'output'
+    interface.fileManager.set_output_file(str(output_dir), 'data_001')
+    interface.fileManager.reference_path = str(tmp_path / 'reference.hdf5')
+    make_reference_file(interface.fileManager.reference_path, n_channels = 10, data_shape = (10, 10))
+    interface.set_api_backend(RecordingBackend())
+    interface.perform_measurement(dry_run = True)
+    assert os.listdir(str(output_dir)) == []
+
+def test_reservation_released_when_measurement_fails(interface, tmp_path, monkeypatch):
+    output_dir = tmp_path / 'output'
+    interface.fileManager.set_output_file(str(output_dir), 'data_001')
+    interface.fileManager.reference_path = str(tmp_path / 'reference.hdf5')
+    interface.set_api_backend(RecordingBackend())
+    def fail():
+        raise RuntimeError('pre-processing failed')
+    monkeypatch.setattr(interface, 'process_pulse_sequence', fail)
+    with pytest.raises(RuntimeError, match = 'pre-processing failed'):
+        interface.perform_measurement(dry_run = True)
+    assert os.listdir(str(output_dir)) == []
+    ## The file name is free for the next script
+    next_interface = make_interface(tmp_path, monkeypatch)
+    next_interface.fileManager.set_output_file(str(output_dir), 'data_001')
+    assert next_interface.fileManager.output_file == 'data_001'
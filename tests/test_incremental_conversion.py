@@ -0,0 +1,161 @@
+## Incremental conversion of the input pulse sequence
+##  Changes to parameters which do not affect the pulse timing are patched into
+##  the existing output sequence; the result must be identical to a full
+##  conversion of the changed input sequence.
+
+import copy
+import types
+import logging
+
+import pytest
+
+from PSICT_UIF._include36.PulseSeqManager import PulseSeqManager
+from PSICT_UIF._include36.ParameterSpec import IterationSpec
+
+logging.disable(logging.WARNING)
+
+SCRIPT_RC = types.SimpleNamespace(parameter_pre_process = \
+                {'SQPG': {'pulse': {'o': {'XY': 1, 'Z': 2, 'Readout': 3}}}})
+
+def make_spec():
+    return {
+            'main': {'Truncation range': 3, 'Sample rate': 1e9},
+            'inverted': {'a': 0.25},
+            'x': {'a': 0.5, 'w': 1e-8, 'f': 1e8, 'o': 'XY', 'DRAG': 1e-9, 'time_reference': 'absolute', \
+                  'time_offset': 1e-7, 'pulse_number': 1},
+            'y': {'Amplitude': 0.3, 'Width': 2e-8, 'o': 'Z', 'time_reference': 'previous', \
+                  'time_offset': 2e-8, 'pulse_number': 2},
+            'z': {'a': 0.1, 'w': 1e-8, 'o': 'XY', 'is_inverted': True, 'time_reference': 'relative', \
+                  'relative_to': 'x', 'relative_marker': 'end', 'time_offset': 0.0, 'pulse_number': 3},
+        }
+
+def make_manager(spec, iterations = None):
+    manager = PulseSeqManager()
+    manager.assign_script_rcmodule(SCRIPT_RC, None)
+    manager.set_input_pulse_seq(copy.deepcopy(spec))
+    if iterations is not None:
+        manager.set_iteration_spec(copy.deepcopy(iterations))
+    return manager
+
+def normalize(value):
+    if isinstance(value, IterationSpec):
+        return ('iteration',) + value.get_spec_key()
+    return value
+
+def get_output(manager):
+    return [sorted((name, normalize(value)) for name, value in pulse.attributes.items()) \
+                for pulse in manager.export_output()], sorted(manager.get_main_params().items())
+
+def convert_changed(spec, changed_spec, iterations = None):
+    '''
+    Convert spec, then changed_spec with the same manager; returns the parameter changes found, and the output of the incremental and of a full conversion of changed_spec.
+    '''
+    manager = make_manager(spec)
+    manager.convert_seq()
+    manager.set_input_pulse_seq(copy.deepcopy(changed_spec))
+    if iterations is not None:
+        manager.set_iteration_spec(copy.deepcopy(iterations))
+    param_changes = manager.get_param_changes()
+    manager.convert_seq()
+    full_manager = make_manager(changed_spec, iterations)
+    full_manager.convert_seq()
+    return param_changes, get_output(manager), get_output(full_manager)
+
+def test_no_changes_before_conversion():
+    assert make_manager(make_spec()).get_param_changes() is None
+
+@pytest.mark.parametrize('pulse_name, param_name, new_value, expected_changes', [
+    ('x', 'a', 0.75, [('x', 'a', 0.75)]),
+    ('y', 'Amplitude', 0.4, [('y', 'a', 0.4)]),
+    ('x', 'o', 'Readout', [('x', 'o', 'Readout')]),
+    ('x', 'f', None, [('x', 'f', None)]),
+    ('x', 'DRAG', None, [('x', 'DRAG', None)]),
+    ## Inverted pulses keep the global inverted-pulse amplitude
+    ('z', 'a', 0.9, [('z', 'a', 0.9)]),
+])
+def test_patched_matches_full_conversion(pulse_name, param_name, new_value, expected_changes):
+    spec = make_spec()
+    changed_spec = make_spec()
+    if new_value is None:
+        del changed_spec[pulse_name][param_name]
+    else:
+        changed_spec[pulse_name][param_name] = new_value
+    param_changes, patched_output, full_output = convert_changed(spec, changed_spec)
+    assert param_changes == expected_changes
+    assert patched_output == full_output
+
+def test_full_and_short_names_are_equivalent():
+    spec = make_spec()
+    changed_spec = make_spec()
+    changed_spec['y'] = dict(changed_spec['y'])
+    changed_spec['y']['a'] = changed_spec['y'].pop('Amplitude')
+    param_changes, patched_output, full_output = convert_changed(spec, changed_spec)
+    assert param_changes == []
+    assert patched_output == full_output
+
+def test_iteration_spec_patched():
+    spec = make_spec()
+    manager = make_manager(spec, {'x': {'a': [0.0, 1.0, 11]}})
+    manager.convert_seq()
+    ## An equal iteration is not a change
+    manager.set_input_pulse_seq(copy.deepcopy(spec))
+    manager.set_iteration_spec({'x': {'a': [0.0, 1.0, 11]}})
+    assert manager.get_param_changes() == []
+    param_changes, patched_output, full_output = convert_changed(spec, spec, {'x': {'a': [0.0, 1.0, 21]}})
+    assert [change[:2] for change in param_changes] == [('x', 'a')]
+    assert patched_output == full_output
+
+@pytest.mark.parametrize('change', ['timing', 'main', 'inverted', 'added', 'removed', 'reordered'])
+def test_full_conversion_required(change):
+    spec = make_spec()
+    changed_spec = make_spec()
+    if change == 'timing':
+        changed_spec['x']['w'] = 3e-8
+    elif change == 'main':
+        changed_spec['main']['Sample rate'] = 2e9
+    elif change == 'inverted':
+        changed_spec['inverted']['a'] = 0.5
+    elif change == 'added':
+        changed_spec['q'] = {'a': 0.2, 'w': 1e-8, 'o': 'XY', 'time_reference': 'previous', \
+                            'time_offset': 0.0, 'pulse_number': 4}
+    elif change == 'removed':
+        del changed_spec['y']
+    elif change == 'reordered':
+        changed_spec = dict(reversed(list(changed_spec.items())))
+    param_changes, converted_output, full_output = convert_changed(spec, changed_spec)
+    assert param_changes is None
+    assert converted_output == full_output
+
+def test_invalid_input_keys():
+    manager = make_manager(make_spec())
+    manager.convert_seq()
+    output = get_output(manager)
+    changed_spec = make_spec()
+    changed_spec['x']['amplitude'] = 0.75
+    with pytest.raises(KeyError, match = 'amplitude'):
+        manager.set_input_pulse_seq(changed_spec)
+    changed_spec = make_spec()
+    changed_spec['inverted']['not_a_parameter'] = 1
+    with pytest.raises(KeyError, match = 'not_a_parameter'):
+        manager.set_input_pulse_seq(changed_spec)
+    ## The previous specifications are kept
+    assert manager.get_param_changes() == []
+    manager.convert_seq()
+    assert get_output(manager) == output
+    ## Main parameters are not pulse parameters
+    changed_spec = make_spec()
+    changed_spec['main']['sequence_duration'] = 1e-5
+    manager.set_input_pulse_seq(changed_spec)
+
+@pytest.mark.parametrize('iterations, message', [
+    ({'q': {'a': [0.0, 1.0, 11]}}, 'No pulse with name q'),
+    ({'main': {'Sample rate': [1e9, 2e9, 2]}}, 'No pulse with name main'),
+    ({'inverted': {'a': [0.0, 1.0, 11]}}, 'No pulse with name inverted'),
+    ({'x': {'a': [0.0, 1.0, 11]}, 'y': {'amp': [0.0, 1.0, 11]}}, 'amp'),
+])
+def test_set_iteration_spec_key_error(iterations, message):
+    manager = make_manager(make_spec())
+    with pytest.raises(KeyError, match = message):
+        manager.set_iteration_spec(iterations)
+    ## None of the iterations are set
+    assert manager._input_specs == make_spec()
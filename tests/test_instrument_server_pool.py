@@ -0,0 +1,213 @@
+## Pooled InstrumentServer and InstrumentClient connections
+##  Connections are re-used across measurements until idle for too long or
+##  found broken; values unchanged since they were last applied through a
+##  pooled connection are not sent again; and errors from concurrent workers
+##  are reported in instrument order.
+
+import logging
+import threading
+
+import numpy as np
+import pytest
+
+from PSICT_UIF._include36.InstrumentServerPool import InstrumentServerPool, FakeInstrumentServer
+from PSICT_UIF._include36.LabberExporter import LabberExporter
+
+class ConnectRecorder:
+    '''
+    connect_function which records the FakeInstrumentServer connections opened.
+    '''
+    def __init__(self, server_class = FakeInstrumentServer):
+        self.server_class = server_class
+        self.servers = []
+
+    def __call__(self, server_name):
+        self.servers.append(self.server_class(server_name))
+        return self.servers[-1]
+
+def make_pool(server_class = FakeInstrumentServer, **kwargs):
+    connect = ConnectRecorder(server_class)
+    return InstrumentServerPool(connect_function = connect, **kwargs), connect
+
+def make_idle(pool, idle_time):
+    for entry in list(pool._servers.values()) + list(pool._instruments.values()):
+        entry.last_used -= idle_time
+
+###############################################################################
+## Pool re-use and eviction
+
+def test_connections_reused():
+    pool, connect = make_pool()
+    server = pool.get_server('localhost')
+    instrument = pool.get_instrument('localhost', 'Driver', 'Instr')
+    assert pool.get_server('localhost') is server
+    assert pool.get_instrument('localhost', 'Driver', 'Instr') is instrument
+    assert pool.get_instrument('localhost', 'Driver', 'Other') is not instrument
+    assert len(connect.servers) == 1
+    assert pool.get_server('remote') is not server
+    assert len(connect.servers) == 2
+
+def test_idle_connections_reopened():
+    pool, connect = make_pool(idle_timeout = 100.0, health_check_interval = 10.0)
+    server = pool.get_server('localhost')
+    instrument = pool.get_instrument('localhost', 'Driver', 'Instr')
+    pool.get_applied_values('localhost', 'Driver', 'Instr')['Param'] = ('value', 1.0)
+    make_idle(pool, 200.0)
+    ## Closing the server connection also closes its instrument connections
+    new_server = pool.get_server('localhost')
+    assert new_server is not server
+    assert server.is_closed
+    assert not instrument.is_connected
+    assert len(connect.servers) == 2
+    assert pool.get_applied_values('localhost', 'Driver', 'Instr') == {}
+
+def test_close_idle():
+    pool, connect = make_pool(idle_timeout = 100.0)
+    pool.get_instrument('localhost', 'Driver', 'Instr')
+    pool.get_server('remote')
+    make_idle(pool, 200.0)
+    pool.get_server('remote')
+    pool.close_idle()
+    assert list(pool._servers) == ['remote']
+    assert pool._instruments == {}
+    assert connect.servers[0].is_closed
+
+def test_health_check():
+    pool, connect = make_pool(idle_timeout = 100.0, health_check_interval = 10.0)
+    instrument = pool.get_instrument('localhost', 'Driver', 'Instr')
+    n_round_trips = instrument.n_round_trips
+    ## Recently used connections are not checked
+    assert pool.get_instrument('localhost', 'Driver', 'Instr') is instrument
+    assert instrument.n_round_trips == n_round_trips
+    ## Healthy connections are re-used after the check
+    make_idle(pool, 20.0)
+    assert pool.get_instrument('localhost', 'Driver', 'Instr') is instrument
+    assert instrument.n_round_trips == n_round_trips + 1
+    ## Broken connections are re-opened
+    pool.get_applied_values('localhost', 'Driver', 'Instr')['Param'] = ('value', 1.0)
+    instrument.is_connected = False
+    make_idle(pool, 20.0)
+    pool.get_instrument('localhost', 'Driver', 'Instr')
+    assert instrument.is_connected
+    assert pool.get_applied_values('localhost', 'Driver', 'Instr') == {}
+    assert len(connect.servers) == 1
+
+class BlockingServer(FakeInstrumentServer):
+    '''
+    Server whose health check waits until another thread has acquired (and released) the lock of its pool.
+    '''
+    pool = None
+
+    def getListOfInstruments(self):
+        acquired = []
+        def acquire_lock():
+            acquired.append(self.pool._lock.acquire(timeout = 5))
+            if acquired[-1]:
+                self.pool._lock.release()
+        thread = threading.Thread(target = acquire_lock)
+        thread.start()
+        thread.join()
+        self.lock_acquired = acquired[0]
+        return super().getListOfInstruments()
+
+def test_server_health_check_outside_pool_lock():
+    pool, connect = make_pool(BlockingServer, health_check_interval = 10.0)
+    BlockingServer.pool = pool
+    server = pool.get_server('localhost')
+    make_idle(pool, 20.0)
+    assert pool.get_server('localhost') is server
+    assert server.lock_acquired
+
+###############################################################################
+## Skipping unchanged values
+
+def make_exporter(pool, client_values, *, max_workers = 1):
+    exporter = LabberExporter()
+    exporter.set_server_name('localhost')
+    exporter.set_server_pool(pool)
+    exporter.set_client_max_workers(max_workers)
+    for instrument_name, instrument_params in client_values.items():
+        exporter.add_client_value_spec(instrument_name, instrument_params, 'Driver')
+    return exporter
+
+def get_instrument(connect, instrument_name):
+    return connect.servers[-1].instruments[('Driver', instrument_name)]
+
+def test_unchanged_values_skipped():
+    pool, connect = make_pool()
+    client_values = {'Instr': {'Waveform': np.arange(10.0), 'Mode': 'fast'}}
+    exporter = make_exporter(pool, client_values)
+    exporter.apply_client_values()
+    instrument = get_instrument(connect, 'Instr')
+    assert np.array_equal(instrument.values['Waveform'], np.arange(10.0))
+    assert instrument.values['Mode'] == 'fast'
+    assert exporter.client_write_stats['writes'] == 2
+    assert exporter.client_write_stats['round_trips'] == 2
+    ## Applying the same values again sends nothing (even from a new exporter on the same pool)
+    exporter = make_exporter(pool, client_values)
+    exporter.apply_client_values()
+    assert exporter.client_write_stats == {'writes': 0, 'writes_skipped': 2, 'bytes_sent': 0, 'bytes_skipped': 84, \
+                                           'round_trips': 0}
+    ## Only the changed value is sent; equal values of a different dtype are changed values
+    client_values['Instr']['Waveform'] = np.arange(10)
+    exporter.apply_client_values()
+    assert exporter.client_write_stats['writes'] == 1
+    assert exporter.client_write_stats['writes_skipped'] == 1
+    assert instrument.values['Waveform'].dtype == np.arange(10).dtype
+    ## All values are sent when refresh is forced
+    exporter.set_client_force_refresh(True)
+    exporter.apply_client_values()
+    assert exporter.client_write_stats['writes'] == 2
+
+def test_values_resent_after_reconnect():
+    pool, connect = make_pool()
+    exporter = make_exporter(pool, {'Instr': {'Waveform': [0.0, 1.0]}})
+    exporter.apply_client_values()
+    pool.discard_instrument('localhost', 'Driver', 'Instr')
+    exporter.apply_client_values()
+    assert exporter.client_write_stats['writes'] == 1
+
+def test_failed_write_discards_connection():
+    pool, connect = make_pool()
+    exporter = make_exporter(pool, {'Instr': {'Waveform': [0.0, 1.0], 'Mode': 'fast'}})
+    exporter.apply_client_values()
+    instrument = get_instrument(connect, 'Instr')
+    exporter.add_client_value_spec('Instr', {'Waveform': [0.0, 2.0], 'Mode': 'slow'}, 'Driver')
+    def fail(config_dict):
+        raise RuntimeError('write failed')
+    instrument.setInstrConfig = fail
+    with pytest.raises(RuntimeError, match = 'write failed'):
+        exporter.apply_client_values()
+    assert not instrument.is_connected
+    assert pool.get_applied_values('localhost', 'Driver', 'Instr') == {}
+
+###############################################################################
+## Concurrent application
+
+def test_threaded_errors_in_instrument_order(caplog):
+    pool, connect = make_pool()
+    client_values = {'Instr{}'.format(index): {'Waveform': [float(index)]} for index in range(4)}
+    exporter = make_exporter(pool, client_values, max_workers = 4)
+    exporter.apply_client_values()
+    ## The later instrument fails first
+    failed = threading.Event()
+    def fail_late(param_name, param_value):
+        failed.wait(5)
+        raise RuntimeError('Instr1 failed')
+    def fail_early(param_name, param_value):
+        failed.set()
+        raise ValueError('Instr3 failed')
+    get_instrument(connect, 'Instr1').setValue = fail_late
+    get_instrument(connect, 'Instr3').setValue = fail_early
+    for index, instrument_params in enumerate(client_values.values()):
+        instrument_params['Waveform'] = [float(index), 1.0]
+    with caplog.at_level(logging.ERROR):
+        with pytest.raises(RuntimeError, match = 'Instr1 failed'):
+            exporter.apply_client_values()
+    assert [record.getMessage().split(':')[0] for record in caplog.records] == \
+                ['Applying InstrumentClient values failed for instrument Instr1', \
+                 'Applying InstrumentClient values failed for instrument Instr3']
+    ## The other instruments are still applied
+    for instrument_name in ['Instr0', 'Instr2']:
+        assert get_instrument(connect, instrument_name).values['Waveform'] == client_values[instrument_name]['Waveform']
+    assert pool.get_applied_values('localhost', 'Driver', 'Instr1') == {}
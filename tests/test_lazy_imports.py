@@ -0,0 +1,21 @@
+## Labber and h5py are only imported when first used
+##  PSICT_UIF is imported in a fresh interpreter, so that modules imported by
+##  other tests do not affect the result.
+
+import os
+import sys
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_import_does_not_load_labber_or_h5py():
+    script = '; '.join([
+        'import sys',
+        'import PSICT_UIF',
+        'print(",".join(sorted(set(name.split(".")[0] for name in sys.modules) & {"Labber", "h5py"})))',
+    ])
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')])))
+    result = subprocess.run([sys.executable, '-c', script], env = env, \
+                            stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == ''
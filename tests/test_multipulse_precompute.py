@@ -0,0 +1,180 @@
+## Precomputation of pulse sequence waveforms in the PSICT MultiPulse driver
+##  Waveforms taken from the precompute cache must be identical to those
+##  generated on demand, including after a waveform parameter is changed in
+##  the middle of a 'Pulse sequence counter' sweep.
+
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+
+from multipulse import make_driver, set_value, get_waveforms
+
+from waveforms_handling import WAVEFORM_PARAMETERS, getWaveformKey, generateSequenceWaveforms, WaveformWorker
+
+## Long enough for all sequences at the default sample rate
+SWEEP_VALUES = {'Number of points': 12e3, 'First pulse delay': 1e-7, 'Use global DRAG': True, \
+                'Global DRAG coefficient': 1e-9}
+
+class RecordingExecutor:
+    '''
+    Executor which only records the submitted calls, leaving their futures pending.
+    '''
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, function, *args):
+        future = Future()
+        self.submitted.append((function, args, future))
+        return future
+
+    def shutdown(self, wait = True):
+        pass
+
+@pytest.fixture
+def drivers():
+    opened_drivers = []
+    yield opened_drivers
+    for driver in opened_drivers:
+        executor = driver.oPrecomputeExecutor
+        driver.performClose()
+        if executor is not None:
+            executor.shutdown(wait = True)
+
+def open_driver(drivers, monkeypatch, values):
+    driver = make_driver(monkeypatch, values)
+    drivers.append(driver)
+    return driver
+
+def get_waveform_values(driver):
+    return {param_name: driver.getValue(param_name) for param_name in WAVEFORM_PARAMETERS}
+
+def get_current_key(driver):
+    return getWaveformKey(driver.getValue('Pulse sequence counter'), get_waveform_values(driver))
+
+def wait_for_precompute(driver, timeout = 60):
+    end_time = time.time() + timeout
+    while driver.dPendingWaveforms:
+        assert time.time() < end_time, 'Precomputing timed out'
+        time.sleep(0.01)
+
+def make_waveforms(value):
+    return [np.full(4, value)], [np.full(4, -value)], 4
+
+def test_precomputed_sweep_matches_serial(drivers, monkeypatch):
+    serial = open_driver(drivers, monkeypatch, SWEEP_VALUES)
+    precomputed = open_driver(drivers, monkeypatch, dict(SWEEP_VALUES, **{'Precompute sequences': True, \
+                                                                         'Precompute workers': 2}))
+    n_seqs = len(precomputed.lPulseSequences)
+    wait_for_precompute(precomputed)
+    assert len(precomputed.oWaveformCache) == n_seqs
+    for counter in range(n_seqs):
+        if counter == n_seqs // 2:
+            ## Change a waveform parameter mid-sweep
+            for driver in [serial, precomputed]:
+                set_value(driver, 'Global DRAG coefficient', 2e-9)
+        for driver in [serial, precomputed]:
+            set_value(driver, 'Pulse sequence counter', counter)
+        is_cached = get_current_key(precomputed) in precomputed.oWaveformCache
+        ## The first sequence after the change is generated on demand, after which precomputing restarts
+        assert is_cached == (counter != n_seqs // 2)
+        serial.updateWaveform()
+        precomputed.updateWaveform()
+        if counter == n_seqs // 2:
+            assert precomputed.dPendingWaveforms
+            assert all(key[1:] == get_current_key(precomputed)[1:] for key in precomputed.dPendingWaveforms)
+            wait_for_precompute(precomputed)
+        serial_waveforms, precomputed_waveforms = get_waveforms(serial), get_waveforms(precomputed)
+        assert np.array_equal(precomputed_waveforms[0], serial_waveforms[0])
+        assert np.array_equal(precomputed_waveforms[1], serial_waveforms[1])
+        assert np.array_equal(precomputed.vTime, serial.vTime)
+
+def test_outdated_pending_waveforms_cancelled(drivers, monkeypatch):
+    driver = open_driver(drivers, monkeypatch, SWEEP_VALUES)
+    executor = driver.oPrecomputeExecutor = RecordingExecutor()
+    set_value(driver, 'Precompute sequences', True)
+    n_seqs = len(driver.lPulseSequences)
+    assert len(executor.submitted) == n_seqs
+    assert all(function is generateSequenceWaveforms for function, _, _ in executor.submitted)
+    old_futures = [future for _, _, future in executor.submitted]
+    executor.submitted = []
+    ## Not precomputed for the new parameters: generated on demand, and precomputing restarted
+    set_value(driver, 'Sample rate', 2e9)
+    driver.updateWaveform()
+    current_key = get_current_key(driver)
+    assert list(driver.oWaveformCache) == [current_key]
+    assert all(future.cancelled() for future in old_futures)
+    assert len(executor.submitted) == n_seqs - 1
+    assert set(driver.dPendingWaveforms) == {getWaveformKey(index, get_waveform_values(driver)) \
+                                                for index in range(1, n_seqs)}
+    ## A pending waveform which has not been started is cancelled, and generated on demand instead
+    pending_key = getWaveformKey(1, get_waveform_values(driver))
+    pending_future = driver.dPendingWaveforms[pending_key]
+    assert driver.getPrecomputedWaveform(pending_key) is None
+    assert pending_future.cancelled()
+    assert pending_key not in driver.dPendingWaveforms
+
+def test_sequences_following_counter_precomputed(drivers, monkeypatch):
+    ## Only half of the cache is filled, starting from the current sequence
+    driver = open_driver(drivers, monkeypatch, dict(SWEEP_VALUES, **{'Waveform cache size': 6, \
+                                                                    'Pulse sequence counter': 40}))
+    executor = driver.oPrecomputeExecutor = RecordingExecutor()
+    set_value(driver, 'Precompute sequences', True)
+    assert [key[0] for key in driver.dPendingWaveforms] == [40, 41, 0]
+    assert [args[2] for _, args, _ in executor.submitted] == [driver.lPulseSequences[index] for index in [40, 41, 0]]
+
+def test_cache_evicts_least_recently_used(drivers, monkeypatch):
+    driver = open_driver(drivers, monkeypatch, {})
+    driver.iWaveformCacheSize = 2
+    keys = [(index, 'params') for index in range(3)]
+    driver.storeWaveform(keys[0], make_waveforms(0.0))
+    driver.storeWaveform(keys[1], make_waveforms(1.0))
+    ## Using the first waveform makes the second the least recently used
+    assert driver.getPrecomputedWaveform(keys[0])[2] == 4
+    driver.storeWaveform(keys[2], make_waveforms(2.0))
+    assert list(driver.oWaveformCache) == [keys[0], keys[2]]
+    assert driver.getPrecomputedWaveform(keys[1]) is None
+    ## No limit on the cache size
+    driver.iWaveformCacheSize = 0
+    driver.storeWaveform(keys[1], make_waveforms(1.0))
+    assert len(driver.oWaveformCache) == 3
+
+def test_collect_waveform(drivers, monkeypatch):
+    driver = open_driver(drivers, monkeypatch, {})
+    futures = {}
+    for index, outcome in enumerate(['result', 'error', 'cancelled', 'replaced']):
+        key = (index, 'params')
+        futures[outcome] = (key, Future())
+        driver.dPendingWaveforms[key] = futures[outcome][1]
+    futures['result'][1].set_result(make_waveforms(1.0))
+    futures['error'][1].set_exception(RuntimeError('generation failed'))
+    futures['cancelled'][1].cancel()
+    futures['replaced'][1].set_result(make_waveforms(2.0))
+    replacement = Future()
+    driver.dPendingWaveforms[futures['replaced'][0]] = replacement
+    for key, future in futures.values():
+        driver.collectWaveform(key, future)
+    assert list(driver.oWaveformCache) == [futures['result'][0]]
+    assert driver.oWaveformCache[futures['result'][0]][2] == 4
+    ## Only the replacement future is still pending
+    assert driver.dPendingWaveforms == {futures['replaced'][0]: replacement}
+
+def test_generate_sequence_waveforms_matches_driver(drivers, monkeypatch):
+    driver = open_driver(drivers, monkeypatch, SWEEP_VALUES)
+    for counter, sample_rate in [(2, 1e9), (40, 1e9), (4, 1e9), (4, 2e9), (3, 2e9)]:
+        set_value(driver, 'Sample rate', sample_rate)
+        set_value(driver, 'Pulse sequence counter', counter)
+        driver.updateWaveform()
+        values = get_waveform_values(driver)
+        ## The worker of the process is re-used between calls, with the updated values
+        waveforms, quadratures, n_points = generateSequenceWaveforms(driver.nTrace, driver.lPulseDefinitions, \
+                                                                     driver.lPulseSequences[counter], values)
+        assert n_points == driver.getValue('Number of points')
+        assert np.array_equal(np.array(waveforms), get_waveforms(driver)[0])
+        assert np.array_equal(np.array(quadratures), get_waveforms(driver)[1])
+        ## A new worker gives the same result
+        worker = WaveformWorker(driver.nTrace, driver.lPulseDefinitions, dict(values, **{'Pulse sequence counter': 0}))
+        worker.lPulseSequences = [driver.lPulseSequences[counter]]
+        worker.calculateWaveform()
+        assert np.array_equal(np.array(worker.lWaveforms), np.array(waveforms))
@@ -0,0 +1,129 @@
+## Storage of pulse parameters in the typed columns of a PulseTable
+##  Values of the column type are held in the typed columns, while other values
+##  (eg IterationSpec objects) and unset parameters must round-trip unchanged.
+
+import math
+
+import numpy as np
+import pytest
+
+from PSICT_UIF._include36.Pulse import Pulse, PulseTable, \
+        get_param_values, get_param_set_mask, get_param_array, set_param_values
+from PSICT_UIF._include36.ParameterSpec import IterationSpec
+
+def make_iteration_spec():
+    return IterationSpec({'start_value': 0.0, 'stop_value': 1.0, 'n_pts': 11})
+
+def test_column_dtypes():
+    table = PulseTable()
+    assert table.dtype['a'] == np.float64
+    assert table.dtype['absolute_time'] == np.float64
+    assert table.dtype['pulse_number'] == np.int64
+    assert table.dtype['is_inverted'] == np.int8
+    assert table.dtype['name'] == object
+    assert table.dtype['time_reference'] == object
+
+@pytest.mark.parametrize('key, value', [
+    ('a', 0.25), ('a', float('inf')), ('pulse_number', 7),
+    ('is_inverted', True), ('is_measurement', False), ('name', 'p0'),
+    ('time_reference', 'previous'),
+])
+def test_typed_values_round_trip(key, value):
+    pulse = Pulse({'name': 'p0', key: value})
+    assert pulse[key] == value
+    assert type(pulse[key]) is type(value)
+
+def test_integers_stored_as_floats():
+    pulse = Pulse({'name': 'p0', 'a': 3, 'w': np.int32(2), 'pulse_number': np.int16(4)})
+    assert pulse['a'] == 3 and type(pulse['a']) is float
+    assert pulse['w'] == 2 and type(pulse['w']) is float
+    assert pulse['pulse_number'] == 4 and type(pulse['pulse_number']) is int
+    assert pulse._table.objects['a'] == {}
+
+def test_flags_read_back_as_bools():
+    pulse = Pulse({'name': 'p0', 'is_inverted': np.bool_(True), 'is_measurement': False})
+    assert pulse['is_inverted'] is True
+    assert pulse['is_measurement'] is False
+
+@pytest.mark.parametrize('key, value', [
+    ('a', True), ('pulse_number', 2.5), ('pulse_number', 2**70), ('is_inverted', 1), ('w', 'not a number'),
+])
+def test_other_values_held_as_objects(key, value):
+    pulse = Pulse({'name': 'p0', key: value})
+    assert pulse[key] is value
+    assert pulse._table.objects[key] == {pulse._row: value}
+
+def test_iteration_spec_held_as_object():
+    iteration_spec = make_iteration_spec()
+    pulse = Pulse({'name': 'p0', 'a': iteration_spec})
+    assert pulse['a'] is iteration_spec
+    assert pulse['Amplitude'] is iteration_spec
+    ## Replacing the object with a typed value drops the object
+    pulse['a'] = 0.5
+    assert pulse['a'] == 0.5
+    assert pulse._table.objects['a'] == {}
+
+def test_nan_is_a_set_value():
+    pulse = Pulse({'name': 'p0', 'a': float('nan')})
+    assert 'a' in pulse.attributes
+    assert math.isnan(pulse['a'])
+    assert get_param_set_mask([pulse], 'a').tolist() == [True]
+
+def test_unset_and_deleted_parameters():
+    pulse = Pulse({'name': 'p0', 'a': 0.5, 'pulse_number': 1})
+    for key in ['w', 'is_inverted', 'relative_to']:
+        assert key not in pulse.attributes
+        with pytest.raises(KeyError):
+            pulse[key]
+    del pulse['a']
+    del pulse['pulse_number']
+    assert 'a' not in pulse.attributes
+    assert 'pulse_number' not in pulse.attributes
+    assert pulse._table.objects['a'] == {}
+    assert list(pulse.attributes) == ['name']
+    assert get_param_set_mask([pulse], 'a').tolist() == [False]
+
+def test_set_attributes_writes_whole_row():
+    iteration_spec = make_iteration_spec()
+    pulse = Pulse({'name': 'p0', 'a': 0.5, 'w': iteration_spec})
+    pulse.set_attributes({'Width': 1e-8, 'pulse_number': 2, 'is_inverted': True, 'time_reference': 'absolute'})
+    assert dict(pulse.attributes) == {'name': 'p0', 'a': 0.5, 'w': 1e-8, 'pulse_number': 2, \
+                                      'is_inverted': True, 'time_reference': 'absolute'}
+    assert pulse._table.objects['w'] == {}
+    with pytest.raises(KeyError):
+        pulse.set_attributes({'not_a_parameter': 1})
+
+def test_values_kept_when_table_grows():
+    table = PulseTable(capacity = 1)
+    iteration_spec = make_iteration_spec()
+    pulses = [Pulse({'name': 'p{}'.format(i), 'a': iteration_spec if i == 3 else 0.1*i, 'pulse_number': i}, \
+                    table = table) for i in range(40)]
+    assert len(table) == 40
+    assert [pulse['pulse_number'] for pulse in pulses] == list(range(40))
+    assert pulses[3]['a'] is iteration_spec
+    assert [pulse['a'] for pulse in pulses if pulse.name != 'p3'] == [0.1*i for i in range(40) if i != 3]
+
+def test_vectorized_access():
+    table = PulseTable()
+    iteration_spec = make_iteration_spec()
+    pulses = [Pulse({'name': 'p{}'.format(i), 'a': 0.5}, table = table) for i in range(5)]
+    pulses[1]['w'] = 1e-8
+    pulses[2]['w'] = iteration_spec
+    assert get_param_set_mask(pulses, 'w').tolist() == [False, True, True, False, False]
+    values = get_param_values(pulses, 'w')
+    assert values.dtype == object
+    assert values.tolist() == [None, 1e-8, iteration_spec, None, None]
+    with pytest.raises(KeyError):
+        get_param_array(pulses, 'w')
+    assert get_param_array(pulses[1:3], 'w').tolist() == [1e-8, 1.0]
+    set_param_values(pulses, 'w', [0.0, 1.0, 2.0, None, iteration_spec])
+    assert get_param_values(pulses, 'w').tolist() == [0.0, 1.0, 2.0, None, iteration_spec]
+    assert table.objects['w'] == {pulses[4]._row: iteration_spec}
+    assert get_param_array(pulses, 'a').dtype == np.float64
+
+def test_vectorized_access_across_tables():
+    pulses = [Pulse({'name': 'p0', 'a': 0.5}), Pulse({'name': 'p1'})]
+    assert get_param_set_mask(pulses, 'a').tolist() == [True, False]
+    assert get_param_values(pulses, 'a').tolist() == [0.5, None]
+    set_param_values(pulses, 'a', [1.0, 2.0])
+    assert get_param_array(pulses, 'a').tolist() == [1.0, 2.0]
@@ -0,0 +1,105 @@
+## Cache of prepared reference files
+##  Entries are keyed by the template file contents and the reference state
+##  hash of the LabberExporter, which must distinguish all settings affecting
+##  the direct edits to the reference file (including large arrays).
+
+import os
+
+import numpy as np
+import pytest
+
+from PSICT_UIF._include36.LabberExporter import LabberExporter
+from PSICT_UIF._include36.ReferenceCache import ReferenceCache
+
+from interface import make_interface
+
+def write_file(file_path, contents):
+    with open(str(file_path), 'wb') as output_file:
+        output_file.write(contents)
+    return str(file_path)
+
+def read_file(file_path):
+    with open(str(file_path), 'rb') as input_file:
+        return input_file.read()
+
+def get_state_hash(*, config_value = 0.0, iteration_values = None):
+    exporter = LabberExporter()
+    exporter._instr_config_values = {'AWG': {'Waveform': config_value}}
+    exporter._hardware_names = {'AWG': 'Generic AWG'}
+    if iteration_values is not None:
+        exporter.add_iteration_spec('Source', {'Frequency': iteration_values})
+    return exporter.get_reference_state_hash()
+
+def test_state_hash_distinguishes_large_config_arrays():
+    ## The repr of both arrays is truncated to the same string by NumPy
+    waveform = np.zeros(5000)
+    changed_waveform = waveform.copy()
+    changed_waveform[2500] = 1.0
+    assert repr(waveform) == repr(changed_waveform)
+    assert get_state_hash(config_value = waveform) != get_state_hash(config_value = changed_waveform)
+    assert get_state_hash(config_value = waveform) == get_state_hash(config_value = waveform.copy())
+    ## dtype and shape are part of the hash
+    assert get_state_hash(config_value = waveform) != get_state_hash(config_value = waveform.astype(np.float32))
+    assert get_state_hash(config_value = waveform) != get_state_hash(config_value = waveform.reshape(50, 100))
+
+def test_state_hash_distinguishes_large_explicit_iterations():
+    values = np.linspace(4e9, 5e9, 2001)
+    changed_values = values.copy()
+    changed_values[1000] += 1.0
+    assert get_state_hash(iteration_values = values) != get_state_hash(iteration_values = changed_values)
+    assert get_state_hash(iteration_values = values) == get_state_hash(iteration_values = values.copy())
+
+def test_lookup_miss(tmp_path):
+    cache = ReferenceCache(str(tmp_path / 'cache'))
+    template_path = write_file(tmp_path / 'template.hdf5', b'template')
+    assert cache.lookup(cache.get_key(template_path, 'state')) is None
+
+def test_publish_and_lookup_hit(tmp_path):
+    cache = ReferenceCache(str(tmp_path / 'cache'))
+    template_path = write_file(tmp_path / 'template.hdf5', b'template')
+    prepared_path = write_file(tmp_path / 'prepared.hdf5', b'prepared reference')
+    key = cache.get_key(template_path, 'state')
+    cache.publish(key, prepared_path)
+    entry_path = cache.lookup(key)
+    assert entry_path == cache.get_entry_path(key)
+    assert read_file(entry_path) == b'prepared reference'
+    ## No temporary files are left behind
+    assert os.listdir(cache.cache_dir) == [os.path.basename(entry_path)]
+    ## Other states and templates miss
+    assert cache.lookup(cache.get_key(template_path, 'other state')) is None
+    other_template_path = write_file(tmp_path / 'other_template.hdf5', b'other template')
+    assert cache.lookup(cache.get_key(other_template_path, 'state')) is None
+
+def test_least_recently_used_evicted(tmp_path):
+    cache = ReferenceCache(str(tmp_path / 'cache'), max_size = 25)
+    prepared_path = write_file(tmp_path / 'prepared.hdf5', b'x'*10)
+    for key in ['a', 'b']:
+        cache.publish(key, prepared_path)
+    os.utime(cache.get_entry_path('a'), (1, 1))
+    os.utime(cache.get_entry_path('b'), (2, 2))
+    ## Looking up 'a' makes 'b' the least recently used entry
+    assert cache.lookup('a') is not None
+    cache.publish('c', prepared_path)
+    assert cache.lookup('b') is None
+    assert cache.lookup('a') is not None
+    assert cache.lookup('c') is not None
+
+def test_file_manager_uses_cache(tmp_path, monkeypatch):
+    interface = make_interface(tmp_path, monkeypatch)
+    file_manager = interface.fileManager
+    file_manager.set_reference_copy_strategies(['copy'])
+    file_manager.set_reference_cache(str(tmp_path / 'cache'))
+    write_file(tmp_path / 'template.hdf5', b'template')
+    file_manager.set_template_file(str(tmp_path), 'template')
+    assert not os.path.exists(file_manager.reference_path)
+    ## Miss: the template is copied, and the edited reference file published
+    assert file_manager.prepare_reference_file('state') is False
+    assert read_file(file_manager.reference_path) == b'template'
+    write_file(file_manager.reference_path, b'edited')
+    file_manager.publish_reference_file()
+    file_manager.clean_reference_file()
+    ## Hit: the edited reference file is copied from the cache
+    assert file_manager.prepare_reference_file('state') is True
+    assert read_file(file_manager.reference_path) == b'edited'
+    assert file_manager.prepare_reference_file('other state') is False
+    assert read_file(file_manager.reference_path) == b'template'
@@ -0,0 +1,87 @@
+## Re-ordering of the reference file 'Step list' by the iteration order
+##  The permutation-based reorder_step_list is checked against the previous
+##  swap-based implementation for random iteration orders: the requested
+##  channels must match the swap result exactly, the remaining channels must
+##  keep their relative order, and no rows may be lost.
+
+import random
+import shutil
+
+import h5py
+import pytest
+
+from PSICT_UIF._include36.ReferenceFileSession import ReferenceFileSession, decode_label
+from PSICT_UIF._include36.LabberExporter import LabberExporter
+
+from reference_file import make_reference_file
+
+N_CHANNELS = 60
+
+@pytest.fixture(scope = 'module')
+def reference(tmp_path_factory):
+    file_path = str(tmp_path_factory.mktemp('reference') / 'reference.hdf5')
+    labels = make_reference_file(file_path, n_channels = N_CHANNELS)
+    with h5py.File(file_path, 'r') as config_file:
+        step_list = config_file['Step list'][()]
+    return file_path, labels, step_list
+
+def swap_based_reorder(step_list, channel_names):
+    '''
+    Reference implementation: the swap-based re-ordering used before reorder_step_list.
+    '''
+    step_list = step_list.copy()
+    for new_index, channel_name in enumerate(channel_names):
+        current_labels = [decode_label(entry['channel_name']) for entry in step_list]
+        old_index = current_labels.index(channel_name)
+        swapped_entry = step_list[new_index].copy()
+        step_list[new_index] = step_list[old_index]
+        step_list[old_index] = swapped_entry
+    return step_list
+
+def read_reordered(reference, tmp_path, channel_names, *, through_exporter = False):
+    file_path, _, _ = reference
+    copy_path = str(tmp_path / 'reordered.hdf5')
+    shutil.copy(file_path, copy_path)
+    if through_exporter:
+        exporter = LabberExporter()
+        exporter.set_reference_path(copy_path)
+        exporter._iteration_order = channel_names
+        exporter.sort_iteration_order()
+    else:
+        with ReferenceFileSession(copy_path) as session:
+            session.reorder_step_list(channel_names)
+    with h5py.File(copy_path, 'r') as config_file:
+        return config_file['Step list'][()]
+
+def check_reordered(reference, reordered, channel_names):
+    _, _, step_list = reference
+    n_requested = len(channel_names)
+    ## Requested prefix is identical to the swap-based result
+    expected = swap_based_reorder(step_list, channel_names)
+    assert reordered[:n_requested].tolist() == expected[:n_requested].tolist()
+    ## All other rows keep their relative order
+    other_rows = [entry for entry in step_list.tolist() if decode_label(entry[0]) not in channel_names]
+    assert reordered[n_requested:].tolist() == other_rows
+    ## No rows are lost (or duplicated)
+    assert sorted(reordered.tolist()) == sorted(step_list.tolist())
+
+@pytest.mark.parametrize('seed', range(20))
+def test_matches_swap_based_prefix(reference, tmp_path, seed):
+    _, labels, _ = reference
+    rnd = random.Random(seed)
+    channel_names = rnd.sample(labels, rnd.randint(0, 15))
+    check_reordered(reference, read_reordered(reference, tmp_path, channel_names), channel_names)
+
+@pytest.mark.parametrize('channel_names', [
+    [],
+    ['Instr0 - Param0'],
+    ['Instr{} - Param{}'.format(index % 5, index) for index in range(N_CHANNELS)][::-1],
+])
+def test_edge_orders(reference, tmp_path, channel_names):
+    check_reordered(reference, read_reordered(reference, tmp_path, channel_names), channel_names)
+
+def test_sort_iteration_order(reference, tmp_path):
+    _, labels, _ = reference
+    channel_names = random.Random(0).sample(labels, 10)
+    reordered = read_reordered(reference, tmp_path, channel_names, through_exporter = True)
+    check_reordered(reference, reordered, channel_names)
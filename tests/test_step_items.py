@@ -0,0 +1,71 @@
+## Step items of iterations which cannot be set through the Labber API
+##  Log-spaced, explicit-value, and segmented iterations are written directly
+##  to the 'Step items' of the channel in the reference file, one step item per
+##  range (or per explicit value).
+
+import h5py
+import numpy as np
+
+from PSICT_UIF._include36.LabberExporter import LabberExporter
+from PSICT_UIF._include36 import _LabberExporter_rc as _rc
+
+from reference_file import make_reference_file
+
+## Fields of the Labber step items (sweep_rate is never edited)
+STEP_ITEMS_DTYPE = np.dtype([('range_type', 'i4'), ('step_type', 'i4'), ('single', 'f8'), ('start', 'f8'), \
+                             ('stop', 'f8'), ('center', 'f8'), ('span', 'f8'), ('step', 'f8'), ('n_pts', 'i4'), \
+                             ('interp', 'i4'), ('sweep_rate', 'f8')])
+
+SINGLE = _rc.STEP_ITEM_RANGE_TYPES['single']
+START_STOP = _rc.STEP_ITEM_RANGE_TYPES['start_stop']
+N_PTS = _rc.STEP_ITEM_STEP_TYPES['n_pts']
+LINEAR = _rc.STEP_ITEM_INTERP_TYPES['linear']
+LOG = _rc.STEP_ITEM_INTERP_TYPES['log']
+
+def make_exporter(tmp_path, iter_spec):
+    '''
+    Create an exporter on a synthetic reference file (with a single default step item per channel), with 'Instr0 - Param0' set to iter_spec and 'Instr1 - Param1' to a linear iteration.
+    '''
+    file_path = str(tmp_path / 'reference.hdf5')
+    labels = make_reference_file(file_path, n_channels = 4, n_instruments = 2, data_shape = (10, 10))
+    with h5py.File(file_path, 'r+') as config_file:
+        for label in labels:
+            config_file['Step config'][label].create_dataset('Step items', \
+                    data = np.array([(SINGLE, 0, 1.5, 0.0, 0.0, 0.0, 0.0, 0.0, 1, LINEAR, 0.25)], dtype = STEP_ITEMS_DTYPE))
+    exporter = LabberExporter()
+    exporter.set_reference_path(file_path)
+    exporter.add_point_value_spec('Instr0', {'Param2': 0.5})
+    exporter.add_iteration_spec('Instr0', {'Param0': iter_spec})
+    exporter.add_iteration_spec('Instr1', {'Param1': [0.0, 1.0, 11]})
+    return exporter, file_path
+
+def read_step_items(file_path, label):
+    with h5py.File(file_path, 'r') as config_file:
+        return config_file['Step config'][label]['Step items'][()]
+
+def get_rows(step_items):
+    return [tuple(step_item[field_name].item() for field_name in \
+                ['range_type', 'step_type', 'single', 'start', 'stop', 'n_pts', 'interp']) for step_item in step_items]
+
+def apply_and_check(tmp_path, iter_spec, expected_rows):
+    exporter, file_path = make_exporter(tmp_path, iter_spec)
+    assert list(exporter.get_step_items()) == ['Instr0 - Param0']
+    exporter.apply_step_items()
+    step_items = read_step_items(file_path, 'Instr0 - Param0')
+    assert get_rows(step_items) == expected_rows
+    ## Fields which are not set are copied from the original step item
+    assert np.all(step_items['sweep_rate'] == 0.25)
+    ## Linear iterations and point values are set through the Labber API
+    for label in ['Instr1 - Param1', 'Instr0 - Param2']:
+        assert get_rows(read_step_items(file_path, label)) == [(SINGLE, 0, 1.5, 0.0, 0.0, 1, LINEAR)]
+
+def test_log_spaced_step_items(tmp_path):
+    apply_and_check(tmp_path, [1e-3, 1e-1, 5, 'log'], [(START_STOP, N_PTS, 1e-3, 1e-3, 1e-1, 5, LOG)])
+
+def test_explicit_values_step_items(tmp_path):
+    apply_and_check(tmp_path, np.array([0.3, -0.2, 0.9]), \
+                    [(SINGLE, N_PTS, value, value, value, 1, LINEAR) for value in [0.3, -0.2, 0.9]])
+
+def test_segmented_step_items(tmp_path):
+    apply_and_check(tmp_path, [[0.0, 1.0, 3], [2.0, 20.0, 4, 'log']], \
+                    [(START_STOP, N_PTS, 0.0, 0.0, 1.0, 3, LINEAR), (START_STOP, N_PTS, 2.0, 2.0, 20.0, 4, LOG)])
@@ -0,0 +1,130 @@
+## Lazy sweep grids of the iteration specifications and channel relations
+##  Channel ranges evaluated over the dependent axes only (in chunks) must
+##  match those evaluated over the fully materialised grid.
+
+import itertools
+
+import numpy as np
+import pytest
+
+from PSICT_UIF._include36.SweepGrid import SweepGrid
+from PSICT_UIF._include36.ParameterSpec import make_iteration_spec
+
+from interface import make_interface
+
+CHANNEL_DEFS = {'f': 'Source - Frequency', 'p': 'Source - Power', 'a': 'AWG - Amplitude', \
+                'o': 'AWG - Offset', 'g': 'AWG - Gain', 'd': 'Mixer - Detuning'}
+
+def make_grid(*, chunk_size = 7):
+    channel_values = {
+            'Source - Frequency': make_iteration_spec([4e9, 5e9, 11]),
+            'Source - Power': make_iteration_spec([1e-3, 1e-1, 5, 'log']),
+            'AWG - Amplitude': make_iteration_spec(np.array([0.3, -0.2, 0.9])),
+            'AWG - Offset': 0.05,
+            ## The relation takes precedence over the iteration
+            'AWG - Gain': make_iteration_spec([0.0, 1.0, 101]),
+        }
+    channel_relations = {
+            'AWG - Gain': ['a*2 + o', ['a', 'o']],
+            'Mixer - Detuning': ['f - 4.5e9 + g*p', ['f', 'g', 'p']],
+        }
+    return SweepGrid(channel_values, iteration_order = ['AWG - Amplitude', 'Source - Frequency'], \
+                     channel_defs = CHANNEL_DEFS, channel_relations = channel_relations, chunk_size = chunk_size)
+
+def test_axes_in_iteration_order():
+    grid = make_grid()
+    assert grid.axis_channels == ['AWG - Amplitude', 'Source - Frequency', 'Source - Power']
+    assert grid.shape == (3, 11, 5)
+    assert grid.n_points == 165
+    assert grid.derived_channels == ['AWG - Gain', 'Mixer - Detuning']
+    assert np.allclose(grid.axis_values[2], np.logspace(-3, -1, 5))
+
+def test_dependencies():
+    grid = make_grid()
+    assert grid.get_dependencies('Source - Power') == [2]
+    assert grid.get_dependencies('AWG - Offset') == []
+    assert grid.get_dependencies('AWG - Gain') == [0]
+    assert grid.get_dependencies('Mixer - Detuning') == [0, 1, 2]
+
+def test_channel_values_over_dependent_axes():
+    grid = make_grid()
+    gain_chunks = list(grid.iterate_channel_values('AWG - Gain'))
+    assert np.allclose(np.concatenate(gain_chunks), [0.65, -0.35, 1.85])
+    detuning_chunks = list(grid.iterate_channel_values('Mixer - Detuning'))
+    assert all(len(chunk) <= 7 for chunk in detuning_chunks)
+    assert sum(len(chunk) for chunk in detuning_chunks) == grid.n_points
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1000])
+def test_ranges_match_full_grid(chunk_size):
+    grid = make_grid(chunk_size = chunk_size)
+    amplitude, frequency, power = (values.ravel() for values in np.meshgrid(*grid.axis_values, indexing = 'ij'))
+    gain = amplitude*2 + 0.05
+    detuning = frequency - 4.5e9 + gain*power
+    summary = grid.summarize(n_log_values = 2)
+    assert summary['shape'] == (3, 11, 5)
+    assert summary['n_points'] == 165
+    ## Three swept, two derived, and two logged values per point
+    assert summary['file_size'] == 165*7*8
+    expected_ranges = {'AWG - Amplitude': amplitude, 'Source - Frequency': frequency, 'Source - Power': power, \
+                       'AWG - Gain': gain, 'Mixer - Detuning': detuning}
+    assert set(summary['channel_ranges']) == set(expected_ranges)
+    for channel_name, values in expected_ranges.items():
+        assert summary['channel_ranges'][channel_name] == pytest.approx((values.min(), values.max()))
+
+def test_segmented_axis():
+    grid = SweepGrid({'Source - Frequency': make_iteration_spec([[0.0, 1.0, 3], [2.0, 4.0, 2]])})
+    assert grid.shape == (5,)
+    assert grid.get_channel_range('Source - Frequency') == (0.0, 4.0)
+
+def test_invalid_relations():
+    grid = SweepGrid({'A - x': make_iteration_spec([0.0, 1.0, 3])}, channel_defs = {'x': 'A - x', 'y': 'A - y'}, \
+                     channel_relations = {'A - y': ['z*2', ['z']], 'A - z': ['y + x', ['y', 'x']]})
+    with pytest.raises(KeyError, match = 'Channel key z'):
+        grid.get_channel_range('A - y')
+    grid.channel_defs['z'] = 'A - z'
+    with pytest.raises(ValueError, match = 'circular'):
+        grid.get_dependencies('A - y')
+    grid = SweepGrid({}, channel_defs = {'x': 'A - x'}, channel_relations = {'A - y': ['x*2', ['x']]})
+    with pytest.raises(KeyError, match = 'No value is set'):
+        grid.get_channel_range('A - y')
+
+def make_measurement_interface(tmp_path, monkeypatch):
+    interface = make_interface(tmp_path, monkeypatch)
+    interface.set_point_values({
+            'SQPG': {
+                'main': {'Truncation range': 3, 'Sample rate': 1e9},
+                'x': {'a': 0.5, 'w': 1e-8, 'o': 1, 'time_reference': 'absolute', 'time_offset': 1e-7, \
+                      'pulse_number': 1},
+                'y': {'a': 0.3, 'w': 2e-8, 'o': 2, 'time_reference': 'previous', 'time_offset': 1e-8, \
+                      'pulse_number': 2},
+            },
+            'Source': {'Power': 0.01},
+        })
+    interface.set_iteration_values({'SQPG': {'x': {'a': [0.0, 1.0, 11]}}, 'Source': {'Frequency': [4e9, 5e9, 6]}}, \
+                                   [('Source', 'Frequency'), ('SQPG', ('x', 'Amplitude'))])
+    interface.set_channel_relations({'SQPG': {'x': {'ax': 'Amplitude'}, 'y': {'ay': 'Amplitude'}}, \
+                                     'Source': {'f': 'Frequency'}}, \
+                                    {'SQPG': {'y': {'Amplitude': 'ax/2 + f*1e-10'}}})
+    return interface
+
+def test_interface_sweep_grid(tmp_path, monkeypatch):
+    interface = make_measurement_interface(tmp_path, monkeypatch)
+    summary = interface.get_sweep_grid().summarize()
+    assert summary['shape'] == (6, 11)
+    assert summary['channel_ranges']['Source - Frequency'] == (4e9, 5e9)
+    assert summary['channel_ranges']['SQPG - Amplitude #1'] == (0.0, 1.0)
+    assert summary['channel_ranges']['SQPG - Amplitude #2'] == pytest.approx((0.4, 1.0))
+
+def test_interface_sweep_grid_conversion_reused(tmp_path, monkeypatch):
+    interface = make_measurement_interface(tmp_path, monkeypatch)
+    interface.get_sweep_grid()
+    output_pulses = list(interface.pulseSeqManager.export_output())
+    ## The measurement pre-processing uses the sequence converted for the sweep grid
+    interface.process_pulse_sequence()
+    assert all(pulse is output_pulse for pulse, output_pulse in \
+                itertools.zip_longest(interface.pulseSeqManager.export_output(), output_pulses))
+    ## Changes since the sweep grid are still applied
+    assert interface.get_sweep_grid().shape == (6, 11)
+    interface.set_iteration_values({'SQPG': {'x': {'a': [0.0, 1.0, 21]}}, 'Source': {'Frequency': [4e9, 5e9, 3]}}, \
+                                   [('Source', 'Frequency'), ('SQPG', ('x', 'Amplitude'))])
+    assert interface.get_sweep_grid().shape == (3, 21)
@@ -0,0 +1,101 @@
+## Equivalence of the vectorized and pulse-by-pulse pulse sequence conversions
+##  Random input sequences (with and without global inverted-pulse parameters,
+##  with iterations and channel relations) are converted with both paths, and
+##  the full converted and exported outputs are compared.
+
+import copy
+import random
+import types
+import logging
+
+import pytest
+
+from PSICT_UIF._include36.PulseSeqManager import PulseSeqManager
+from PSICT_UIF._include36.LabberExporter import LabberExporter
+from PSICT_UIF._include36.ParameterSpec import IterationSpec
+
+logging.disable(logging.WARNING)
+
+SCRIPT_RC = types.SimpleNamespace(parameter_pre_process = \
+                {'SQPG': {'pulse': {'o': {'XY': 1, 'Z': 2, 'Readout': 3}}}})
+
+def generate_sequence(n_pulses, seed, *, with_inverted):
+    '''
+    Generate a random input pulse sequence, with iteration specs, channel definitions and relations, and an iteration order.
+    '''
+    rnd = random.Random(seed)
+    spec = {'main': {'Truncation range': 3, 'Sample rate': 1e9, 'sequence_duration': 1e-5}}
+    if with_inverted:
+        spec['inverted'] = {'a': 0.5, 'o': 'Z'}
+    names = ['p{}'.format(i) for i in range(n_pulses)]
+    for i, name in enumerate(names):
+        params = {'a': rnd.random(), 'w': rnd.random() * 1e-8, 'v': rnd.random() * 1e-8, \
+                  'time_offset': rnd.random() * 1e-8, 'pulse_number': i + 1, 'f': 1e8, \
+                  'o': rnd.choice(['XY', 'Z', 'Readout']), 'p': 0.0}
+        choice = rnd.random()
+        if i == 0 or choice < 0.1:
+            params['time_reference'] = 'absolute'
+        elif choice < 0.55:
+            params['time_reference'] = 'previous'
+        else:
+            params['time_reference'] = 'relative'
+            params['relative_to'] = names[rnd.randrange(i)]
+            params['relative_marker'] = rnd.choice(['start', 'end'])
+        ## Inverted pulses are also included without global inverted-pulse parameters
+        if rnd.random() < 0.1:
+            params['is_inverted'] = True
+        spec[name] = params
+    ## Shuffle declaration order to create forward references
+    items = list(spec.items())
+    rnd.shuffle(items)
+    iterations = {names[j]: {'a': [0.0, 1.0, 11]} for j in rnd.sample(range(n_pulses), min(5, n_pulses))}
+    channel_defs = {names[j]: {'a': 'amp{}'.format(j)} for j in range(0, min(n_pulses, 20), 2)}
+    channel_relations = {names[j]: {'a': 'amp{}*2'.format(j - 1)} for j in range(1, min(n_pulses, 20), 2)}
+    iteration_order = [('SQPG', (name, 'Amplitude')) for name in list(iterations)[:3]] \
+                        + [('SQPG', ('main', 'Sample rate'))]
+    return dict(items), iterations, channel_defs, channel_relations, iteration_order
+
+def normalize(value):
+    if isinstance(value, IterationSpec):
+        return ('iteration', value.start_value, value.stop_value, value.n_pts)
+    return value
+
+def convert(sequence, *, vectorized):
+    '''
+    Convert and export the given sequence, returning all outputs in a comparable form.
+    '''
+    spec, iterations, channel_defs, channel_relations, iteration_order = copy.deepcopy(sequence)
+    manager = PulseSeqManager()
+    manager.assign_script_rcmodule(SCRIPT_RC, None)
+    manager.set_input_pulse_seq(spec)
+    manager.set_iteration_spec(iterations)
+    manager.add_channel_defs(channel_defs)
+    manager.add_channel_relations(channel_relations)
+    manager.convert_seq(vectorized = vectorized)
+    exporter = LabberExporter()
+    exporter.add_point_value_spec('SQPG', manager.get_main_params())
+    exporter.receive_pulse_sequence(manager.export_output())
+    exporter.receive_pulse_rels(*manager.export_relations())
+    exporter.set_iteration_order(iteration_order)
+    exporter.process_iteration_order()
+    return {
+            'pulses': [sorted((name, normalize(value)) for name, value in pulse.attributes.items()) \
+                            for pulse in manager.export_output()],
+            'main': sorted(manager.get_main_params().items()),
+            'channel_defs': exporter._raw_channel_defs,
+            'channel_relations': exporter._channel_relations,
+            'iteration_order': exporter._iteration_order,
+        }
+
+@pytest.mark.parametrize('with_inverted', [False, True])
+@pytest.mark.parametrize('n_pulses', [1, 5, 30, 120])
+@pytest.mark.parametrize('seed', range(3))
+def test_vectorized_matches_scalar(n_pulses, seed, with_inverted):
+    sequence = generate_sequence(n_pulses, seed, with_inverted = with_inverted)
+    assert convert(sequence, vectorized = True) == convert(sequence, vectorized = False)
+
+def test_inverted_params_default_empty():
+    sequence = generate_sequence(10, 0, with_inverted = False)
+    assert 'inverted' not in sequence[0]
+    output = convert(sequence, vectorized = True)
+    assert len(output['pulses']) == 10
@@ -0,0 +1,118 @@
+## On-disk waveform store of the PSICT MultiPulse driver
+##  Waveforms written to the store must read back unchanged (padded with zeros
+##  to the store length), and the store files must be deleted when the store
+##  is closed or replaced.
+
+import os
+
+import numpy as np
+import pytest
+
+from multipulse import make_driver, set_value, get_waveforms
+
+from waveforms_handling import WAVEFORM_PARAMETERS, generateSequenceWaveforms
+from waveforms_store import WaveformStore, storeSequenceWaveforms
+
+STORE_VALUES = {'Number of points': 12e3, 'First pulse delay': 1e-7, 'Use waveform store': True}
+
+def make_waveforms(n_trace, n_points, seed):
+    random_state = np.random.RandomState(seed)
+    return list(random_state.normal(size = (n_trace, n_points))), list(random_state.normal(size = (n_trace, n_points)))
+
+def get_store_paths(base_path):
+    return [base_path + suffix for suffix in ['_waveforms.npy', '_points.npy', '_written.npy']]
+
+def test_round_trip(tmp_path):
+    base_path = str(tmp_path / 'store')
+    store = WaveformStore(base_path, 3, 2, 100)
+    waveforms, quadratures = make_waveforms(2, 100, 0)
+    assert not store.isWritten(1)
+    store.write(1, waveforms, quadratures, 100.0)
+    assert store.isWritten(1)
+    assert not store.isWritten(0)
+    read_waveforms, read_quadratures, n_points = store.read(1)
+    assert n_points == 100
+    assert read_waveforms.dtype == np.float64
+    assert np.array_equal(read_waveforms, waveforms)
+    assert np.array_equal(read_quadratures, quadratures)
+    store.close()
+    ## Written waveforms are visible when the store is re-opened (eg by another process)
+    reopened_store = WaveformStore(base_path)
+    assert reopened_store.isWritten(1)
+    assert np.array_equal(reopened_store.read(1)[0], waveforms)
+    reopened_store.close()
+
+def test_short_sequences_zero_padded(tmp_path):
+    store = WaveformStore(str(tmp_path / 'store'), 2, 2, 100)
+    waveforms, quadratures = make_waveforms(2, 60, 1)
+    store.write(0, waveforms, quadratures, 60)
+    read_waveforms, read_quadratures, n_points = store.read(0)
+    assert n_points == 60
+    assert read_waveforms.shape == (2, 60)
+    assert np.array_equal(read_waveforms, waveforms)
+    assert np.array_equal(read_quadratures, quadratures)
+    ## The remainder of the sequence is padded with zeros
+    assert not store.mWaveforms[0, :, :, 60:].any()
+    store.close()
+
+def test_float32(tmp_path):
+    store = WaveformStore(str(tmp_path / 'store'), 1, 2, 50, bFloat32 = True)
+    waveforms, quadratures = make_waveforms(2, 50, 2)
+    store.write(0, waveforms, quadratures, 50)
+    read_waveforms, read_quadratures, _ = store.read(0)
+    assert read_waveforms.dtype == np.float32
+    assert np.array_equal(read_waveforms, np.array(waveforms, dtype = np.float32))
+    assert np.array_equal(read_quadratures, np.array(quadratures, dtype = np.float32))
+    assert os.path.getsize(str(tmp_path / 'store_waveforms.npy')) < 2 * 2 * 50 * 8
+    store.close()
+
+@pytest.mark.parametrize('delete', [True, False])
+def test_close_deletes_files(tmp_path, delete):
+    base_path = str(tmp_path / 'store')
+    store = WaveformStore(base_path, 1, 1, 10)
+    store.close(bDelete = delete)
+    assert store.mWaveforms is None
+    assert [os.path.exists(path) for path in get_store_paths(base_path)] == [not delete] * 3
+
+def test_store_sequence_waveforms(tmp_path, monkeypatch):
+    driver = make_driver(monkeypatch, STORE_VALUES)
+    values = {param_name: driver.getValue(param_name) for param_name in WAVEFORM_PARAMETERS}
+    base_path = str(tmp_path / 'store')
+    store = WaveformStore(base_path, len(driver.lPulseSequences), driver.nTrace, values['Number of points'])
+    storeSequenceWaveforms(base_path, 4, driver.nTrace, driver.lPulseDefinitions, driver.lPulseSequences[4], values)
+    waveforms, quadratures, n_points = generateSequenceWaveforms(driver.nTrace, driver.lPulseDefinitions, \
+                                                                 driver.lPulseSequences[4], values)
+    assert store.isWritten(4)
+    assert store.read(4)[2] == n_points
+    assert np.array_equal(store.read(4)[0], waveforms)
+    assert np.array_equal(store.read(4)[1], quadratures)
+    store.close(bDelete = True)
+    driver.performClose()
+
+def test_driver_replaces_store(tmp_path, monkeypatch):
+    driver = make_driver(monkeypatch, dict(STORE_VALUES, **{'Waveform store directory': str(tmp_path)}))
+    set_value(driver, 'Pulse sequence counter', 2)
+    driver.updateWaveform()
+    store = driver.oWaveformStore
+    assert store.isWritten(2)
+    old_paths = get_store_paths(store.sBasePath)
+    assert sorted(os.listdir(str(tmp_path))) == sorted(map(os.path.basename, old_paths))
+    stored_waveforms = get_waveforms(driver)
+    ## Waveforms are read back from the store as views onto the file
+    assert isinstance(driver.lWaveforms, np.memmap)
+    ## Changing a waveform parameter replaces the store, deleting the old files
+    set_value(driver, 'First pulse delay', 2e-7)
+    driver.updateWaveform()
+    assert driver.oWaveformStore is not store
+    assert not any(os.path.exists(path) for path in old_paths)
+    assert len(os.listdir(str(tmp_path))) == 3
+    assert not np.array_equal(get_waveforms(driver)[0], stored_waveforms[0])
+    ## Changing the store precision also replaces the store
+    new_store = driver.oWaveformStore
+    set_value(driver, 'Store waveforms as float32', True)
+    driver.updateWaveform()
+    assert driver.oWaveformStore.mWaveforms.dtype == np.float32
+    assert not os.path.exists(new_store.sBasePath + '_waveforms.npy')
+    ## Closing the driver deletes the store
+    driver.performClose()
+    assert os.listdir(str(tmp_path)) == []